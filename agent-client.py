@@ -0,0 +1,29 @@
+import runpy
+import sys
+from pathlib import Path
+from util.agent import *
+
+SCRIPT_DIR = Path(__file__).parent
+AGENT_INFO = SCRIPT_DIR / '.agent'
+
+def main():
+    """Run one of the adapter's scripts through the agent, e.g. `agent-client.py launcher -g 123`. If the agent isn't
+    running, the script is run in this process instead, exactly as if it had been run directly.
+
+    This is kept as small as possible, since its startup time is paid on every stream.
+    """
+    if len(sys.argv) < 2 or not sys.argv[1] in AGENT_SCRIPTS:
+        print(f"Usage: agent-client.py {{{','.join(AGENT_SCRIPTS)}}} [script args...]", file=sys.stderr)
+        sys.exit(2)
+    script, argv = sys.argv[1], sys.argv[2:]
+
+    exit_code = run_in_agent(script, argv, AGENT_INFO)
+    if exit_code is not None:
+        sys.exit(exit_code)
+
+    script_path = SCRIPT_DIR / f"{script}.py"
+    sys.argv = [str(script_path)] + argv
+    runpy.run_path(str(script_path), run_name='__main__')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import threading
+from pathlib import Path
+from util.agent import *
+from util.log import *
+from util.session import *
+from util.script import *
+
+SCRIPT_DIR = Path(__file__).parent
+AGENT_INFO = SCRIPT_DIR / '.agent'
+LOG = Logger(SCRIPT_DIR / 'logs' / 'agent-log.jsonl')
+# Opening and closing Steam's windows must not interleave, otherwise a teardown that's still running from the last
+# stream could close the Big Picture window the next stream just opened
+STEAM_WINDOW_LOCK = threading.Lock()
+# Settings are copied around as whole files, so only one sync runs at a time
+SETTINGS_SYNC_LOCK = threading.Lock()
+
+def make_handlers() -> Dict[str, AgentHandler]:
+    """Load each script once. Anything they cache (Steam paths, the Big Picture window title, the process backend) is
+    kept for the life of the agent, rather than rediscovered every stream."""
+    pre_launcher = load_script(SCRIPT_DIR / 'pre-launcher.py')
+    launcher = load_script(SCRIPT_DIR / 'launcher.py')
+    teardown = load_script(SCRIPT_DIR / 'teardown.py')
+    settings_sync = load_script(SCRIPT_DIR / 'settings-sync.py')
+    prep = load_script(SCRIPT_DIR / 'prep.py')
+
+    def run_teardown(argv: List[str], env: Dict[str, str]):
+        if argv[-1:] == ['detached']:
+            # Detached mode only exists so stream shutdown isn't blocked on teardown. There's no need to spawn another
+            # process for that here, just don't make the client wait. The session is resolved now rather than in the
+            # thread, in case the next stream starts a new one before the thread gets to it
+            options = argv[:-1] or ['-S', join_session(teardown.SESSION_PATH).id]
+            threading.Thread(target=run_teardown, args=(options + ['normal'], env), daemon=True).start()
+            return
+        with STEAM_WINDOW_LOCK:
+            teardown.LOG.with_error_catching(lambda: teardown.main(argv), 'teardown script')
+
+    def run_prep(argv: List[str], env: Dict[str, str]):
+        # Undo starts teardown in the background, which waits for the window lock until prep is done with it
+        prep.LOG.with_error_catching(lambda: prep.main(argv, env, lambda: run_teardown(['detached'], env)), 'prep script')
+
+    return {
+        'prep': run_prep,
+        'pre-launcher': lambda argv, env: pre_launcher.LOG.with_error_catching(pre_launcher.main, 'pre-launcher script'),
+        'launcher': lambda argv, env: launcher.LOG.with_error_catching(lambda: launcher.main(argv), 'launcher script'),
+        'teardown': run_teardown,
+        'settings-sync': lambda argv, env: settings_sync.LOG.with_error_catching(lambda: settings_sync.main(argv, env), 'settings sync script'),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Sunshine Steam Adapter Agent',
+        description='Long-running process that runs the prep, pre-launcher, launcher, teardown, and settings sync scripts on behalf of agent-client.py, so streams start faster. Run it at logon, e.g. with pythonw from a scheduled task.'
+    )
+    parser.add_argument('--address', type=str, default=None, help=f"Named pipe or socket to listen on. Defaults to {get_default_agent_address()}.")
+    args = parser.parse_args()
+
+    server = AgentServer(make_handlers(), AGENT_INFO, locks={'prep': STEAM_WINDOW_LOCK, 'pre-launcher': STEAM_WINDOW_LOCK, 'settings-sync': SETTINGS_SYNC_LOCK},
+                         address=args.address, log=LOG.log)
+    server.start()
+    try:
+        server.serve_forever()
+    finally:
+        server.close()
+
+if __name__ == '__main__':
+    LOG.with_error_catching(main, 'agent')
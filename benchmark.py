@@ -0,0 +1,264 @@
+import argparse
+import contextlib
+import importlib.util
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+from util.shortcuts import *
+from util.vdf import *
+
+def time_it(name: str, func: Callable, repeat: int = 3):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{name}: {best * 1000:.1f} ms (best of {repeat})")
+    return result
+
+def make_shortcuts(count: int) -> dict:
+    shortcuts = {}
+    for i in range(count):
+        shortcuts[str(i)] = {
+            'appid': 0x80000000 + i,
+            'AppName': f"Emulated Game {i}",
+            'Exe': f"\"C:\\Emulators\\retroarch\\retroarch.exe\"",
+            'StartDir': "\"C:\\Emulators\\retroarch\\\"",
+            'icon': '',
+            'ShortcutPath': '',
+            'LaunchOptions': f"-L cores\\snes9x_libretro.dll \"D:\\Roms\\SNES\\game-{i}.sfc\"",
+            'IsHidden': 0,
+            'AllowDesktopConfig': 1,
+            'AllowOverlay': 1,
+            'OpenVR': 0,
+            'Devkit': 0,
+            'DevkitGameID': '',
+            'DevkitOverrideAppID': 0,
+            'LastPlayTime': 1690000000 + i,
+            'FlatpakAppID': '',
+            'tags': {'0': 'Emulation', '1': 'SNES'} if i % 2 == 0 else {},
+        }
+    return {'shortcuts': shortcuts}
+
+def write_shortcuts_file(file_path: Path, count: int):
+    file_path.write_bytes(dumps(make_shortcuts(count)))
+
+# The following function is adapted from code originally from https://github.com/boppreh/steamgrid.
+# It is the regex-based parser that util/steam.py used before switching to util/vdf.py, kept here for comparison.
+# Please refer to the below license from the original code.
+
+# The MIT License (MIT)
+
+# Copyright (c) 2016 BoppreH
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+def parse_shortcuts_with_regex(shortcut_path: Path) -> list:
+    shortcut_bytes = shortcut_path.read_bytes()
+    game_pattern = re.compile(b"\x00\x02appid\x00(.{4})\x01appname\x00([^\x08]+?)\x00\x01exe\x00([^\x08]+?)\x00\x01.+?\x00tags\x00(?:\x01([^\x08]+?)|)\x08\x08", flags=re.DOTALL | re.IGNORECASE)
+    games = []
+    for game_match in game_pattern.findall(shortcut_bytes):
+        alt_id = int.from_bytes(game_match[0], byteorder='little', signed=False)
+        games.append((alt_id, game_match[1].decode('utf-8'), game_match[2].decode('utf-8')))
+    return games
+
+def parse_shortcuts_with_reader(shortcut_path: Path) -> list:
+    games = []
+    # Same fields as the regex parser reads
+    for _, entry in iter_file_map_entries(shortcut_path, 'shortcuts', ('appid', 'appname', 'exe')):
+        games.append((get_field(entry, 'appid') & 0xFFFFFFFF, get_field(entry, 'appname'), get_field(entry, 'exe')))
+    return games
+
+def vdf_handler(args):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        shortcut_path = Path(temp_dir) / 'shortcuts.vdf'
+        write_shortcuts_file(shortcut_path, args.count)
+        print(f"Generated {shortcut_path} with {args.count} shortcuts ({shortcut_path.stat().st_size} bytes)")
+
+        regex_games = time_it('Regex parser', lambda: parse_shortcuts_with_regex(shortcut_path))
+        reader_games = time_it('Binary VDF reader', lambda: parse_shortcuts_with_reader(shortcut_path))
+        print(f"Regex parser found {len(regex_games)} games, binary VDF reader found {len(reader_games)} games")
+
+def shortcut_cache_handler(args):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        shortcut_path = Path(temp_dir) / 'shortcuts.vdf'
+        cache_path = Path(temp_dir) / '.shortcut-cache'
+        shortcuts = make_shortcuts(args.count)
+        shortcut_path.write_bytes(dumps(shortcuts))
+
+        def read_with_cache() -> ShortcutCache:
+            cache = ShortcutCache.from_file(cache_path)
+            _, changed = cache.read_shortcuts(shortcut_path)
+            if changed:
+                cache.to_file(cache_path)
+            return cache
+
+        def run(name: str, prepare: Callable):
+            prepare()
+            start_time = time.perf_counter()
+            cache = read_with_cache()
+            elapsed = time.perf_counter() - start_time
+            print(f"{name}: {elapsed * 1000:.1f} ms ({cache.parsed_count} parsed, {cache.reused_count} from cache)")
+
+        def touch():
+            stat = shortcut_path.stat()
+            os.utime(shortcut_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+        def modify_one():
+            shortcuts['shortcuts']['0']['AppName'] = 'Renamed Game'
+            shortcut_path.write_bytes(dumps(shortcuts))
+            touch()
+
+        run('Cold (no cache)', lambda: cache_path.unlink(missing_ok=True))
+        run('Warm (unchanged file)', lambda: None)
+        run('Warm (mtime changed, same content)', touch)
+        run('Warm (one shortcut changed)', modify_one)
+
+def sync_handler(args):
+    # Imported here, since the library pulls in the Windows-only Steam helpers
+    from util.library import Library, MissingPolicy
+
+    def make_game(i: int, name: Optional[str] = None) -> Game:
+        if i % 4 == 0:
+            id = str(get_app_id_from_alt_id(0x80000000 + i))
+            return Game(id, name or f"Emulated Game {i}", alt_id=id, process_name='retroarch.exe')
+        return Game(str(i), name or f"Steam Game {i}")
+
+    # Library with args.games games and args.exclusions exclusions. Steam reports every one of them (so nothing is
+    # prompted for), plus 1% renamed games and 1% new games.
+    total = args.games + args.exclusions
+    library = Library(games=[make_game(i) for i in range(args.games)],
+                      exclusions=[make_game(i) for i in range(args.games, total)])
+    renamed = set(range(0, total, 100))
+    new_games = [make_game(i, f"Renamed Game {i}" if i in renamed else None) for i in range(total)]
+    new_games += [make_game(i) for i in range(total, total + args.games // 100)]
+
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        start_time = time.perf_counter()
+        library.apply_sync_plan(library.plan_sync(new_games), MissingPolicy.KEEP)
+        elapsed = time.perf_counter() - start_time
+    print(f"Synced {args.games} games and {args.exclusions} exclusions in {elapsed * 1000:.1f} ms")
+
+# Scripts Sunshine runs for every stream. Each one is a separate interpreter, so their startup cost adds up. Prep is
+# the entry point of each stream, and loads the pre-launcher and settings sync scripts. With the agent, every script
+# is started through the agent client instead
+LAUNCH_SCRIPTS = ['prep.py', 'settings-sync.py', 'pre-launcher.py', 'launcher.py', 'teardown.py', 'agent-client.py']
+
+# Windows-only modules the scripts import at the top level. Where they aren't installed, the startup probe replaces
+# them with empty stand-ins, so the rest of each script's startup can still be measured
+WINDOWS_MODULES = ['win32process', 'winreg']
+
+# Default maximum time to first action for each script, in milliseconds
+STARTUP_BUDGET = 250
+
+# Loads a script without running its main block, then prints how long the imports and module level setup took
+STARTUP_PROBE = '''
+import importlib.machinery, importlib.util, sys, time, types
+class StubLoader:
+    def create_module(self, spec):
+        return types.ModuleType(spec.name)
+    def exec_module(self, module):
+        pass
+class StubFinder:
+    def find_spec(self, name, path, target=None):
+        if name in sys.argv[2:]:
+            return importlib.machinery.ModuleSpec(name, StubLoader())
+sys.meta_path.insert(0, StubFinder())
+start_time = time.perf_counter()
+spec = importlib.util.spec_from_file_location('startup_probe', sys.argv[1])
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+print(time.perf_counter() - start_time)
+'''
+
+def get_missing_windows_modules() -> List[str]:
+    return [name for name in WINDOWS_MODULES if importlib.util.find_spec(name) is None]
+
+def measure_startup(script_path: Path, repeat: int) -> Tuple[float, float]:
+    """Return the median import time and time to first action of a script, in milliseconds."""
+    stubbed_modules = get_missing_windows_modules()
+    import_times = []
+    first_action_times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', STARTUP_PROBE, str(script_path), *stubbed_modules],
+                                cwd=script_path.parent, capture_output=True, text=True)
+        elapsed = time.perf_counter() - start_time
+        if result.returncode != 0:
+            raise RuntimeError(f"Failed to load {script_path.name}:\n{result.stderr}")
+        import_times.append(float(result.stdout.strip().splitlines()[-1]))
+        first_action_times.append(elapsed)
+
+    # The time to first action covers everything from spawning the process until the script's main block would
+    # start, including interpreter startup
+    return statistics.median(import_times) * 1000, statistics.median(first_action_times) * 1000
+
+def startup_handler(args):
+    script_dir = Path(__file__).parent
+    stubbed_modules = get_missing_windows_modules()
+    if stubbed_modules:
+        print(f"Not on Windows, so these modules are stubbed out, and not included in the timings: {', '.join(stubbed_modules)}")
+    over_budget = []
+    for script in LAUNCH_SCRIPTS:
+        import_time, first_action_time = measure_startup(script_dir / script, args.repeat)
+        print(f"{script}: imports {import_time:.1f} ms, time to first action {first_action_time:.1f} ms (median of {args.repeat})")
+        if args.budget is not None and first_action_time > args.budget:
+            over_budget.append(script)
+
+    if over_budget:
+        print(f"Over the startup budget of {args.budget} ms: {', '.join(over_budget)}")
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Sunshine Steam Adapter Benchmarks',
+        description='Benchmarks for the performance sensitive parts of the adapter. These use synthetic data, so they can be run without Steam installed.'
+    )
+    subparsers = parser.add_subparsers(required=True, help='Which benchmark to run.')
+
+    vdf_parser = subparsers.add_parser('vdf', help='Compare parsing a synthetic shortcuts.vdf with the binary VDF reader against the legacy regex.')
+    vdf_parser.add_argument('-n', '--count', type=int, default=20000, help='Number of shortcuts to generate.')
+    vdf_parser.set_defaults(handler=vdf_handler)
+
+    shortcut_cache_parser = subparsers.add_parser('shortcut-cache', help='Report cold and warm timings for reading a synthetic shortcuts.vdf through the shortcut cache.')
+    shortcut_cache_parser.add_argument('-n', '--count', type=int, default=20000, help='Number of shortcuts to generate.')
+    shortcut_cache_parser.set_defaults(handler=shortcut_cache_handler)
+
+    sync_parser = subparsers.add_parser('sync', help='Time syncing a large synthetic library with the games reported by Steam.')
+    sync_parser.add_argument('-g', '--games', type=int, default=50000, help='Number of games in the library.')
+    sync_parser.add_argument('-e', '--exclusions', type=int, default=10000, help='Number of exclusions in the library.')
+    sync_parser.set_defaults(handler=sync_handler)
+
+    startup_parser = subparsers.add_parser('startup', help='Report import time and time to first action for each script Sunshine launches. Exits with an error if any script is over budget.')
+    startup_parser.add_argument('-r', '--repeat', type=int, default=5, help='Number of times to launch each script.')
+    startup_parser.add_argument('-b', '--budget', type=float, default=STARTUP_BUDGET, help='Maximum allowed time to first action, in milliseconds.')
+    startup_parser.set_defaults(handler=startup_handler)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+if __name__ == '__main__':
+    main()
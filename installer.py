@@ -1,8 +1,12 @@
+import argparse
 import json
+import re
 import traceback
 from pathlib import Path
 from util.io import *
 from util.library import *
+from util.merge import *
+from util.settings import *
 from util.steam import *
 
 SCRIPT_DIR = Path(__file__).parent
@@ -10,11 +14,17 @@ PRE_LAUNCHER_PATH = SCRIPT_DIR / 'pre-launcher.py'
 LAUNCHER_PATH = SCRIPT_DIR / 'launcher.py'
 TEARDOWN_PATH = SCRIPT_DIR / 'teardown.py'
 SETTINGS_SYNC_PATH = SCRIPT_DIR / 'settings-sync.py'
+PREP_PATH = SCRIPT_DIR / 'prep.py'
+AGENT_CLIENT_PATH = SCRIPT_DIR / 'agent-client.py'
 LIBRARY_CACHE = SCRIPT_DIR / ".library-cache"
+SHORTCUT_CACHE = SCRIPT_DIR / ".shortcut-cache"
 ART_CACHE_DIR = SCRIPT_DIR / ".converted-artwork-cache"
 STATIC_ART_DIR = SCRIPT_DIR / "static-artwork"
 DEFAULT_SHORTCUT_DIR = SCRIPT_DIR / 'shortcuts'
 DEFAULT_SUNSHINE_CONFIG_PATH = Path(r'C:\Program Files\Sunshine\config\apps.json')
+# Reused for every config write, so the artwork directories are only rescanned if they change
+ARTWORK_INDEX = ArtworkIndex.from_steam_config_path(get_steam_config_path())
+ART_CACHE = ConvertedArtworkCache(ART_CACHE_DIR)
 
 def configure_non_steam_game(library: Library):
     print(f"There are currently {len(library.get_non_steam_games())} non-steam games in your library:")
@@ -63,35 +73,59 @@ def configure_game_settings_sync(library: Library):
     for game in games:
         print(f"Configuring settings sync for {game}...")
         if game.settings_path:
-            if yes_or_no(f"Settings sync already enabled for {game} with settings file {game.settings_path}. Would you like to disable it?"):
+            if yes_or_no(f"Settings sync already enabled for {game} with settings {game.settings_path}. Would you like to disable it?"):
                 game.settings_path = None
+                game.settings_patterns = []
+                game.settings_merge = False
                 library.to_file(LIBRARY_CACHE)
                 print(f"Disabled settings sync for {game}.")
                 continue
 
-        settings_path_input = input(f"Input the path to the game's settings file{f' ({game.settings_path})' if game.settings_path else ''}: ")
+        settings_path_input = input(f"Input the path to the game's settings file, or the directory its settings files are in{f' ({game.settings_path})' if game.settings_path else ''}: ")
         settings_path = Path(game.settings_path if game.settings_path and settings_path_input == '' else settings_path_input)
-        if not settings_path.is_file():
-            print(f"Error: No file {settings_path} exists.")
+        if not settings_path.exists():
+            print(f"Error: No file or directory {settings_path} exists.")
             return
+        settings_patterns = []
+        if settings_path.is_dir():
+            current_patterns = f" ({', '.join(game.settings_patterns)})" if game.settings_patterns else ''
+            patterns_input = input(f"Input glob patterns for the settings files in the directory, separated by commas (e.g. *.ini, profiles/*.json){current_patterns}. Press enter to sync every file: ")
+            if patterns_input == '' and game.settings_path and Path(game.settings_path) == settings_path.resolve():
+                settings_patterns = game.settings_patterns
+            else:
+                settings_patterns = [pattern.strip() for pattern in patterns_input.split(',') if pattern.strip()]
+            settings_files = SettingsFiles(settings_path, settings_patterns).list()
+            if not settings_files:
+                print(f"Error: No settings files found in {settings_path}.")
+                return
+            print(f"Found {len(settings_files)} settings files.")
+        settings_merge = False
+        if all(get_settings_format(path) for path in SettingsFiles(settings_path, settings_patterns).list().values()):
+            settings_merge = yes_or_no("Would you like to only sync the individual settings you change while streaming, so settings you change outside of streams (e.g. keybinds) are kept for every client?")
         game.settings_path = settings_path.resolve()
+        game.settings_patterns = settings_patterns
+        game.settings_merge = settings_merge
         library.to_file(LIBRARY_CACHE)
-        print(f"Enabled settings sync for {game} with settings file {game.settings_path}.")
+        print(f"Enabled settings sync for {game}.")
         newline()
     print(f"Configured settings sync for {len(games)} games.")
 
-def write_sunshine_config(library: Library):
+def write_sunshine_config(library: Library, art_workers: Optional[int] = None, use_agent: bool = False):
     path = Path(input(f"Input the path to write the config to (press enter to use the default of {DEFAULT_SUNSHINE_CONFIG_PATH}): ") or DEFAULT_SUNSHINE_CONFIG_PATH).resolve()
-    if path.is_file():
-        if not yes_or_no(f"Config file {path} already exists. Do you want to overwrite it?"):
-            print('Did not write Sunshine config.')
-            return
+    save_sunshine_config(library, path, art_workers, use_agent)
+
+def save_sunshine_config(library: Library, path: Path, art_workers: Optional[int] = None, use_agent: bool = False):
     print('Writing Sunshine config...')
-    json_dict = library.to_sunshine_config_json_dict(PRE_LAUNCHER_PATH, LAUNCHER_PATH, TEARDOWN_PATH, SETTINGS_SYNC_PATH, STATIC_ART_DIR, ART_CACHE_DIR)
-    with path.open(mode='w', encoding='utf-8') as file:
-        json.dump(json_dict, file, ensure_ascii=False, indent=4)
+    # Games are merged into the existing config, so we don't lose any apps the user added to Sunshine themselves
+    existing_config = read_sunshine_config(path)
+    json_dict = library.to_sunshine_config_json_dict(PRE_LAUNCHER_PATH, LAUNCHER_PATH, TEARDOWN_PATH, SETTINGS_SYNC_PATH, PREP_PATH, STATIC_ART_DIR, ART_CACHE, ARTWORK_INDEX, art_workers, existing_config,
+                                                     AGENT_CLIENT_PATH if use_agent else None)
+    changed = write_sunshine_config_file(path, json_dict)
     newline()
-    print(f"Saved Sunshine config to {path}. You may need to restart Sunshine for the changes to go into effect.")
+    if changed:
+        print(f"Saved Sunshine config to {path}. You may need to restart Sunshine for the changes to go into effect.")
+    else:
+        print(f"Sunshine config at {path} is already up to date. Nothing was written.")
 
 def print_menu():
     print('1. List loaded games')
@@ -102,7 +136,51 @@ def print_menu():
     print('6. Write games to Sunshine config')
     print('7. Quit')
 
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog='Sunshine Steam Adapter Installer',
+        description='Interactive menu for syncing your Steam library with Sunshine. Use --headless to sync without any prompts, e.g. from a scheduled task.'
+    )
+    parser.add_argument('--headless', action='store_true', help='Sync the library with Steam and quit, without showing the menu or prompting for anything.')
+    parser.add_argument('--missing-policy', type=str, choices=[policy.value for policy in MissingPolicy], default=None,
+                        help='What to do with library games and exclusions that are no longer found in Steam. Defaults to "ask", or "keep" in headless mode.')
+    parser.add_argument('--dry-run', action='store_true', help='Only print what syncing with Steam would change, then quit. Nothing is saved.')
+    parser.add_argument('--write-config', type=Path, nargs='?', const=DEFAULT_SUNSHINE_CONFIG_PATH, default=None,
+                        help=f"In headless mode, also write the Sunshine config after syncing. Defaults to {DEFAULT_SUNSHINE_CONFIG_PATH}.")
+    parser.add_argument('--art-workers', type=int, default=None,
+                        help='Number of processes used to convert artwork to png when writing the Sunshine config. Defaults to the number of CPUs.')
+    parser.add_argument('--art-cache-size', type=int, default=None,
+                        help=f"Maximum size of the converted artwork cache ({ART_CACHE_DIR}) in MB. The least recently used artwork is deleted first. Unlimited by default.")
+    parser.add_argument('--art-size', type=str, default=f"{COVER_ART_SIZE[0]}x{COVER_ART_SIZE[1]}",
+                        help='Maximum size (WIDTHxHEIGHT) of the artwork written to the Sunshine config. Larger artwork is downsampled.')
+    parser.add_argument('--art-compress-level', type=int, choices=range(10), default=None, metavar='{0-9}',
+                        help='Compression level for the artwork written to the Sunshine config. By default, pngs are fully optimized, which is slowest but smallest.')
+    parser.add_argument('--use-agent', action='store_true',
+                        help='Write Sunshine commands that run through the resident agent (agent.py) when it\'s running, and fall back to running the scripts directly when it isn\'t.')
+    args = parser.parse_args()
+
+    art_size_match = re.match(r'^(\d+)x(\d+)$', args.art_size)
+    if not art_size_match:
+        parser.error('--art-size must be of the form WIDTHxHEIGHT, e.g. 600x900')
+    args.art_size = (int(art_size_match.group(1)), int(art_size_match.group(2)))
+    if args.art_workers is not None and args.art_workers < 1:
+        parser.error('--art-workers must be at least 1')
+    if args.missing_policy is None:
+        args.missing_policy = MissingPolicy.KEEP if args.headless else MissingPolicy.ASK
+    else:
+        args.missing_policy = MissingPolicy(args.missing_policy)
+    if args.headless and args.missing_policy == MissingPolicy.ASK:
+        parser.error('--missing-policy=ask cannot be used in headless mode')
+    if args.write_config and not args.headless:
+        parser.error('--write-config can only be used in headless mode')
+    return args
+
 if __name__ == '__main__':
+    args = parse_args()
+    if args.art_cache_size is not None:
+        ART_CACHE.max_bytes = args.art_cache_size * 1024 * 1024
+    ART_CACHE.size = args.art_size
+    ART_CACHE.compress_level = args.art_compress_level
     print("Loading cached library...")
     try:
         library = Library.from_file(LIBRARY_CACHE)
@@ -110,10 +188,17 @@ if __name__ == '__main__':
         print(f"Failed to read cached library. It may be corrupted. Quitting to avoid overwriting it. Error was: {traceback.format_exc()}")
         sys.exit(-1)
     print("Syncing library with Steam games...")
-    library.sync_library_with_steam()
+    library.sync_library_with_steam(SHORTCUT_CACHE, missing_policy=args.missing_policy, dry_run=args.dry_run)
+    if args.dry_run:
+        sys.exit(0)
     library.to_file(LIBRARY_CACHE)
     newline()
 
+    if args.headless:
+        if args.write_config:
+            save_sunshine_config(library, args.write_config.resolve(), args.art_workers, args.use_agent)
+        sys.exit(0)
+
     while True:
         newline()
         print_menu()
@@ -130,7 +215,7 @@ if __name__ == '__main__':
             configure_game_settings_sync(library)
         elif choice == 6:
             try:
-                write_sunshine_config(library)
+                write_sunshine_config(library, args.art_workers, args.use_agent)
             except BaseException as e:
                 newline()
                 print(f"Failed to write Sunshine config. Error was: {traceback.format_exc()}")
@@ -1,32 +1,62 @@
 import argparse
 import subprocess
 import time
-import win32com.client, win32gui
 import winreg
 from pathlib import Path
-from typing import Callable, Optional
+from typing import List, Optional
 from util.log import *
+from util.process import *
+from util.registry import *
+from util.session import *
 from util.steam import *
+from util.wait import *
+from util.window import *
 
 SCRIPT_DIR = Path(__file__).parent
-LOG = Logger(SCRIPT_DIR / 'logs' / 'launcher-log.txt')
-
-def get_running_processes():
-    WMI = win32com.client.GetObject('winmgmts:')
-    processes = WMI.InstancesOf('Win32_Process')
-    map = {}
-    for process in processes:
-        map[process.Properties_("Name").Value] = process.Properties_("ProcessID").Value
-    return map
-
-def wait_for_state_with_timeout(state_checker: Callable[[], bool], timeout: float):
-    start_time = time.perf_counter()
-    while not state_checker():
-        if time.perf_counter() - start_time > timeout:
-            raise RuntimeError(f"Timed out waiting for previous step to finish. Waited {timeout} seconds")
-        time.sleep(0.25)
-
-def launch_game_and_wait_for_close(game_id: Optional[int] = None, process_name: Optional[str] = None):
+LOG = Logger(SCRIPT_DIR / 'logs' / 'launcher-log.jsonl')
+SESSION_PATH = SCRIPT_DIR / '.session'
+PROCESS_TABLE = ProcessTable()
+
+def wait_for_steam_game(game_id: int, running_app_id_watcher: RegistryValueWatcher, session: Session, launch_time: float, start_timeout: float = 15):
+    """Wait for a Steam game to start, then to quit, based on Steam's RunningAppId registry value.
+
+    The watcher wakes the waits whenever the registry key changes, so both are detected as soon as Steam updates the
+    value.
+    """
+    # Wait for game to start running
+    wait_until(lambda: running_app_id_watcher.read() == game_id, 'game to start', timeout=start_timeout,
+               events=running_app_id_watcher, log=LOG.log)
+    log_span(LOG.log, session, 'game detected', launch_time, time.perf_counter())
+    LOG.log("Game is now running")
+
+    # Wait for game to close
+    LOG.log("Waiting for game to quit")
+    with span(LOG.log, session, 'game exited'):
+        wait_until(lambda: running_app_id_watcher.read() != game_id, 'game to quit', events=running_app_id_watcher, log=LOG.log)
+    LOG.log("Game has quit")
+
+def wait_for_non_steam_game(process_name: str, session: Session, launch_time: float, start_timeout: float = 15):
+    """Wait for a non-Steam game to start, then to quit, based on its process name."""
+    def is_game_running() -> bool:
+        return PROCESS_TABLE.is_running(process_name)
+
+    # Wait for game to start running
+    wait_until(is_game_running, 'game to start', timeout=start_timeout, log=LOG.log)
+    log_span(LOG.log, session, 'game detected', launch_time, time.perf_counter())
+    LOG.log("Game is now running")
+
+    def get_game_pids() -> List[int]:
+        # Include the whole process tree, since the process we found may just be a launcher for the actual game
+        snapshot = PROCESS_TABLE.snapshot()
+        return snapshot.get_tree(snapshot.get_pids(process_name))
+
+    # Wait for game to close. This blocks on the game's process handles, rather than polling
+    LOG.log("Waiting for game to quit")
+    with span(LOG.log, session, 'game exited'):
+        wait_while_running(is_game_running, get_game_pids, get_default_process_waiter())
+    LOG.log("Game has quit")
+
+def launch_game_and_wait_for_close(session: Session, game_id: Optional[int] = None, process_name: Optional[str] = None):
     """Launch steam game by id, then wait for the game to quit.
 
     By default, this will use Steam's registry keys to detect when the game quits. However, the registry key is
@@ -44,37 +74,28 @@ def launch_game_and_wait_for_close(game_id: Optional[int] = None, process_name:
     if game_id:
         # Launch game
         LOG.log(f"Launching game with id={game_id}")
+        launch_time = time.perf_counter()
         subprocess.run([steam_path, f"steam://rungameid/{game_id}"])
 
-        with winreg.OpenKeyEx(winreg.HKEY_CURRENT_USER, r'SOFTWARE\Valve\Steam', 0, winreg.KEY_READ) as key:
-            def is_game_running() -> bool:
-                if process_name:
-                    return process_name in get_running_processes()
-                else:
-                    return read_reg_value(key, 'RunningAppId') == game_id
-
-            # Wait for game to start running
-            wait_for_state_with_timeout(is_game_running, 15)
-            LOG.log("Game is now running")
-
-            # Wait for game to close
-            LOG.log("Waiting for game to quit")
-            while is_game_running():
-                time.sleep(0.25)
-            LOG.log("Game has quit")
+        if process_name:
+            wait_for_non_steam_game(process_name, session, launch_time)
+        else:
+            watcher = watch_registry_value(winreg.HKEY_CURRENT_USER, r'SOFTWARE\Valve\Steam', 'RunningAppId')
+            try:
+                wait_for_steam_game(game_id, watcher, session, launch_time)
+            finally:
+                watcher.close()
 
         # Let teardown script handle closing Steam big picture. This is to prevent the stream from showing the desktop briefly
     else:
         # Wait for big picture mode to close
         LOG.log("Waiting for Steam big picture mode to close")
-        def is_big_picture_mode_open():
-            handle = get_big_picture_window()
-            return handle != 0 and win32gui.IsWindowVisible(handle)
-        while is_big_picture_mode_open():
-            time.sleep(0.25)
+        with span(LOG.log, session, 'big picture session'):
+            windows = get_window_system()
+            wait_until(lambda: not is_big_picture_window_visible(windows), 'Steam big picture mode to close', events=windows.watcher, log=LOG.log)
         LOG.log("Steam big picture mode has closed, finishing up")
 
-def main():
+def main(argv: Optional[List[str]] = None):
     parser = argparse.ArgumentParser(
         prog='Sunshine Steam Adapater Launcher',
         description='This is a launcher for steam games, for use with Sunshine. It handles launching of a steam game based on its ID.'
@@ -82,12 +103,14 @@ def main():
     parser.add_argument('-g', '--game_id', type=int, help='The steam game id to launch. If not specified, nothing will be launched, and the script will exit once big picture mode is closed.')
     parser.add_argument('-p', '--process_name', type=str, required=False,
                         help='If the game to launch is a non-steam game, you must supply the process name here. For example, any games that run via retroarch, you should specify retroarch.exe. If you provide this argument, you must also provide the game_id argument.')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if args.process_name and not args.game_id:
         raise ValueError("game_id must be provided if process_name is provided. Run with `--help` flag for more info.")
 
-    launch_game_and_wait_for_close(game_id=args.game_id, process_name=args.process_name)
+    session = join_session(SESSION_PATH, str(args.game_id) if args.game_id else None)
+    LOG.set_context(session=session.id)
+    launch_game_and_wait_for_close(session, game_id=args.game_id, process_name=args.process_name)
 
 if __name__ == '__main__':
     LOG.with_error_catching(main, 'launcher script')
@@ -1,71 +1,62 @@
 import subprocess
 import time
-import win32com.client, win32gui
 import win32process
 from pathlib import Path
-from typing import Callable
+from typing import Optional
 from util.log import *
+from util.process import *
+from util.session import *
 from util.steam import *
+from util.wait import *
+from util.window import *
 
 SCRIPT_DIR = Path(__file__).parent
-LOG = Logger(SCRIPT_DIR / 'logs' / 'pre-launcher-log.txt')
+LOG = Logger(SCRIPT_DIR / 'logs' / 'pre-launcher-log.jsonl')
+SESSION_PATH = SCRIPT_DIR / '.session'
+PROCESS_TABLE = ProcessTable()
 
-def get_running_processes():
-    WMI = win32com.client.GetObject('winmgmts:')
-    processes = WMI.InstancesOf('Win32_Process')
-    map = {}
-    for process in processes:
-        map[process.Properties_("Name").Value] = process.Properties_("ProcessID").Value
-    return map
-
-def wait_for_state_with_timeout(state_checker: Callable[[], bool], timeout: float):
-    start_time = time.perf_counter()
-    while not state_checker():
-        if time.perf_counter() - start_time > timeout:
-            raise RuntimeError(f"Timed out waiting for previous step to finish. Waited {timeout} seconds")
-        time.sleep(0.25)
-
-def launch_steam():
-    """Ensure steam is running, then open big picture mode."""
+def start_steam():
+    """Start Steam if it's not already running, and wait for it to finish starting."""
 
     # Get steam executable path
     steam_path = get_steam_exe_path()
 
     # Launch steam if it's not already running
-    if not steam_path.name in get_running_processes():
+    if not PROCESS_TABLE.is_running(steam_path.name):
         LOG.log("Launching Steam, since it was not already running")
         subprocess.Popen(steam_path, creationflags=win32process.DETACHED_PROCESS)
 
         # Wait for steam window to show. That's how we know it has fully started
-        def is_steam_window_visible():
-            handle = win32gui.FindWindow('SDL_app', 'Steam')
-            return handle != 0 and win32gui.IsWindowVisible(handle)
-        wait_for_state_with_timeout(is_steam_window_visible, 15)
+        windows = get_window_system()
+        wait_until(lambda: is_steam_window_visible(windows), 'Steam window to open', timeout=15, events=windows.watcher, log=LOG.log)
         LOG.log("Started Steam")
 
         # Give a little bit more buffer before starting big picture mode
         time.sleep(0.5)
 
+def open_big_picture():
+    """Open big picture mode, and wait for it to settle. Steam must already be running."""
+    steam_path = get_steam_exe_path()
+
     # Start big picture mode
     LOG.log("Opening Steam big picture mode")
     subprocess.run([steam_path, 'steam://open/bigpicture'])
-
-    # Wait for big picture mode to open. We require it to signal as open a few
-    # times in a row, since it will sometimes close and reopen randomly.
-    open_count = 0
-    def is_big_picture_mode_open():
-        nonlocal open_count
-        handle = get_big_picture_window()
-        if handle != 0 and win32gui.IsWindowVisible(handle):
-            open_count += 1
-        else:
-            open_count = 0
-        return open_count >= 6
-    wait_for_state_with_timeout(is_big_picture_mode_open, 15)
+    wait_for_big_picture()
     LOG.log("Opened Steam big picture mode")
 
+def wait_for_big_picture(windows: Optional[WindowSystem] = None):
+    windows = windows or get_window_system()
+    # Wait for big picture mode to open. We require it to stay open for a moment,
+    # since it will sometimes close and reopen randomly.
+    wait_until(lambda: is_big_picture_window_visible(windows), 'Steam big picture mode to open', timeout=15, stable_for=1.5, events=windows.watcher, log=LOG.log)
+
 def main():
-    launch_steam()
+    session = join_session(SESSION_PATH)
+    LOG.set_context(session=session.id)
+    with span(LOG.log, session, 'start Steam'):
+        start_steam()
+    with span(LOG.log, session, 'open big picture'):
+        open_big_picture()
 
 if __name__ == '__main__':
     LOG.with_error_catching(main, 'pre-launcher script')
@@ -0,0 +1,92 @@
+import argparse
+import os
+import subprocess
+import sys
+import win32process
+from pathlib import Path
+from typing import Callable, List, Mapping, Optional
+from util.log import *
+from util.prep import *
+from util.script import *
+from util.session import *
+from util.settings import *
+from util.steam import *
+
+SCRIPT_DIR = Path(__file__).parent
+LOG = Logger(SCRIPT_DIR / 'logs' / 'prep-log.jsonl')
+SESSION_PATH = SCRIPT_DIR / '.session'
+PRE_LAUNCHER = load_script(SCRIPT_DIR / 'pre-launcher.py')
+SETTINGS_SYNC = load_script(SCRIPT_DIR / 'settings-sync.py')
+
+def warm_up():
+    """Look up everything the later steps (and the launcher) need from the registry and Steam's files, so it's cached
+    by the time they need it."""
+    get_steam_exe_path()
+    get_steam_config_path()
+    get_localization_entries(LOCALIZATION_KEYS)
+
+def do_handler(args):
+    # Prep is the first thing Sunshine runs for a stream, so it starts the session the other scripts join
+    session = start_session(SESSION_PATH, args.game_id)
+    LOG.set_context(session=session.id)
+    LOG.log(f"Running prep with game id={args.game_id} and settings={args.settings_files} for session {session}")
+    steps = []
+    if args.settings_files:
+        client_id = SETTINGS_SYNC.get_client_id_from_env(args.env)
+        steps.append(PrepStep('load settings', lambda: SETTINGS_SYNC.start_sync(args.game_id, client_id, args.settings_files),
+                              lambda: SETTINGS_SYNC.cancel_sync(args.settings_files)))
+    steps += [
+        PrepStep('warm up lookups', warm_up),
+        PrepStep('start Steam', PRE_LAUNCHER.start_steam),
+        PrepStep('open big picture', PRE_LAUNCHER.open_big_picture, close_big_picture, depends_on=['start Steam', 'warm up lookups']),
+    ]
+    with span(LOG.log, session, 'prep'):
+        try:
+            run_prep_steps(steps, LOG.log)
+        finally:
+            for step in steps:
+                if step.end_time is not None:
+                    log_span(LOG.log, session, step.name, step.start_time, step.end_time, failed=step.error is not None)
+
+def spawn_detached_teardown():
+    subprocess.Popen([sys.executable, SCRIPT_DIR / 'teardown.py', 'detached'], creationflags=win32process.DETACHED_PROCESS)
+
+def undo_handler(args):
+    session = join_session(SESSION_PATH, args.game_id)
+    LOG.set_context(session=session.id)
+    LOG.log(f"Running prep undo with game id={args.game_id} and settings={args.settings_files} for session {session}")
+    # Same order Sunshine undid the separate prep commands in: teardown first, then saving settings
+    args.teardown()
+    LOG.log('Started teardown')
+    if args.settings_files:
+        client_id = SETTINGS_SYNC.get_client_id_from_env(args.env)
+        with span(LOG.log, session, 'save settings'):
+            SETTINGS_SYNC.finish_sync(args.game_id, client_id, args.settings_files)
+
+def main(argv: Optional[List[str]] = None, env: Optional[Mapping[str, str]] = None, teardown: Optional[Callable[[], None]] = None):
+    parser = argparse.ArgumentParser(
+        prog='Sunshine Steam Adapter Prep',
+        description='Gets everything ready for a stream at once: restores the game\'s settings (if settings sync is enabled), starts Steam, and opens big picture mode. Undo tears it all down again.'
+    )
+    parser.add_argument('-g', '--game_id', type=str, required=False, help='The game id the stream is for, used to sync its settings and to group its session timings.')
+    parser.add_argument('-s', '--settings_path', type=Path, required=False, help='The path to the game\'s settings file, or to the directory its settings files are in. If not given, settings aren\'t synced.')
+    parser.add_argument('-i', '--include', type=str, action='append', required=False, help='A glob pattern for the settings files to sync, relative to the settings directory. Can be given multiple times. Defaults to every file in the directory.')
+    parser.add_argument('-m', '--merge', action='store_true', help='Only sync the individual settings that change during streams, rather than whole settings files.')
+    subparsers = parser.add_subparsers(required=True, help='What action to take.')
+
+    do_parser = subparsers.add_parser('do', help='Prepare for the stream. If any step fails, the steps that already finished are rolled back.')
+    do_parser.set_defaults(handler=do_handler)
+
+    undo_parser = subparsers.add_parser('undo', help='Start teardown, and save the game\'s settings for the client.')
+    undo_parser.set_defaults(handler=undo_handler)
+
+    args = parser.parse_args(argv)
+    if args.settings_path and not args.game_id:
+        parser.error('game_id must be provided if settings_path is provided')
+    args.settings_files = SettingsFiles(args.settings_path, args.include, args.merge) if args.settings_path else None
+    args.env = os.environ if env is None else env
+    args.teardown = teardown or spawn_detached_teardown
+    args.handler(args)
+
+if __name__ == '__main__':
+    LOG.with_error_catching(main, 'prep script')
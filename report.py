@@ -0,0 +1,107 @@
+import argparse
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+from util.log import *
+from util.session import *
+
+SCRIPT_DIR = Path(__file__).parent
+LOG_DIR = SCRIPT_DIR / 'logs'
+LIBRARY_CACHE = SCRIPT_DIR / ".library-cache"
+
+def read_spans(log_dir: Path) -> List[dict]:
+    """Read the spans logged by every script, including from rotated logs."""
+    records = []
+    for log_path in sorted(log_dir.glob('*.jsonl')):
+        records += read_log_records(log_path)
+    return get_span_records(records)
+
+def get_game_names() -> Dict[str, str]:
+    """Names of the games in the library, so they can be shown alongside their ids."""
+    from util.library import Library
+    try:
+        return {game.id: game.name for game in Library.from_file(LIBRARY_CACHE).get_games()}
+    except (OSError, ValueError):
+        return {}
+
+def get_session_ids(spans: List[dict]) -> List[str]:
+    """Session ids, oldest first."""
+    session_ids = {}
+    for record in spans:
+        session_ids.setdefault(record['session'], record['time'])
+    return sorted(session_ids, key=lambda session_id: session_ids[session_id])
+
+def phases_handler(args):
+    spans = read_spans(args.log_dir)
+    if args.game_id:
+        spans = [record for record in spans if str(record.get('game_id')) == args.game_id]
+    if args.last:
+        session_ids = set(get_session_ids(spans)[-args.last:])
+        spans = [record for record in spans if record['session'] in session_ids]
+    if not spans:
+        print(f"No session timings found in {args.log_dir}")
+        return
+
+    summary = summarize_spans(spans)
+    game_names = get_game_names()
+    for game_id in sorted({game_id for game_id, _ in summary}):
+        session_count = len({record['session'] for record in spans if str(record.get('game_id')) == game_id})
+        # Only the Steam Big Picture app runs without a game id
+        name = game_names.get(game_id, 'Steam Big Picture' if game_id == 'None' else game_id)
+        print(f"{name} (ID={game_id}), {session_count} sessions:")
+        print(f"    {'Phase':<24}{'Count':>8}{'p50 ms':>10}{'p95 ms':>10}{'Max ms':>10}")
+        # Phases in the order they first finished
+        phases = []
+        for record in spans:
+            if str(record.get('game_id')) == game_id and (game_id, record['span']) in summary and not record['span'] in phases:
+                phases.append(record['span'])
+        for phase in phases:
+            stats = summary[(game_id, phase)]
+            print(f"    {phase:<24}{stats['count']:>8}{stats['p50']:>10.0f}{stats['p95']:>10.0f}{stats['max']:>10.0f}")
+        print()
+
+def timeline_handler(args):
+    spans = read_spans(args.log_dir)
+    session_ids = get_session_ids(spans)
+    if not session_ids:
+        print(f"No session timings found in {args.log_dir}")
+        return
+    session_id = args.session or session_ids[-1]
+    spans = [record for record in spans if record['session'] == session_id]
+    if not spans:
+        print(f"No timings found for session {session_id}")
+        return
+
+    # Spans are logged when they end, so work out when each started from its duration
+    ends = [datetime.fromisoformat(record['time']).timestamp() for record in spans]
+    starts = [end - record['duration_ms'] / 1000 for end, record in zip(ends, spans)]
+    session_start = min(starts)
+    print(f"Session {session_id} (game id={spans[0].get('game_id')}), started {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(session_start))}:")
+    print(f"    {'Phase':<24}{'Start ms':>10}{'End ms':>10}{'Took ms':>10}")
+    for start, end, record in sorted(zip(starts, ends, spans), key=lambda item: item[0]):
+        failed = ' (failed)' if record.get('failed') else ''
+        print(f"    {record['span']:<24}{(start - session_start) * 1000:>10.0f}{(end - session_start) * 1000:>10.0f}{record['duration_ms']:>10.0f}{failed}")
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Sunshine Steam Adapter Session Report',
+        description='Reports how long each phase of a stream (prep, launching the game, teardown, etc) took, from the timings the scripts log for each stream session.'
+    )
+    parser.add_argument('-l', '--log_dir', type=Path, default=LOG_DIR, help=f"The directory the scripts log to. Defaults to {LOG_DIR}.")
+    subparsers = parser.add_subparsers(required=True, help='What to report.')
+
+    phases_parser = subparsers.add_parser('phases', help='Report the p50, p95 and max duration of each phase, for each game.')
+    phases_parser.add_argument('-g', '--game_id', type=str, required=False, help='Only report sessions for this game id.')
+    phases_parser.add_argument('-n', '--last', type=int, required=False, help='Only report the last N sessions.')
+    phases_parser.set_defaults(handler=phases_handler)
+
+    timeline_parser = subparsers.add_parser('timeline', help='Show when each phase of a session started and ended.')
+    timeline_parser.add_argument('-s', '--session', type=str, required=False, help='The session id. Defaults to the most recent session.')
+    timeline_parser.set_defaults(handler=timeline_handler)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+if __name__ == '__main__':
+    main()
@@ -1,31 +1,50 @@
 import argparse
+import json
 import os
-import shutil
+import time
+from typing import Dict, List, Mapping, Optional
 from util.log import *
+from util.merge import *
+from util.session import *
+from util.settings import *
 
 SCRIPT_DIR = Path(__file__).parent
 SETTINGS_CACHE = SCRIPT_DIR / ".settings-cache"
-LOG = Logger(SCRIPT_DIR / 'logs' / 'settings-sync-log.txt')
+SETTINGS_JOURNAL_DIR = SETTINGS_CACHE / ".journal"
+# How many saved versions of each settings file are kept for each game and client
+SETTINGS_HISTORY_LENGTH = 10
+MERGED_SETTINGS_VERSION = 1
+LOG = Logger(SCRIPT_DIR / 'logs' / 'settings-sync-log.jsonl')
+SESSION_PATH = SCRIPT_DIR / '.session'
 
-def backup_settings(settings_path: Path):
-    backup_path = settings_path.with_suffix(settings_path.suffix + '.bak')
-    LOG.log(f"Backing up game's settings file to {backup_path}")
-    shutil.copy2(settings_path, backup_path)
-    if not backup_path.is_file():
-        raise RuntimeError('Could not find settings backup after doing copy')
-    LOG.log('Successfully backed up game\'s settings file')
+def get_backup_path(settings_path: Path) -> Path:
+    return settings_path.with_suffix(settings_path.suffix + '.bak')
 
-def restore_backup_settings(settings_path: Path):
-    backup_path = settings_path.with_suffix(settings_path.suffix + '.bak')
-    LOG.log(f"Restoring game's backup settings file at {backup_path}")
-    if not backup_path.is_file():
-        LOG.log("No settings backup file found. Nothing to do")
+def backup_settings(settings_files: SettingsFiles, stats: Optional[SettingsSyncStats] = None):
+    backup_path = get_backup_path(settings_files.path)
+    LOG.log(f"Backing up game's settings to {backup_path}")
+    if sync_settings_files(settings_files, settings_files.path, backup_path, stats):
+        LOG.log('Successfully backed up game\'s settings')
+    else:
+        LOG.log('Backup is already identical to game\'s settings. Skipped copying')
+
+def restore_backup_settings(settings_files: SettingsFiles, stats: Optional[SettingsSyncStats] = None):
+    backup_path = get_backup_path(settings_files.path)
+    LOG.log(f"Restoring game's backup settings at {backup_path}")
+    if not backup_path.exists():
+        LOG.log("No settings backup found. Nothing to do")
         return
-    shutil.copy2(backup_path, settings_path)
-    LOG.log('Successfully restored game\'s backup settings file')
+    if sync_settings_files(settings_files, backup_path, settings_files.path, stats):
+        LOG.log('Successfully restored game\'s backup settings')
+    else:
+        LOG.log('Game\'s settings are already identical to the backup. Skipped copying')
 
-def delete_backup_settings(settings_path: Path):
-    backup_path = settings_path.with_suffix(settings_path.suffix + '.bak')
+def delete_backup_settings(settings_files: SettingsFiles):
+    backup_path = get_backup_path(settings_files.path)
+    if settings_files.is_directory:
+        # It's identical to the game's settings now, so keeping it means the next backup only copies what changed
+        LOG.log(f"Keeping game's backup settings directory at {backup_path}, so the next backup only copies files that changed")
+        return
     LOG.log(f"Deleting game's backup settings file at {backup_path}.")
     if not backup_path.is_file():
         LOG.log("No settings backup file found. Nothing to do")
@@ -33,60 +52,286 @@ def delete_backup_settings(settings_path: Path):
     backup_path.unlink()
     LOG.log('Successfully deleted game\'s backup settings file')
 
-def get_save_path(game_id: str, client_id: str, settings_path: Path) -> Path:
+def is_backup_in_use(settings_files: SettingsFiles, journal: SettingsJournal) -> bool:
+    """Whether the backup holds the game's settings from before a stream that hasn't finished syncing. Backup
+    directories are kept between streams, so for those only the journal can tell."""
+    if journal.read() is not None:
+        return True
+    return not settings_files.is_directory and get_backup_path(settings_files.path).is_file()
+
+def get_settings_store() -> SettingsStore:
+    return SettingsStore(SETTINGS_CACHE, keep_versions=SETTINGS_HISTORY_LENGTH)
+
+def get_legacy_save_path(game_id: str, client_id: str, settings_path: Path) -> Path:
+    """Where settings were saved before the settings store. They're moved into the store the first time they're used."""
     return SETTINGS_CACHE / game_id / client_id / settings_path.name
 
-def save_settings(game_id: str, client_id: str, settings_path: Path):
-    save_path = get_save_path(game_id, client_id, settings_path)
-    LOG.log(f"Saving game's settings file to {save_path}")
-    save_path.parent.mkdir(parents=True, exist_ok=True)
-    shutil.copy2(settings_path, save_path)
-    LOG.log("Saved settings for game")
-
-def load_settings(game_id: str, client_id: str, settings_path: Path):
-    save_path = get_save_path(game_id, client_id, settings_path)
-    LOG.log(f"Loading game's settings file from {save_path}")
-    if not save_path.is_file():
-        LOG.log("No saved settings file found. Nothing to do")
+def migrate_legacy_settings(store: SettingsStore, game_id: str, client_id: str, settings_files: SettingsFiles):
+    legacy_path = get_legacy_save_path(game_id, client_id, settings_files.path)
+    if settings_files.is_directory or not legacy_path.is_file():
         return
-    shutil.copy2(save_path, settings_path)
-    LOG.log("Loaded settings to game")
+    if not store.read_history(game_id, client_id, settings_files.path.name):
+        LOG.log(f"Moving saved settings file at {legacy_path} into the settings store")
+        store.save(game_id, client_id, SettingsFiles(legacy_path))
+    legacy_path.unlink()
+
+def get_store_name(settings_files: SettingsFiles) -> str:
+    """The name settings are saved under in the settings store. Merged settings are stored separately from whole files."""
+    return f"{settings_files.path.name}.merge" if settings_files.merge else settings_files.path.name
+
+def get_merge_format(settings_path: Path):
+    settings_format = get_settings_format(settings_path)
+    if settings_format is None:
+        raise ValueError(f"Settings file {settings_path} can't be merged. Only INI, JSON and XML settings files can be")
+    return settings_format
+
+def save_whole_settings(game_id: str, client_id: str, settings_files: SettingsFiles, stats: Optional[SettingsSyncStats] = None):
+    store = get_settings_store()
+    LOG.log(f"Saving game's settings to the settings store at {store.root_path}")
+    migrate_legacy_settings(store, game_id, client_id, settings_files)
+    if store.save(game_id, client_id, settings_files, stats):
+        LOG.log("Saved settings for game")
+    else:
+        LOG.log("Saved settings are already identical to game's settings. Skipped saving")
+
+def save_merged_settings(game_id: str, client_id: str, settings_files: SettingsFiles, stats: Optional[SettingsSyncStats] = None) -> Dict[str, dict]:
+    """Save just the settings that changed since the backup was made (i.e. during the stream), and return them."""
+    backup_path = get_backup_path(settings_files.path)
+    deltas = {}
+    for name, path in settings_files.list().items():
+        base_path = settings_files.resolve(name, backup_path)
+        if not base_path.is_file():
+            LOG.log(f"Settings file {path} didn't exist before the stream, so there's nothing to merge it with. Leaving it as is")
+            continue
+        delta = compute_settings_delta(get_merge_format(path), base_path.read_bytes(), path.read_bytes())
+        if not is_delta_empty(delta):
+            deltas[name] = delta
+
+    store = get_settings_store()
+    key_count = sum(len(delta['set']) + len(delta['deleted']) for delta in deltas.values())
+    LOG.log(f"Saving {key_count} settings changed during the stream to the settings store at {store.root_path}")
+    data = json.dumps({'version': MERGED_SETTINGS_VERSION, 'files': deltas}, ensure_ascii=False, indent=4, sort_keys=True).encode('utf-8')
+    if store.save_data(game_id, client_id, get_store_name(settings_files), data, stats):
+        LOG.log("Saved settings for game")
+    else:
+        LOG.log("Saved settings are already identical to the changed settings. Skipped saving")
+    return deltas
+
+def save_settings(game_id: str, client_id: str, settings_files: SettingsFiles, stats: Optional[SettingsSyncStats] = None):
+    if settings_files.merge:
+        save_merged_settings(game_id, client_id, settings_files, stats)
+    else:
+        save_whole_settings(game_id, client_id, settings_files, stats)
+
+def write_merged_settings(settings_path: Path, delta: dict, base_data: Optional[bytes], stats: Optional[SettingsSyncStats]):
+    """Apply a delta to a settings file. If base_data is given, the delta is undone instead (it must have been made
+    against base_data)."""
+    settings_format = get_merge_format(settings_path)
+    if base_data is not None:
+        delta = invert_settings_delta(settings_format, base_data, delta)
+    data = apply_settings_delta(settings_format, settings_path.read_bytes(), delta)
+    changed = write_file_atomically(settings_path, data)
+    if stats:
+        if changed:
+            stats.copied += 1
+            stats.bytes_written += len(data)
+        else:
+            stats.skipped += 1
+
+def load_merged_settings(game_id: str, client_id: str, settings_files: SettingsFiles, stats: Optional[SettingsSyncStats] = None):
+    store = get_settings_store()
+    LOG.log(f"Loading game's changed settings from the settings store at {store.root_path}")
+    data = store.load_data(game_id, client_id, get_store_name(settings_files))
+    if data is None:
+        LOG.log("No saved settings found. Nothing to do")
+        return
+    for name, delta in json.loads(data)['files'].items():
+        settings_path = settings_files.resolve(name)
+        if not settings_path.is_file():
+            LOG.log(f"Settings file {settings_path} doesn't exist. Skipped merging {len(delta['set']) + len(delta['deleted'])} saved settings into it")
+            continue
+        write_merged_settings(settings_path, delta, None, stats)
+    LOG.log("Merged saved settings into game's settings")
+
+def revert_merged_settings(settings_files: SettingsFiles, deltas: Dict[str, dict], stats: Optional[SettingsSyncStats] = None):
+    """Undo the settings changed during the stream, leaving the rest of the game's settings files alone."""
+    backup_path = get_backup_path(settings_files.path)
+    LOG.log(f"Reverting settings changed during the stream, using the backup at {backup_path}")
+    for name, delta in deltas.items():
+        settings_path = settings_files.resolve(name)
+        if settings_path.is_file():
+            write_merged_settings(settings_path, delta, settings_files.resolve(name, backup_path).read_bytes(), stats)
+    LOG.log("Reverted game's settings")
 
-def get_client_id_from_env() -> str:
-    width = os.environ["SUNSHINE_CLIENT_WIDTH"]
-    height = os.environ["SUNSHINE_CLIENT_HEIGHT"]
-    fps = os.environ["SUNSHINE_CLIENT_FPS"]
+def load_settings(game_id: str, client_id: str, settings_files: SettingsFiles, stats: Optional[SettingsSyncStats] = None):
+    if settings_files.merge:
+        load_merged_settings(game_id, client_id, settings_files, stats)
+        return
+    store = get_settings_store()
+    LOG.log(f"Loading game's settings from the settings store at {store.root_path}")
+    migrate_legacy_settings(store, game_id, client_id, settings_files)
+    changed = store.load(game_id, client_id, settings_files, stats)
+    if changed is None:
+        LOG.log("No saved settings found. Nothing to do")
+    elif changed:
+        LOG.log("Loaded settings to game")
+    else:
+        LOG.log("Game's settings are already identical to the saved settings. Skipped copying")
+
+def recover_interrupted_sync(settings_files: SettingsFiles, stats: Optional[SettingsSyncStats] = None):
+    """If the last stream for these settings never got to save (e.g. the host crashed), finish it off now. That way
+    the game's original settings are restored, rather than backed up over."""
+    journal = SettingsJournal(SETTINGS_JOURNAL_DIR, settings_files.path)
+    entry = journal.read()
+    if entry is None:
+        return
+    LOG.log(f"Previous stream for game id={entry['game_id']} and client id={entry['client_id']} didn't finish syncing settings (state={entry['state']}). Recovering")
+    if entry['state'] == SettingsJournal.LOADED and get_backup_path(settings_files.path).exists():
+        save_settings(entry['game_id'], entry['client_id'], settings_files, stats)
+    restore_backup_settings(settings_files, stats)
+    delete_backup_settings(settings_files)
+    journal.clear()
+    LOG.log("Recovered from interrupted stream")
+
+def start_sync(game_id: str, client_id: str, settings_files: SettingsFiles):
+    """Back up the game's settings, then load the saved settings for the client."""
+    stats = SettingsSyncStats()
+    journal = SettingsJournal(SETTINGS_JOURNAL_DIR, settings_files.path)
+    recover_interrupted_sync(settings_files, stats)
+    backup_settings(settings_files, stats)
+    journal.write(SettingsJournal.BACKED_UP, game_id, client_id)
+    load_settings(game_id, client_id, settings_files, stats)
+    journal.write(SettingsJournal.LOADED, game_id, client_id)
+    LOG.log(f"Settings load finished: {stats}")
+
+def finish_sync(game_id: str, client_id: str, settings_files: SettingsFiles):
+    """Save the game's settings for the client, then restore the backed up settings."""
+    stats = SettingsSyncStats()
+    journal = SettingsJournal(SETTINGS_JOURNAL_DIR, settings_files.path)
+    restore = is_backup_in_use(settings_files, journal)
+    if settings_files.merge:
+        if not restore:
+            # Without the backup, there's no way to tell which settings changed during the stream
+            LOG.log("Settings weren't loaded for this stream, so there's no backup to merge with. Nothing to do")
+        else:
+            deltas = save_merged_settings(game_id, client_id, settings_files, stats)
+            journal.write(SettingsJournal.SAVED, game_id, client_id)
+            revert_merged_settings(settings_files, deltas, stats)
+            delete_backup_settings(settings_files)
+            journal.clear()
+    else:
+        save_whole_settings(game_id, client_id, settings_files, stats)
+        if restore:
+            journal.write(SettingsJournal.SAVED, game_id, client_id)
+            restore_backup_settings(settings_files, stats)
+            delete_backup_settings(settings_files)
+            journal.clear()
+        else:
+            LOG.log("Settings weren't loaded for this stream, so there's no backup to restore")
+    LOG.log(f"Settings save finished: {stats}")
+
+def cancel_sync(settings_files: SettingsFiles):
+    """Restore the backed up settings, without saving anything for the client."""
+    stats = SettingsSyncStats()
+    journal = SettingsJournal(SETTINGS_JOURNAL_DIR, settings_files.path)
+    if is_backup_in_use(settings_files, journal):
+        restore_backup_settings(settings_files, stats)
+        delete_backup_settings(settings_files)
+    journal.clear()
+    LOG.log(f"Settings sync cancelled: {stats}")
+
+def get_client_id_from_env(env: Mapping[str, str]) -> str:
+    width = env["SUNSHINE_CLIENT_WIDTH"]
+    height = env["SUNSHINE_CLIENT_HEIGHT"]
+    fps = env["SUNSHINE_CLIENT_FPS"]
     return f"{width}x{height}x{fps}"
 
+def get_settings_files(args) -> SettingsFiles:
+    return SettingsFiles(args.settings_path, args.include, args.merge)
+
+def get_client_id(args) -> str:
+    return args.client_id if args.client_id else get_client_id_from_env(args.env)
+
 def load_handler(args):
-    client_id = get_client_id_from_env()
-    LOG.log(f"Running settings sync loader with game id={args.game_id}, client id={client_id}, and settings path={args.settings_path}")
-    backup_settings(args.settings_path)
-    load_settings(args.game_id, client_id, args.settings_path)
+    client_id = get_client_id_from_env(args.env)
+    settings_files = get_settings_files(args)
+    LOG.log(f"Running settings sync loader with game id={args.game_id}, client id={client_id}, and settings={settings_files}")
+    session = join_session(SESSION_PATH, args.game_id)
+    LOG.set_context(session=session.id)
+    with span(LOG.log, session, 'load settings'):
+        start_sync(args.game_id, client_id, settings_files)
 
 def save_handler(args):
-    client_id = get_client_id_from_env()
-    LOG.log(f"Running settings sync saver with game id={args.game_id}, client id={client_id}, and settings path={args.settings_path}")
-    save_settings(args.game_id, client_id, args.settings_path)
-    restore_backup_settings(args.settings_path)
-    delete_backup_settings(args.settings_path)
+    client_id = get_client_id_from_env(args.env)
+    settings_files = get_settings_files(args)
+    LOG.log(f"Running settings sync saver with game id={args.game_id}, client id={client_id}, and settings={settings_files}")
+    session = join_session(SESSION_PATH, args.game_id)
+    LOG.set_context(session=session.id)
+    with span(LOG.log, session, 'save settings'):
+        finish_sync(args.game_id, client_id, settings_files)
+
+def history_handler(args):
+    client_id = get_client_id(args)
+    store = get_settings_store()
+    migrate_legacy_settings(store, args.game_id, client_id, get_settings_files(args))
+    history = store.read_history(args.game_id, client_id, get_store_name(get_settings_files(args)))
+    if not history:
+        print(f"No saved settings for game id={args.game_id} and client id={client_id}")
+        return
+    # Newest first, numbered by how many steps back a rollback would go
+    for steps, version in enumerate(reversed(history)):
+        saved = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(version['saved']))
+        size = sum(entry['size'] for entry in version['files'].values())
+        print(f"{steps}: saved {saved}, {len(version['files'])} files, {size} bytes")
+
+def rollback_handler(args):
+    client_id = get_client_id(args)
+    LOG.log(f"Rolling back saved settings for game id={args.game_id}, client id={client_id}, and settings path={args.settings_path} by {args.steps} versions")
+    store = get_settings_store()
+    migrate_legacy_settings(store, args.game_id, client_id, get_settings_files(args))
+    version = store.rollback(args.game_id, client_id, get_store_name(get_settings_files(args)), args.steps)
+    LOG.log(f"Saved settings are now the version saved at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(version['saved']))}")
 
-def main():
+def gc_handler(args):
+    LOG.log("Collecting garbage in the settings store")
+    max_bytes = int(args.max_size * 1024 * 1024) if args.max_size is not None else None
+    get_settings_store().collect_garbage(max_bytes, LOG.log)
+
+def main(argv: Optional[List[str]] = None, env: Optional[Mapping[str, str]] = None):
     parser = argparse.ArgumentParser(
         prog='Sunshine Game Settings Syncer',
         description='This is a tool used to synchronize game settings based on client resolution. Any changes made during a stream are restored the next time you stream.'
     )
-    parser.add_argument('-g', '--game_id', type=str, required=True, help='The game id to sync settings for.')
-    parser.add_argument('-s', '--settings_path', type=Path, required=True, help='The path to the game\'s settings file.')
+    parser.add_argument('-g', '--game_id', type=str, required=False, help='The game id to sync settings for. Required for everything except gc.')
+    parser.add_argument('-s', '--settings_path', type=Path, required=False, help='The path to the game\'s settings file, or to the directory its settings files are in. Required for everything except gc.')
+    parser.add_argument('-i', '--include', type=str, action='append', required=False, help='A glob pattern (e.g. "*.ini" or "**/*.json") for the settings files to sync, relative to the settings directory. Can be given multiple times. Defaults to every file in the directory.')
+    parser.add_argument('-m', '--merge', action='store_true', help='Only sync the individual settings that change during streams, rather than whole settings files. Only works for INI, JSON and XML settings files.')
     subparsers = parser.add_subparsers(required=True, help='What action to take.')
 
     load_parser = subparsers.add_parser('load', help='Load the saved settings file for the client.')
-    load_parser.set_defaults(handler=load_handler)
+    load_parser.set_defaults(handler=load_handler, needs_game=True)
 
     save_parser = subparsers.add_parser('save', help='Save the current settings file for the client.')
-    save_parser.set_defaults(handler=save_handler)
+    save_parser.set_defaults(handler=save_handler, needs_game=True)
+
+    history_parser = subparsers.add_parser('history', help='List the saved versions of the settings file for the client, newest first.')
+    history_parser.add_argument('-c', '--client_id', type=str, required=False, help='The client id, e.g. 1920x1080x60. Defaults to the client of the current stream.')
+    history_parser.set_defaults(handler=history_handler, needs_game=True)
+
+    rollback_parser = subparsers.add_parser('rollback', help='Make an older saved version of the settings file the one loaded next for the client.')
+    rollback_parser.add_argument('-c', '--client_id', type=str, required=False, help='The client id, e.g. 1920x1080x60. Defaults to the client of the current stream.')
+    rollback_parser.add_argument('-n', '--steps', type=int, default=1, help='How many versions to go back, as numbered by history. Defaults to 1.')
+    rollback_parser.set_defaults(handler=rollback_handler, needs_game=True)
+
+    gc_parser = subparsers.add_parser('gc', help='Delete saved settings that are no longer used by any game or client.')
+    gc_parser.add_argument('-m', '--max_size', type=float, required=False, help='If given, also drop the oldest saved versions until the store fits in this many MB. The newest version for each game and client is always kept.')
+    gc_parser.set_defaults(handler=gc_handler, needs_game=False)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.needs_game and (not args.game_id or not args.settings_path):
+        parser.error('game_id and settings_path must be provided')
+    # The agent runs sessions for several clients at once, so it passes each one's environment explicitly
+    args.env = os.environ if env is None else env
     args.handler(args)
 
 if __name__ == '__main__':
@@ -2,26 +2,21 @@ import argparse
 import subprocess
 import sys
 import time
-import win32api, win32com.client, win32con, win32process
-import winreg
+import win32process
+from typing import List, Optional
 from util.log import *
+from util.process import *
+from util.session import *
 from util.steam import *
+from util.wait import *
+from util.window import *
 
 SCRIPT_DIR = Path(__file__).parent
-LOG = Logger(SCRIPT_DIR / 'logs' / 'teardown-log.txt')
+LOG = Logger(SCRIPT_DIR / 'logs' / 'teardown-log.jsonl')
+SESSION_PATH = SCRIPT_DIR / '.session'
+PROCESS_TABLE = ProcessTable()
 
-def terminate_recursive(pid: int):
-    wmi = win32com.client.GetObject('winmgmts:')
-    children = wmi.ExecQuery(f"Select * from win32_process where ParentProcessId={pid}")
-    for child in children:
-        terminate_recursive(child.Properties_('ProcessID').Value)
-    handle = win32api.OpenProcess(win32con.PROCESS_QUERY_INFORMATION | win32con.PROCESS_VM_READ | win32con.PROCESS_TERMINATE, False, pid)
-    name = win32process.GetModuleFileNameEx(handle, 0)
-    win32api.TerminateProcess(handle, 0)
-    win32api.CloseHandle(handle)
-    LOG.log(f"Killed process with exe={name} and id={pid}")
-
-def normal_handler():
+def normal_handler(session: Session):
     LOG.log('Teardown script running in normal mode')
 
     # Wait a second after main launcher has finished. This is done for two reasons:
@@ -30,60 +25,59 @@ def normal_handler():
     time.sleep(1)
 
     # Kill the game process (should ideally be terminated already)
-    with winreg.OpenKeyEx(winreg.HKEY_CURRENT_USER, r'SOFTWARE\Valve\Steam\ActiveProcess', 0, winreg.KEY_READ) as key:
-        steam_pid = read_reg_value(key, 'pid')
-
+    with span(LOG.log, session, 'teardown killed'):
+        steam_pid = get_steam_pid()
         if steam_pid:
-            # Kill any child processes of steam. This is the only way to close the game, considering we don't know its process name
-            wmi = win32com.client.GetObject('winmgmts:')
-            children = wmi.ExecQuery(f"Select * from win32_process where ParentProcessId={steam_pid}")
-            for child in children:
-                if child.Name != 'steamwebhelper.exe' and child.Name != 'GameOverlayUI.exe':
-                    LOG.log(f"Attempting to kill process with pid={child.Properties_('ProcessID').Value} and all of its children")
-                    terminate_recursive(child.Properties_('ProcessID').Value)
+            # Kill any child processes of steam. This is the only way to close the game, considering we don't know its process name.
+            # The whole tree is worked out from one snapshot, and killed leaves first so nothing gets respawned by its parent
+            snapshot = PROCESS_TABLE.snapshot()
+            game_pids = [child.pid for child in snapshot.get_children(steam_pid) if not child.name in STEAM_HELPER_PROCESS_NAMES]
+            killed = terminate_process_trees(snapshot, game_pids, get_default_process_terminator(), LOG.log)
+            LOG.log(f"Killed {len(killed)} processes")
 
     # Close big picture mode (should ideally be closed already)
     LOG.log("Closing Steam big picture mode")
-    close_big_picture()
+    with span(LOG.log, session, 'big picture closed'):
+        close_big_picture()
     LOG.log("Closed Steam big picture mode")
 
-    def is_steam_window_visible():
-        handle = get_steam_window()
-        return handle != 0 and win32gui.IsWindowVisible(handle)
+    with span(LOG.log, session, 'window closed'):
+        close_steam_window_when_open()
+    LOG.log("Teardown finished")
 
+def close_steam_window_when_open(windows: Optional[WindowSystem] = None):
+    """Wait for the regular Steam window to open after big picture mode closes, then close it."""
+    windows = windows or get_window_system()
     # Wait for Steam regular window to open. At most wait for 10 seconds
     LOG.log("Waiting for regular Steam window to open")
-    start_time = time.perf_counter()
-    while not is_steam_window_visible() and time.perf_counter() - start_time < 10:
-        time.sleep(0.25)
+    wait_until(lambda: is_steam_window_visible(windows), 'regular Steam window to open', timeout=10, raise_on_timeout=False, events=windows.watcher, log=LOG.log)
 
     # Close Steam regular window. Unfortunately haven't found a better way to do this. Steam seems to try opening the window multiple times
     LOG.log("Attempting to close regular Steam window")
-    is_closed_count = 0
-    # Require the window to report as closed 8 times in a row before we quit. But just give up after 10 seconds
-    start_time = time.perf_counter()
-    while is_closed_count < 8 and time.perf_counter() - start_time < 10:
-        if not is_steam_window_visible():
-            is_closed_count += 1
-        else:
-            is_closed_count = 0
+    def close_and_check_steam_window():
+        if not is_steam_window_visible(windows):
+            return True
         LOG.log("Sending close signal to Steam window")
-        close_steam_window()
-        time.sleep(0.5)
+        close_steam_window(windows)
+        return False
+    # Require the window to stay closed for 4 seconds before we quit. But just give up after 10 seconds
+    wait_until(close_and_check_steam_window, 'regular Steam window to close', timeout=10, stable_for=4,
+               raise_on_timeout=False, events=windows.watcher, log=LOG.log)
     LOG.log("Closed regular Steam window")
-    LOG.log("Teardown finished")
 
-def detached_handler():
+def detached_handler(session: Session):
     LOG.log('Teardown script running in detached mode')
-    # Spawn background process to close regular Steam window. This will avoid us blocking stream shutdown
-    subprocess.Popen([sys.executable, __file__, 'normal'], creationflags=win32process.DETACHED_PROCESS)
+    # Spawn background process to close regular Steam window. This will avoid us blocking stream shutdown. It's passed
+    # the session, in case the next stream starts a new one before it's done
+    subprocess.Popen([sys.executable, __file__, '-S', session.id, 'normal'], creationflags=win32process.DETACHED_PROCESS)
     LOG.log('Spawned background process to do actual teardown')
 
-def main():
+def main(argv: Optional[List[str]] = None):
     parser = argparse.ArgumentParser(
         prog='Sunshine Steam Adapater Teardown Script',
         description='This script is used to terminate any running Steam games, close big picture mode, and the regular Steam window.'
     )
+    parser.add_argument('-S', '--session', type=str, required=False, help='The id of the stream session to log timings for. Defaults to the current session.')
     subparsers = parser.add_subparsers(required=True, help='What action to take.')
 
     normal_parser = subparsers.add_parser('normal', help='Normal cleanup mode. Will terminate any Steam games, close big picture mode, and close the normal Steam window.')
@@ -92,8 +86,10 @@ def main():
     detached_parser = subparsers.add_parser('detached', help='Detached cleanup mode. Will spawn detached process to do cleanup. This is so the stream isn\'t blocked on waiting for shutdown.')
     detached_parser.set_defaults(handler=detached_handler)
 
-    args = parser.parse_args()
-    args.handler()
+    args = parser.parse_args(argv)
+    session = join_session(SESSION_PATH, session_id=args.session)
+    LOG.set_context(session=session.id)
+    args.handler(session)
 
 if __name__ == '__main__':
     LOG.with_error_catching(main, 'teardown script')
\ No newline at end of file
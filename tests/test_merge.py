@@ -0,0 +1,33 @@
+import json
+import unittest
+from util.merge import *
+
+class JsonFormatTest(unittest.TestCase):
+    def round_trip(self, base: dict, changed: dict):
+        """Apply the delta from base to changed onto base, then revert it. Returns the reverted settings."""
+        settings_format = JsonFormat()
+        base_data = json.dumps(base, indent=2).encode()
+        delta = compute_settings_delta(settings_format, base_data, json.dumps(changed, indent=2).encode())
+        applied = apply_settings_delta(settings_format, base_data, delta)
+        self.assertEqual(json.loads(applied), changed)
+        reverted = apply_settings_delta(settings_format, applied, invert_settings_delta(settings_format, base_data, delta))
+        return json.loads(reverted)
+
+    def test_revert_removes_added_objects(self):
+        base = {'a': 1}
+        self.assertEqual(self.round_trip(base, {'a': 1, 'e': {'f': {'g': 2}}}), base)
+
+    def test_revert_keeps_objects_with_other_keys(self):
+        base = {'e': {'x': 1}}
+        self.assertEqual(self.round_trip(base, {'e': {'x': 1, 'f': {'g': 2}}}), base)
+
+    def test_revert_keeps_objects_that_were_empty(self):
+        base = {'e': {}, 'a': 1}
+        self.assertEqual(self.round_trip(base, {'e': {'f': 2}, 'a': 1}), base)
+
+    def test_revert_restores_deleted_values(self):
+        base = {'e': {'f': 1, 'g': [1, 2]}}
+        self.assertEqual(self.round_trip(base, {'e': {'f': 3}}), base)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,240 @@
+import sys
+import threading
+import types
+import unittest
+from unittest import mock
+from util.process import *
+
+class ProcessTableTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = FakeProcessBackend()
+        self.backend.start(4, 'System')
+        self.backend.start(100, 'steam.exe')
+        self.backend.start(101, 'steamwebhelper.exe', parent_pid=100)
+        self.backend.start(102, 'Game.exe', parent_pid=100)
+
+    def test_is_running_ignores_case(self):
+        table = ProcessTable(self.backend)
+        self.assertTrue(table.is_running('game.exe'))
+        self.assertTrue(table.is_running('GAME.EXE'))
+        self.assertFalse(table.is_running('other.exe'))
+        self.assertEqual(table.get_pids('STEAM.exe'), [100])
+
+    def test_get_children(self):
+        snapshot = self.backend.snapshot()
+        self.assertEqual(sorted(child.pid for child in snapshot.get_children(100)), [101, 102])
+        self.assertEqual(snapshot.get_children(102), [])
+
+    def test_process_is_not_its_own_child(self):
+        self.backend.start(0, 'Idle', parent_pid=0, create_time=0)
+        self.assertEqual(sorted(child.pid for child in self.backend.snapshot().get_children(0)), [4, 100])
+
+    def test_snapshot_is_reused_within_max_age(self):
+        table = ProcessTable(self.backend, max_age=60)
+        self.assertTrue(table.is_running('game.exe'))
+        self.backend.exit(102)
+        self.assertTrue(table.is_running('game.exe'))
+        self.assertEqual(self.backend.snapshot_count, 1)
+
+        table.invalidate()
+        self.assertFalse(table.is_running('game.exe'))
+        self.assertEqual(self.backend.snapshot_count, 2)
+
+    def test_fresh_snapshot_without_max_age(self):
+        table = ProcessTable(self.backend)
+        self.assertTrue(table.is_running('game.exe'))
+        self.backend.exit(102)
+        self.assertFalse(table.is_running('game.exe'))
+
+class TerminateProcessTreesTest(unittest.TestCase):
+    def setUp(self):
+        # launcher (100) -> game (101) -> crash handler (102), game (101) -> helper (103)
+        self.backend = FakeProcessBackend()
+        self.backend.start(100, 'launcher.exe', create_time=10)
+        self.backend.start(101, 'game.exe', parent_pid=100, create_time=11)
+        self.backend.start(102, 'crashhandler.exe', parent_pid=101, create_time=12)
+        self.backend.start(103, 'helper.exe', parent_pid=101, create_time=13)
+        self.backend.start(200, 'unrelated.exe', create_time=14)
+        self.log = []
+
+    def assertLeavesFirst(self, processes):
+        position = {process.pid: i for i, process in enumerate(processes)}
+        for process in processes:
+            if process.parent_pid in position:
+                self.assertLess(position[process.pid], position[process.parent_pid])
+
+    def test_kill_order_is_leaves_first(self):
+        kill_order = self.backend.snapshot().get_kill_order([100])
+        self.assertEqual(sorted(process.pid for process in kill_order), [100, 101, 102, 103])
+        self.assertLeavesFirst(kill_order)
+        self.assertEqual(kill_order[-1].pid, 100)
+
+    def test_skips_children_created_before_parent(self):
+        # The original 100 exited and its pid was reused. The orphaned game still lists 100 as its parent, but was
+        # created before the new process, so it isn't part of its tree
+        self.backend.exit(100)
+        self.backend.start(100, 'launcher.exe', create_time=20)
+        self.backend.start(104, 'overlay.exe', parent_pid=100, create_time=21)
+        snapshot = self.backend.snapshot()
+        self.assertEqual([child.pid for child in snapshot.get_children(100)], [104])
+        self.assertEqual(sorted(process.pid for process in snapshot.get_kill_order([100])), [100, 104])
+
+    def test_reads_missing_create_times_lazily(self):
+        processes = [ProcessInfo(100, 0, 'launcher.exe'), ProcessInfo(101, 100, 'game.exe'),
+                     ProcessInfo(102, 100, 'stale.exe')]
+        create_times = {100: 10, 101: 11, 102: 5}
+        read = []
+        def read_create_time(pid):
+            read.append(pid)
+            return create_times[pid]
+        snapshot = ProcessSnapshot(processes, read_create_time)
+        self.assertEqual([child.pid for child in snapshot.get_children(100)], [101])
+        self.assertEqual([child.pid for child in snapshot.get_children(101)], [])
+        # Processes without children never need their creation time, and each one is only read once
+        self.assertEqual(sorted(read), [100, 101, 102])
+
+    def test_terminates_whole_tree(self):
+        killed = terminate_process_trees(self.backend.snapshot(), [100], self.backend, self.log.append)
+        self.assertEqual(killed, self.backend.terminated)
+        self.assertEqual(sorted(process.pid for process in killed), [100, 101, 102, 103])
+        self.assertLeavesFirst(killed)
+        self.assertEqual(list(self.backend.processes), [200])
+
+    def test_skips_reused_pids(self):
+        snapshot = self.backend.snapshot()
+        # After the snapshot, the helper exits and its pid is reused by an unrelated program
+        self.backend.exit(103)
+        self.backend.start(103, 'notepad.exe', create_time=30)
+        killed = terminate_process_trees(snapshot, [100], self.backend, self.log.append)
+        self.assertEqual(sorted(process.pid for process in killed), [100, 101, 102])
+        self.assertEqual(self.backend.processes[103].name, 'notepad.exe')
+        self.assertIn('helper.exe (pid=103)', self.log[-1])
+
+    def test_keeps_going_after_failure(self):
+        class FailingTerminator(ProcessTerminator):
+            def terminate(inner, process):
+                if process.pid == 102:
+                    raise OSError('Access is denied')
+                return self.backend.terminate(process)
+        killed = terminate_process_trees(self.backend.snapshot(), [100], FailingTerminator(), self.log.append)
+        self.assertEqual(sorted(process.pid for process in killed), [100, 101, 103])
+        self.assertTrue(any('crashhandler.exe (pid=102)' in line and 'Access is denied' in line for line in self.log))
+
+    def test_nothing_to_kill(self):
+        self.assertEqual(terminate_process_trees(self.backend.snapshot(), [999], self.backend, self.log.append), [])
+        self.assertEqual(self.log, [])
+
+class RecordingProcessWaiter(ProcessWaiter):
+    """Records the pids of every wait, then waits on the fake backend."""
+
+    def __init__(self, backend: FakeProcessBackend):
+        self.backend = backend
+        self.waits = []
+
+    def wait_for_exit(self, pids, timeout):
+        self.waits.append(sorted(pids))
+        return self.backend.wait_for_exit(pids, timeout)
+
+class WaitWhileRunningTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = FakeProcessBackend()
+        self.backend.start(100, 'game.exe')
+        self.table = ProcessTable(self.backend)
+        self.waiter = RecordingProcessWaiter(self.backend)
+
+    def wait(self, recheck_interval):
+        wait_while_running(lambda: self.table.is_running('game.exe'), lambda: self.table.get_pids('game.exe'),
+                           self.waiter, recheck_interval)
+
+    def test_waits_for_game_restarted_under_new_pid(self):
+        def restart():
+            self.backend.start(101, 'game.exe')
+            self.backend.exit(100)
+            threading.Timer(0.05, lambda: self.backend.exit(101)).start()
+        threading.Timer(0.05, restart).start()
+        self.wait(recheck_interval=5)
+        self.assertEqual(self.waiter.waits, [[100], [101]])
+
+    def test_recheck_picks_up_new_processes(self):
+        # The new process starts while the first one is still running, so only the recheck can notice it
+        threading.Timer(0.05, lambda: self.backend.start(101, 'game.exe')).start()
+        threading.Timer(0.5, lambda: self.backend.exit(100)).start()
+        threading.Timer(0.6, lambda: self.backend.exit(101)).start()
+        self.wait(recheck_interval=0.2)
+        self.assertEqual(self.waiter.waits[0], [100])
+        self.assertIn([100, 101], self.waiter.waits)
+        self.assertFalse(self.backend.processes)
+
+class FakeHandle:
+    def __init__(self, pid):
+        self.pid = pid
+        self.closed = False
+
+    def Close(self):
+        self.closed = True
+
+class Win32ProcessWaiterTest(unittest.TestCase):
+    """Runs Win32ProcessWaiter against stand-ins for the pywin32 modules."""
+
+    WAIT_OBJECT_0 = 0
+    WAIT_TIMEOUT = 258
+
+    def setUp(self):
+        self.handles = []
+        self.batches = []
+        self.denied_pids = set()
+        self.timeout_on_batch = None
+
+        class error(Exception):
+            pass
+
+        def open_process(access, inherit, pid):
+            if pid in self.denied_pids:
+                raise error(5, 'OpenProcess', 'Access is denied.')
+            handle = FakeHandle(pid)
+            self.handles.append(handle)
+            return handle
+
+        def wait_for_multiple_objects(handles, wait_all, timeout_ms):
+            self.assertTrue(wait_all)
+            self.batches.append([handle.pid for handle in handles])
+            if len(self.batches) == self.timeout_on_batch:
+                return self.WAIT_TIMEOUT
+            return self.WAIT_OBJECT_0
+
+        modules = {
+            'pywintypes': types.SimpleNamespace(error=error),
+            'win32api': types.SimpleNamespace(OpenProcess=open_process),
+            'win32con': types.SimpleNamespace(SYNCHRONIZE=0x00100000),
+            'win32event': types.SimpleNamespace(WaitForMultipleObjects=wait_for_multiple_objects,
+                                                WAIT_OBJECT_0=self.WAIT_OBJECT_0, WAIT_TIMEOUT=self.WAIT_TIMEOUT),
+        }
+        patcher = mock.patch.dict(sys.modules, modules)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_waits_in_batches_of_64(self):
+        pids = list(range(1000, 1150))
+        self.assertTrue(Win32ProcessWaiter().wait_for_exit(pids, 5))
+        self.assertEqual([len(batch) for batch in self.batches], [64, 64, 22])
+        self.assertEqual([pid for batch in self.batches for pid in batch], pids)
+        self.assertTrue(all(handle.closed for handle in self.handles))
+
+    def test_stops_at_first_batch_that_times_out(self):
+        self.timeout_on_batch = 2
+        self.assertFalse(Win32ProcessWaiter().wait_for_exit(list(range(1000, 1150)), 5))
+        self.assertEqual(len(self.batches), 2)
+        self.assertTrue(all(handle.closed for handle in self.handles))
+
+    def test_skips_processes_it_cannot_open(self):
+        self.denied_pids = {1001}
+        self.assertTrue(Win32ProcessWaiter().wait_for_exit([1000, 1001, 1002], 5))
+        self.assertEqual(self.batches, [[1000, 1002]])
+
+    def test_no_handles_returns_false(self):
+        self.denied_pids = {1000}
+        self.assertFalse(Win32ProcessWaiter().wait_for_exit([1000], 0))
+        self.assertEqual(self.batches, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import threading
+import time
+import unittest
+from util.registry import *
+from util.wait import *
+
+class RaceyRegistryValueWatcher(FakeRegistryValueWatcher):
+    """Changes the value right after it's first read, before the watcher starts waiting."""
+
+    def read(self):
+        value = super().read()
+        if self.read_count == 1:
+            self.registry.set_value(self.value_name, 'changed')
+        return value
+
+class RegistryValueWatcherTest(unittest.TestCase):
+    def test_returns_immediately_if_already_true(self):
+        registry = FakeRegistry({'RunningAppId': 42})
+        watcher = registry.watch('RunningAppId')
+        self.assertTrue(watcher.wait_for(lambda value: value == 42, timeout=0))
+        self.assertEqual(watcher.read_count, 1)
+
+    def test_wakes_up_when_value_changes(self):
+        registry = FakeRegistry({'RunningAppId': 0})
+        watcher = registry.watch('RunningAppId')
+        threading.Timer(0.05, lambda: registry.set_value('RunningAppId', 42)).start()
+        start_time = time.perf_counter()
+        self.assertTrue(watcher.wait_for(lambda value: value == 42, timeout=5))
+        self.assertLess(time.perf_counter() - start_time, 1)
+        # Only read when the key changed, rather than polled
+        self.assertEqual(watcher.read_count, 2)
+
+    def test_times_out(self):
+        registry = FakeRegistry({'RunningAppId': 0})
+        watcher = registry.watch('RunningAppId')
+        start_time = time.perf_counter()
+        self.assertFalse(watcher.wait_for(lambda value: value == 42, timeout=0.1))
+        self.assertGreaterEqual(time.perf_counter() - start_time, 0.1)
+
+    def test_change_between_read_and_wait_is_not_missed(self):
+        registry = FakeRegistry({'RunningAppId': 0})
+        watcher = RaceyRegistryValueWatcher(registry, 'RunningAppId')
+        start_time = time.perf_counter()
+        self.assertTrue(watcher.wait_for(lambda value: value == 'changed', timeout=5))
+        # Without arming before reading, this would only notice the change once the timeout passed
+        self.assertLess(time.perf_counter() - start_time, 1)
+
+    def test_polling_watcher(self):
+        values = iter([0, 0, 42])
+        watcher = PollingRegistryValueWatcher(lambda: next(values))
+        self.assertTrue(watcher.wait_for(lambda value: value == 42, timeout=5))
+
+class WaitUntilRegistryTest(unittest.TestCase):
+    def test_waits_for_changes_without_rechecking(self):
+        registry = FakeRegistry({'RunningAppId': 0})
+        watcher = registry.watch('RunningAppId')
+        threading.Timer(1.2, lambda: registry.set_value('RunningAppId', 42)).start()
+        result = wait_until(lambda: watcher.read() == 42, 'game to start', timeout=5, events=watcher)
+        self.assertTrue(result.success)
+        # Read once up front, then once when the value changed. Nothing woke the wait up in between
+        self.assertEqual(watcher.read_count, 2)
+
+    def test_times_out(self):
+        registry = FakeRegistry({'RunningAppId': 0})
+        watcher = registry.watch('RunningAppId')
+        with self.assertRaises(WaitTimeoutError):
+            wait_until(lambda: watcher.read() == 42, 'game to start', timeout=0.1, events=watcher)
+
+if __name__ == '__main__':
+    unittest.main()
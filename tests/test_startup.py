@@ -0,0 +1,15 @@
+import unittest
+from pathlib import Path
+from benchmark import LAUNCH_SCRIPTS, STARTUP_BUDGET, measure_startup
+
+SCRIPT_DIR = Path(__file__).resolve().parent.parent
+
+class StartupBudgetTest(unittest.TestCase):
+    def test_launch_scripts_start_within_budget(self):
+        for script in LAUNCH_SCRIPTS:
+            with self.subTest(script=script):
+                _, first_action_time = measure_startup(SCRIPT_DIR / script, repeat=3)
+                self.assertLessEqual(first_action_time, STARTUP_BUDGET)
+
+if __name__ == '__main__':
+    unittest.main()
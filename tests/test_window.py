@@ -0,0 +1,91 @@
+import sys
+import threading
+import time
+import types
+import unittest
+from pathlib import Path
+from unittest import mock
+from util.script import *
+from util.window import *
+
+SCRIPT_DIR = Path(__file__).resolve().parent.parent
+BIG_PICTURE_TITLE = 'Steam Big Picture Mode'
+
+def load_script_without_windows(name: str) -> types.ModuleType:
+    """Load one of the scripts, with stand-ins for the Windows-only modules it imports at the top level."""
+    stubs = {name: types.ModuleType(name) for name in ['win32process', 'winreg'] if not name in sys.modules}
+    with mock.patch.dict(sys.modules, stubs):
+        return load_script(SCRIPT_DIR / name)
+
+class ReopeningWindowSystem(FakeWindowSystem):
+    """Like Steam, reopens the window a moment after it's first asked to close."""
+
+    def close_window(self, handle: int):
+        window = self.windows[handle]
+        super().close_window(handle)
+        if len(self.closed) == 1:
+            threading.Timer(0.3, lambda: self.create(window['class'], window['title'])).start()
+
+class WindowTestCase(unittest.TestCase):
+    script_name = None
+
+    def setUp(self):
+        self.script = load_script_without_windows(self.script_name)
+        self.logged = []
+        self.script.LOG = types.SimpleNamespace(log=lambda *args, **fields: self.logged.append(' '.join(map(str, args))))
+        # The title is normally read from Steam's localization file
+        patcher = mock.patch.dict(self.script.get_big_picture_window.__globals__,
+                                  {'get_big_picture_window_title': lambda: BIG_PICTURE_TITLE})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+class PreLauncherTest(WindowTestCase):
+    script_name = 'pre-launcher.py'
+
+    def test_waits_for_big_picture_to_stay_open(self):
+        windows = FakeWindowSystem()
+        start_time = time.perf_counter()
+        # Big picture opens, closes again, then reopens for good
+        handle = windows.create('SDL_app', BIG_PICTURE_TITLE)
+        threading.Timer(0.5, lambda: windows.destroy(handle)).start()
+        threading.Timer(0.8, lambda: windows.create('SDL_app', BIG_PICTURE_TITLE)).start()
+        self.script.wait_for_big_picture(windows)
+        # The 1.5 seconds it has to stay open start over once it reopens
+        self.assertGreaterEqual(time.perf_counter() - start_time, 0.8 + 1.5)
+        self.assertLess(time.perf_counter() - start_time, 5)
+
+    def test_waits_for_hidden_window_to_show(self):
+        windows = FakeWindowSystem()
+        windows.create('SDL_app', 'Steam')
+        handle = windows.create('SDL_app', BIG_PICTURE_TITLE, visible=False)
+        threading.Timer(0.2, lambda: windows.set_visible(handle, True)).start()
+        start_time = time.perf_counter()
+        self.script.wait_for_big_picture(windows)
+        self.assertGreaterEqual(time.perf_counter() - start_time, 0.2 + 1.5)
+
+class TeardownTest(WindowTestCase):
+    script_name = 'teardown.py'
+
+    def test_closes_steam_window_until_it_stays_closed(self):
+        windows = ReopeningWindowSystem()
+        threading.Timer(0.1, lambda: windows.create('SDL_app', 'Steam')).start()
+        start_time = time.perf_counter()
+        self.script.close_steam_window_when_open(windows)
+        elapsed = time.perf_counter() - start_time
+        # Closed once when it opened, and again when Steam reopened it. Then it has to stay closed for 4 seconds
+        self.assertEqual(len(windows.closed), 2)
+        self.assertEqual(windows.find_window('SDL_app', 'Steam'), 0)
+        self.assertGreaterEqual(elapsed, 0.1 + 0.3 + 4)
+        self.assertLess(elapsed, 10)
+        self.assertEqual(self.logged.count('Sending close signal to Steam window'), 2)
+
+    def test_leaves_big_picture_open(self):
+        windows = FakeWindowSystem()
+        big_picture = windows.create('SDL_app', BIG_PICTURE_TITLE)
+        threading.Timer(0.1, lambda: windows.create('SDL_app', 'Steam')).start()
+        self.script.close_steam_window_when_open(windows)
+        self.assertNotIn(big_picture, windows.closed)
+        self.assertTrue(windows.is_visible(big_picture))
+
+if __name__ == '__main__':
+    unittest.main()
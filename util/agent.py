@@ -0,0 +1,159 @@
+import json
+import os
+import secrets
+import sys
+import tempfile
+import threading
+import traceback
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+# Scripts the agent can run on behalf of a client. Clients refer to them by file name, without the .py extension
+AGENT_SCRIPTS = ('prep', 'pre-launcher', 'launcher', 'teardown', 'settings-sync')
+
+# Only these environment variables are forwarded from the client, since they're the only ones the scripts read
+FORWARDED_ENV_PREFIX = 'SUNSHINE_'
+
+# A handler runs a script for a client, given its command line arguments and environment
+AgentHandler = Callable[[List[str], Dict[str, str]], None]
+
+def get_default_agent_address() -> str:
+    if sys.platform == 'win32':
+        return r'\\.\pipe\sunshine-steam-adapter-agent'
+    return str(Path(tempfile.gettempdir()) / 'sunshine-steam-adapter-agent.sock')
+
+class AgentServer:
+    """Long-lived process that runs the adapter's scripts on behalf of thin clients, so each stream doesn't pay for
+    interpreter startup, imports, and rediscovering Steam's paths and window titles.
+
+    Each client connection is handled on its own thread, so a launcher waiting for a game to quit doesn't hold up
+    anything else. Handlers that share a lock never run at the same time. This is how overlapping sessions are kept
+    apart, e.g. a new stream's pre-launcher waits for the previous stream's teardown to finish closing Steam.
+
+    Connections are authenticated with a random key, which is written to the info file (along with the address) while
+    the agent is running. Clients that can't find the info file don't try to connect at all.
+    """
+
+    def __init__(self, handlers: Dict[str, AgentHandler], info_path: Path, locks: Optional[Dict[str, threading.Lock]] = None, address: Optional[str] = None, log: Callable[[str], None] = print):
+        self.handlers = handlers
+        self.info_path = info_path
+        self.locks = locks or {}
+        self.address = address or get_default_agent_address()
+        self.log = log
+        self.listener = None
+        self.authkey = None
+        self.active_count = 0
+        self.active_condition = threading.Condition()
+
+    def start(self):
+        from multiprocessing.connection import Listener
+        self.authkey = secrets.token_bytes(32)
+        if sys.platform != 'win32':
+            # A stale socket file is left behind if the agent was killed
+            Path(self.address).unlink(missing_ok=True)
+        self.listener = Listener(self.address, authkey=self.authkey)
+        self.info_path.parent.mkdir(parents=True, exist_ok=True)
+        self.info_path.write_text(json.dumps({'address': self.address, 'key': self.authkey.hex(), 'pid': os.getpid()}), encoding='utf-8')
+        self.log(f"Agent listening on {self.address}")
+
+    def serve_forever(self):
+        """Accept connections until close() is called."""
+        listener = self.listener
+        while listener:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                if self.listener is None:
+                    break
+                # e.g. a client with the wrong key. Don't let it take the agent down
+                self.log(f"Rejected agent connection: {e}")
+                continue
+            if self.listener is None:
+                conn.close()
+                break
+            threading.Thread(target=self._handle_connection, args=(conn,), daemon=True).start()
+
+    def close(self):
+        self.info_path.unlink(missing_ok=True)
+        listener, self.listener = self.listener, None
+        if listener:
+            # Closing the listener doesn't interrupt a blocked accept(), so wake it up with a connection of our own
+            from multiprocessing.connection import Client
+            try:
+                Client(self.address, authkey=self.authkey).close()
+            except Exception:
+                pass
+            listener.close()
+
+    def wait_until_idle(self, timeout: Optional[float] = None) -> bool:
+        with self.active_condition:
+            return self.active_condition.wait_for(lambda: self.active_count == 0, timeout)
+
+    def run(self, script: str, argv: List[str], env: Dict[str, str]) -> int:
+        """Run a handler in this process, and return its exit code."""
+        handler = self.handlers.get(script)
+        if handler is None:
+            self.log(f"Agent has no handler for {script}")
+            return 2
+        with self.active_condition:
+            self.active_count += 1
+        try:
+            lock = self.locks.get(script)
+            if lock:
+                with lock:
+                    handler(argv, env)
+            else:
+                handler(argv, env)
+            return 0
+        except SystemExit as e:
+            # argparse exits on bad arguments
+            return e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            self.log(f"{script} failed in agent: {traceback.format_exc()}")
+            return 1
+        finally:
+            with self.active_condition:
+                self.active_count -= 1
+                self.active_condition.notify_all()
+
+    def _handle_connection(self, conn):
+        with conn:
+            try:
+                request = conn.recv()
+                script, argv, env = request['script'], list(request['argv']), dict(request['env'])
+            except Exception as e:
+                self.log(f"Received invalid agent request: {e}")
+                return
+            self.log(f"Running {script} with args {argv}")
+            exit_code = self.run(script, argv, env)
+            self.log(f"Finished {script} with args {argv}, exit code {exit_code}")
+            try:
+                conn.send({'exit_code': exit_code})
+            except OSError:
+                # Client went away. Nothing to report to
+                pass
+
+def run_in_agent(script: str, argv: List[str], info_path: Path, env: Optional[Dict[str, str]] = None) -> Optional[int]:
+    """Ask a running agent to run a script, and wait for it to finish. Returns the script's exit code, or None if the
+    agent isn't running, in which case the caller should run the script itself."""
+    try:
+        info = json.loads(info_path.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return None
+
+    from multiprocessing.connection import Client
+    try:
+        conn = Client(info['address'], authkey=bytes.fromhex(info['key']))
+    except Exception:
+        # Agent isn't running (or is a stale one we can't talk to)
+        return None
+
+    if env is None:
+        env = {key: value for key, value in os.environ.items() if key.startswith(FORWARDED_ENV_PREFIX)}
+    with conn:
+        # Once the request is sent, don't fall back. The agent may have already started the game, etc.
+        try:
+            conn.send({'script': script, 'argv': argv, 'env': env})
+            return conn.recv()['exit_code']
+        except (OSError, EOFError):
+            return 1
@@ -1,12 +1,271 @@
+import hashlib
+import json
+import os
+import re
+import time
 from pathlib import Path
-from PIL import Image
+from typing import Iterable, Optional, Tuple
+
+# Size of the cover artwork in Steam's library. Sunshine sends the artwork to clients as-is, so there's no point in
+# keeping anything bigger
+COVER_ART_SIZE = (600, 900)
+
+def convert_to_png(src_img_path: Path, dest_img_dir_path: Path, size: Tuple[int, int] = COVER_ART_SIZE, compress_level: Optional[int] = None) -> Path:
+    """Downsample an image to fit within size, strip its metadata, and save it as a png.
+
+    If compress_level (0-9) isn't given, the png is saved with Pillow's optimize option, which produces the smallest file.
+    """
+    # Imported here rather than at the top, since Pillow is slow to import and the launch scripts never convert artwork
+    from PIL import Image
 
-def convert_to_png(src_img_path: Path, dest_img_dir_path: Path) -> Path:
     # Create destination directory if it doesn't exist
     dest_img_dir_path.mkdir(parents=True, exist_ok=True)
 
-    img = Image.open(src_img_path)
+    with Image.open(src_img_path) as img:
+        # For jpegs, this makes the decoder scale down by a power of two while decoding, which is much cheaper than
+        # decoding at full size and resizing afterwards. It's a no-op for other formats
+        img.draft('RGB', size)
+        mode = 'RGBA' if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info else 'RGB'
+        converted = img.convert(mode)
+    converted.thumbnail(size, Image.Resampling.LANCZOS)
+    # Drop metadata (exif, icc profile, text chunks, etc.)
+    converted.info = {}
+
     new_path = dest_img_dir_path / f"{src_img_path.stem}.png"
-    img.save(new_path)
-    print(f"Converted {src_img_path} to png and saved to {new_path}")
-    return new_path
\ No newline at end of file
+    if compress_level is None:
+        converted.save(new_path, format='PNG', optimize=True)
+    else:
+        converted.save(new_path, format='PNG', compress_level=compress_level)
+    return new_path
+
+def convert_all_to_png(src_img_paths: Iterable[Path], dest_img_dir_path: Path, workers: Optional[int] = None,
+                       size: Tuple[int, int] = COVER_ART_SIZE, compress_level: Optional[int] = None) -> dict[Path, Optional[Path]]:
+    """Convert images with convert_to_png in a process pool, since decoding/encoding is CPU bound.
+
+    Returns a map from each source path to its converted path, or None if the conversion failed. Failures are
+    reported, but don't stop the remaining conversions. workers defaults to the number of CPUs. With a single
+    worker, images are converted in this process.
+    """
+    src_img_paths = list(dict.fromkeys(src_img_paths))
+    results: dict[Path, Optional[Path]] = {}
+    if not src_img_paths:
+        return results
+
+    def report(src_img_path: Path, new_path: Optional[Path], error: Optional[BaseException]):
+        results[src_img_path] = new_path
+        progress = f"[{len(results)}/{len(src_img_paths)}]"
+        if error:
+            print(f"{progress} Failed to convert {src_img_path} to png. Error was: {error}")
+        else:
+            print(f"{progress} Converted {src_img_path} to png and saved to {new_path}")
+
+    if workers == 1 or len(src_img_paths) == 1:
+        for src_img_path in src_img_paths:
+            try:
+                report(src_img_path, convert_to_png(src_img_path, dest_img_dir_path, size, compress_level), None)
+            except Exception as e:
+                report(src_img_path, None, e)
+        return results
+
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(convert_to_png, src_img_path, dest_img_dir_path, size, compress_level): src_img_path for src_img_path in src_img_paths}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                report(futures[future], future.result(), None)
+            except Exception as e:
+                report(futures[future], None, e)
+    return results
+
+def hash_file(file_path: Path) -> str:
+    with file_path.open(mode='rb') as file:
+        return hashlib.file_digest(file, 'sha256').hexdigest()
+
+class ConvertedArtworkCache:
+    """Cache of artwork converted with convert_to_png, backed by a manifest file in the cache directory.
+
+    Each entry is keyed by its source path, and records the source's size, mtime and content hash, along with the
+    conversion settings. Conversions are skipped if the source and settings are unchanged (or only the source's mtime
+    changed) and the converted file still exists. Entries for
+    sources that are no longer used can be garbage collected, and the cache can be capped to a maximum size, in which
+    case the least recently used entries are evicted first.
+    """
+
+    MANIFEST_NAME = 'manifest.json'
+
+    def __init__(self, dir_path: Path, max_bytes: Optional[int] = None, size: Tuple[int, int] = COVER_ART_SIZE, compress_level: Optional[int] = None):
+        self.dir_path = dir_path
+        self.max_bytes = max_bytes
+        self.size = size
+        self.compress_level = compress_level
+        self.entries: Optional[dict[str, dict]] = None
+
+    def convert_all(self, src_img_paths: Iterable[Path], workers: Optional[int] = None) -> dict[Path, Optional[Path]]:
+        """Same as convert_all_to_png, but only converts images that aren't already up to date in the cache."""
+        entries = self._get_entries()
+        now = time.time()
+        settings = [*self.size, self.compress_level]
+        results: dict[Path, Optional[Path]] = {}
+        stale: dict[Path, tuple] = {}
+        for src_img_path in dict.fromkeys(src_img_paths):
+            try:
+                stat = src_img_path.stat()
+            except OSError as e:
+                print(f"Failed to read {src_img_path}. Error was: {e}")
+                results[src_img_path] = None
+                continue
+
+            entry = entries.get(str(src_img_path))
+            content_hash = None
+            if entry and entry.get('settings') == settings and Path(entry['output']).is_file():
+                if entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+                    # Steam sometimes rewrites artwork without changing it, so fall back to comparing content
+                    content_hash = hash_file(src_img_path)
+                    if content_hash == entry['hash']:
+                        entry['size'] = stat.st_size
+                        entry['mtime_ns'] = stat.st_mtime_ns
+                if entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+                    entry['last_used'] = now
+                    results[src_img_path] = Path(entry['output'])
+                    continue
+            stale[src_img_path] = (stat, content_hash)
+
+        if results:
+            print(f"Reusing {len(results)} up to date converted images from {self.dir_path}")
+        for src_img_path, new_path in convert_all_to_png(stale.keys(), self.dir_path, workers, self.size, self.compress_level).items():
+            results[src_img_path] = new_path
+            if new_path is None:
+                continue
+            stat, content_hash = stale[src_img_path]
+            entries[str(src_img_path)] = {
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'hash': content_hash or hash_file(src_img_path),
+                'settings': settings,
+                'output': str(new_path),
+                'bytes': new_path.stat().st_size,
+                'last_used': now
+            }
+
+        if not results:
+            return results
+        src_bytes = sum(entries[str(path)]['size'] for path, new_path in results.items() if new_path)
+        converted_bytes = sum(entries[str(path)]['bytes'] for path, new_path in results.items() if new_path)
+        print(f"Artwork is {converted_bytes} bytes after conversion, down from {src_bytes} bytes ({src_bytes - converted_bytes} bytes saved)")
+        return results
+
+    def collect_garbage(self, known_src_img_paths: Iterable[Path], used_src_img_paths: Iterable[Path]):
+        """Delete converted images whose source isn't one of the known paths (e.g. artwork for games that are no
+        longer in the library), then evict least recently used entries until the cache fits within max_bytes.
+
+        Entries for the used paths are never evicted, since they're referenced by the config being written.
+        """
+        entries = self._get_entries()
+        known = set(str(path) for path in known_src_img_paths)
+        used = set(str(path) for path in used_src_img_paths)
+        for src in [src for src in entries if not src in known and not src in used]:
+            self._delete_entry(src, 'its source artwork is no longer used')
+
+        if self.max_bytes is None:
+            return
+        total_bytes = sum(entry['bytes'] for entry in entries.values())
+        for src in sorted(entries, key=lambda src: entries[src]['last_used']):
+            if total_bytes <= self.max_bytes:
+                break
+            if src in used:
+                continue
+            total_bytes -= entries[src]['bytes']
+            self._delete_entry(src, 'the cache is over its size limit')
+        if total_bytes > self.max_bytes:
+            print(f"Converted artwork cache is {total_bytes} bytes, which is over the limit of {self.max_bytes} bytes, but all of it is in use.")
+
+    def save(self):
+        if self.entries is None:
+            return
+        self.dir_path.mkdir(parents=True, exist_ok=True)
+        with (self.dir_path / ConvertedArtworkCache.MANIFEST_NAME).open(mode='w', encoding='utf8') as file:
+            json.dump(self.entries, file, ensure_ascii=False, indent=4)
+
+    def _delete_entry(self, src: str, reason: str):
+        entry = self.entries.pop(src)
+        Path(entry['output']).unlink(missing_ok=True)
+        print(f"Deleted converted image {entry['output']}, since {reason}")
+
+    def _get_entries(self) -> dict[str, dict]:
+        # Loaded lazily, so creating the cache doesn't touch the disk
+        if self.entries is None:
+            manifest_path = self.dir_path / ConvertedArtworkCache.MANIFEST_NAME
+            self.entries = {}
+            if manifest_path.is_file():
+                try:
+                    with manifest_path.open(mode='r', encoding='utf8') as file:
+                        self.entries = json.load(file)
+                except ValueError:
+                    print(f"Converted artwork manifest at {manifest_path} is invalid. Reconverting all artwork.")
+        return self.entries
+
+class ArtworkDirectory:
+    """Maps app ids to artwork files in a single directory, based on a file name pattern.
+
+    The directory is scanned once with os.scandir, and only rescanned by refresh() when its mtime changes (adding,
+    removing or renaming files updates a directory's mtime).
+    """
+
+    def __init__(self, dir_path: Path, name_pattern: re.Pattern):
+        self.dir_path = dir_path
+        self.name_pattern = name_pattern
+        self.mtime_ns: Optional[int] = None
+        self.paths: dict[str, Path] = {}
+
+    def refresh(self):
+        try:
+            mtime_ns = os.stat(self.dir_path).st_mtime_ns
+        except FileNotFoundError:
+            self.mtime_ns = None
+            self.paths = {}
+            return
+        if mtime_ns == self.mtime_ns:
+            return
+
+        # Pick the most recently modified candidate for each app id. Every source is resized and re-encoded anyway,
+        # so its format doesn't matter
+        candidates: dict[str, tuple[int, str]] = {}
+        with os.scandir(self.dir_path) as entries:
+            for entry in entries:
+                match = self.name_pattern.match(entry.name)
+                if not match or not entry.is_file():
+                    continue
+                app_id = match.group(1)
+                mtime_ns = entry.stat().st_mtime_ns
+                if not app_id in candidates or mtime_ns > candidates[app_id][0]:
+                    candidates[app_id] = (mtime_ns, entry.path)
+        self.paths = {app_id: Path(path) for app_id, (_, path) in candidates.items()}
+        self.mtime_ns = mtime_ns
+
+    def find(self, app_id: str) -> Optional[Path]:
+        return self.paths.get(app_id)
+
+class ArtworkIndex:
+    """Index of the cover artwork Steam has for each app id.
+
+    Custom artwork in the user's grid directory takes precedence over the artwork in Steam's librarycache. Call
+    refresh() before a batch of lookups to pick up any changes to the directories.
+    """
+
+    __GRID_PATTERN = re.compile(r'^(\d+)p\.\w+$', flags=re.IGNORECASE)
+    __LIBRARY_CACHE_PATTERN = re.compile(r'^(\d+)_library_600x900\.\w+$', flags=re.IGNORECASE)
+
+    def __init__(self, grid_dir_path: Path, library_cache_dir_path: Path):
+        self.grid = ArtworkDirectory(grid_dir_path, ArtworkIndex.__GRID_PATTERN)
+        self.library_cache = ArtworkDirectory(library_cache_dir_path, ArtworkIndex.__LIBRARY_CACHE_PATTERN)
+
+    @classmethod
+    def from_steam_config_path(cls, steam_config_path: Path):
+        return cls(steam_config_path / 'grid', steam_config_path.parents[2] / 'appcache' / 'librarycache')
+
+    def refresh(self):
+        self.grid.refresh()
+        self.library_cache.refresh()
+
+    def find(self, app_id: str) -> Optional[Path]:
+        return self.grid.find(app_id) or self.library_cache.find(app_id)
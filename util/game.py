@@ -1,10 +1,12 @@
 import re
 from pathlib import Path
-from typing import Optional, Self
+from typing import List, Optional, Self
 from util.art import *
 
 class Game:
-    def __init__(self, id: str, name: str, alt_id: Optional[str] = None, process_name: Optional[str] = None, settings_path: Optional[Path] = None):
+    __slots__ = ('id', '_name', '_sort_key', 'alt_id', 'process_name', 'settings_path', 'settings_patterns', 'settings_merge')
+
+    def __init__(self, id: str, name: str, alt_id: Optional[str] = None, process_name: Optional[str] = None, settings_path: Optional[Path] = None, settings_patterns: Optional[List[str]] = None, settings_merge: bool = False):
         self.id = id
         self.name = name
         if alt_id:
@@ -14,11 +16,32 @@ class Game:
         self.alt_id = alt_id
         self.process_name = process_name
         self.settings_path = settings_path
+        # Glob patterns for the settings files, when settings_path is a directory. Empty means every file in it
+        self.settings_patterns = list(settings_patterns) if settings_patterns else []
+        # Whether only the individual settings changed during streams are synced, rather than whole files
+        self.settings_merge = settings_merge
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @name.setter
+    def name(self, name: str):
+        # Games are sorted by name case-insensitively. Precompute the key, since it's used for every comparison
+        self._name = name
+        self._sort_key = (name.casefold(), name, self.id)
+
+    def sort_key(self) -> tuple:
+        return self._sort_key
 
     def __str__(self) -> str:
         string = f"{self.name} (ID={self.id}"
         if self.settings_path:
             string += f", Settings={self.settings_path}"
+            if self.settings_patterns:
+                string += f" ({', '.join(self.settings_patterns)})"
+            if self.settings_merge:
+                string += ' merged'
         if self.process_name:
             string += f", Process name = {self.process_name}"
         string += ')'
@@ -27,13 +50,18 @@ class Game:
         return string
 
     def __lt__(self, other: Self) -> bool:
-        return self.name < other.name
+        return self._sort_key < other._sort_key
 
     def __eq__(self, other: object) -> bool:
         if not isinstance(other, Game):
             return NotImplemented
         return self.id == other.id or (self.alt_id != None and self.alt_id == other.alt_id)
 
+    def __hash__(self) -> int:
+        # Only hash the id. A non-steam game's id is derived from its alt id, so games that are equal because of
+        # their alt ids also have the same id.
+        return hash(self.id)
+
     def is_non_steam(self) -> bool:
         return not self.alt_id is None
 
@@ -48,6 +76,10 @@ class Game:
 
     def settings_sync_args(self) -> str:
         args = [f"-g={self.id}", f"-s=\"{self.settings_path}\""]
+        for pattern in self.settings_patterns:
+            args.append(f"-i=\"{pattern}\"")
+        if self.settings_merge:
+            args.append('-m')
         return ' '.join(args)
 
     def to_json_dict(self) -> dict:
@@ -61,34 +93,16 @@ class Game:
             j['process_name'] = self.process_name
         if self.settings_path:
             j['settings_path'] = str(self.settings_path)
+        if self.settings_patterns:
+            j['settings_patterns'] = self.settings_patterns
+        if self.settings_merge:
+            j['settings_merge'] = True
         return j
 
     @classmethod
     def from_json_dict(cls, j) -> Self:
-        return cls(id=j.get('id'), name=j.get('name'), alt_id=j.get('alt_id'), process_name=j.get('process_name'), settings_path=j.get('settings_path'))
-
-    def get_cover_art_path(self, steam_config_path: Path, art_cache_dir_path: Path) -> Path | None:
-        app_id = self.alt_id or self.id
-
-        # First look in grid (custom artwork)
-        matches = list((steam_config_path / 'grid').glob(f"{app_id}p.*"))
-        if len(matches) > 0:
-            assert len(matches) == 1
-            match = matches[0]
-            if match.suffix == '.png':
-                return match
-            else:
-                return convert_to_png(match, art_cache_dir_path)
-
-        # Then look in librarycache
-        matches = list((steam_config_path.parents[2] / 'appcache' / 'librarycache').glob(f"{app_id}_library_600x900.*"))
-        if len(matches) > 0:
-            assert len(matches) == 1
-            match = matches[0]
-            if match.suffix == '.png':
-                return match
-            else:
-                return convert_to_png(match, art_cache_dir_path)
-
-        # Just return None if we can't find anything
-        return None
\ No newline at end of file
+        return cls(id=j.get('id'), name=j.get('name'), alt_id=j.get('alt_id'), process_name=j.get('process_name'), settings_path=j.get('settings_path'), settings_patterns=j.get('settings_patterns'), settings_merge=j.get('settings_merge', False))
+
+    def get_cover_art_source_path(self, artwork_index: ArtworkIndex) -> Path | None:
+        """Find the game's cover art. The returned file should be converted with convert_to_png before Sunshine uses it."""
+        return artwork_index.find(self.alt_id or self.id)
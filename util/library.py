@@ -1,32 +1,140 @@
+import bisect
+import hashlib
 import json
 import sys
-import win32com.client
+from enum import Enum
 from typing import List
-from typing import Optional, Self
+from typing import Optional, Self, Tuple
 from util.art import *
 from util.game import *
 from util.io import *
 from util.steam import *
+from util.sunshine import *
+
+class GameCollection:
+    """Sorted list of games, with hash indexes on id and alt id.
+
+    Lookups are O(1), and adding/removing games is a bisect plus a list insert/delete, rather than a full re-sort.
+    """
+
+    def __init__(self, games: Optional[List[Game]] = None):
+        self.games: List[Game] = [] if games is None else sorted(games)
+        self.by_id: dict[str, Game] = {}
+        self.by_alt_id: dict[str, Game] = {}
+        for game in self.games:
+            self._index(game)
+
+    def __len__(self) -> int:
+        return len(self.games)
+
+    def __iter__(self):
+        return iter(self.games)
+
+    def __contains__(self, game: Game) -> bool:
+        return self.find(game) is not None
+
+    def find(self, game: Game) -> Optional[Game]:
+        """Return the game in this collection that is equal to the given game, if any."""
+        found = self.by_id.get(game.id)
+        if found is None and game.alt_id is not None:
+            found = self.by_alt_id.get(game.alt_id)
+        return found
+
+    def add(self, game: Game):
+        bisect.insort(self.games, game)
+        self._index(game)
+
+    def add_all(self, games: List[Game]):
+        # Cheaper than adding one at a time for large batches. Timsort merges the already-sorted runs in linear time
+        self.games.extend(games)
+        self.games.sort()
+        for game in games:
+            self._index(game)
+
+    def remove(self, game: Game):
+        stored = self.find(game)
+        if stored is None:
+            raise ValueError(f"{game} is not in the collection")
+        index = bisect.bisect_left(self.games, stored)
+        while self.games[index] is not stored:
+            index += 1
+        del self.games[index]
+        del self.by_id[stored.id]
+        if stored.alt_id is not None and self.by_alt_id.get(stored.alt_id) is stored:
+            del self.by_alt_id[stored.alt_id]
+
+    def remove_all(self, games: List[Game]):
+        removed = set(self.find(game) for game in games)
+        removed.discard(None)
+        self.games = [game for game in self.games if not game in removed]
+        for game in removed:
+            del self.by_id[game.id]
+            if game.alt_id is not None and self.by_alt_id.get(game.alt_id) is game:
+                del self.by_alt_id[game.alt_id]
+
+    def rename(self, game: Game, name: str):
+        self.remove(game)
+        game.name = name
+        self.add(game)
+
+    def rename_all(self, renames: List[Tuple[Game, str]]):
+        for game, name in renames:
+            self.find(game).name = name
+        self.games.sort()
+
+    def _index(self, game: Game):
+        self.by_id[game.id] = game
+        if game.alt_id is not None:
+            self.by_alt_id[game.alt_id] = game
+
+class MissingPolicy(Enum):
+    """What to do with library games and exclusions that are no longer found in Steam."""
+    ASK = 'ask'
+    REMOVE = 'remove'
+    KEEP = 'keep'
+
+class SyncPlan:
+    """The changes needed to bring a library in sync with the games found in Steam. Built by Library.plan_sync."""
+
+    def __init__(self):
+        self.adds: List[Game] = []
+        self.renames: List[Tuple[Game, str]] = []
+        self.skipped: List[Game] = []
+        self.removals: List[Game] = []
+        self.purges: List[Game] = []
+
+    def is_empty(self) -> bool:
+        return not (self.adds or self.renames or self.removals or self.purges)
+
+    def print(self):
+        for game, name in self.renames:
+            print(f"Rename {game} to {name}")
+        for game in self.adds:
+            print(f"Add {game}")
+        for game in self.skipped:
+            print(f"Skip {game}, since it was previously removed")
+        for game in self.removals:
+            print(f"Remove {game}, since it couldn't be found in Steam library")
+        for game in self.purges:
+            print(f"Purge exclusion for {game}, since it couldn't be found in Steam library")
+        print(f"Sync plan: {len(self.adds)} to add, {len(self.renames)} to rename, {len(self.removals)} to remove, and {len(self.purges)} exclusions to purge.")
 
 class Library:
     __RANGE_DELIMETER_REGEX = re.compile(r'\s*,\s*')
     __RANGE_REGEX = re.compile(r'^(\d+)\s*\-\s*(\d+)|(\d+)$')
 
     def __init__(self, games: Optional[List[Game]] = None, exclusions: Optional[List[Game]] = None):
-        self.games = [] if games is None else games
-        self.exclusions = [] if exclusions is None else exclusions
-
-        self._sort_games()
-        self._sort_exclusions()
+        self.games = GameCollection(games)
+        self.exclusions = GameCollection(exclusions)
 
     def get_game(self, index: int) -> Game:
-        return self.games[index]
+        return self.games.games[index]
 
     def get_games(self) -> List[Game]:
-        return self.games
+        return self.games.games
 
     def get_exclusions(self) -> List[Game]:
-        return self.exclusions
+        return self.exclusions.games
 
     def get_steam_games(self) -> List[Game]:
         return [game for game in self.games if not game.is_non_steam()]
@@ -38,12 +146,10 @@ class Library:
         return [game for game in non_steam_games if not game in self.games]
 
     def add_game(self, game: Game):
-        self.games.append(game)
-        self._sort_games()
+        self.games.add(game)
 
     def add_exclusion(self, exclusion: Game):
-        self.exclusions.append(exclusion)
-        self._sort_exclusions()
+        self.exclusions.add(exclusion)
 
     def remove_game(self, game: Game, skip_exclusion: bool = False):
         self.games.remove(game)
@@ -57,11 +163,14 @@ class Library:
     def purge_exclusion(self, game: Game):
         self.exclusions.remove(game)
 
+    def rename_game(self, game: Game, name: str):
+        self.games.rename(game, name)
+
     def print(self):
-        Library.print_game_list(self.games)
+        Library.print_game_list(self.get_games())
 
     def print_exclusions(self):
-        Library.print_game_list(self.exclusions)
+        Library.print_game_list(self.get_exclusions())
 
     @staticmethod
     def print_game_list(games: List[Game]):
@@ -112,59 +221,78 @@ class Library:
             return []
         return selected_games
 
-    def sync_library_with_steam(self):
-        update_count = 0
-        remove_count = 0
-        add_count = 0
-        purge_count = 0
-        new_games = get_installed_steam_games() + get_non_steam_games()
+    def sync_library_with_steam(self, shortcut_cache_path: Optional[Path] = None, missing_policy: MissingPolicy = MissingPolicy.ASK, dry_run: bool = False):
+        plan = self.plan_sync(get_installed_steam_games() + get_non_steam_games(shortcut_cache_path))
+        if dry_run:
+            plan.print()
+            return
+        self.apply_sync_plan(plan, missing_policy)
+
+    def plan_sync(self, new_games: List[Game]) -> SyncPlan:
+        """Work out what needs to change to sync the library with the given games. Doesn't modify the library."""
+        plan = SyncPlan()
+        new_games_index = GameCollection(new_games)
+        added_games = set()
 
         # Add/update existing games if names have changed
         for new_game in new_games:
-            found = False
-            for game in self.games:
-                if game == new_game:
-                    if game.name != new_game.name:
-                        print(f"Updating {game} name to match newly read value: {new_game.name}")
-                        game.name = new_game.name
-                        update_count += 1
-                    found = True
-                    break
-
-            if not found:
-                if new_game in self.exclusions:
-                    print(f"Not adding {new_game} to library, since it was previously removed.")
-                else:
-                    self.add_game(new_game)
-                    add_count += 1
-                    print(f"Added {new_game} to library.")
+            game = self.games.find(new_game)
+            if game:
+                if game.name != new_game.name:
+                    plan.renames.append((game, new_game.name))
+            elif new_game in self.exclusions:
+                plan.skipped.append(new_game)
+            elif not new_game in added_games:
+                added_games.add(new_game)
+                plan.adds.append(new_game)
 
         # Remove games from library if they weren't found in Steam
-        for game in self.games:
-            if not game in new_games:
-                if yes_or_no(f"Library contains {game}, but couldn't find it in Steam library. Do you want to remove it?"):
-                    self.remove_game(game, skip_exclusion=True)
-                    remove_count += 1
-                    print(f"Removed game {game} from library.")
-                else:
-                    print(f"Did not remove game {game}.")
+        plan.removals = [game for game in self.games if not game in new_games_index]
 
         # Remove exclusions if they weren't found in Steam. One downside: if user excludes a game, then
         # uninstalls it, then runs the script, it will be removed from the exclusions. If user then
         # reinstalls it and expects it to be excluded still, that won't happen. This seems like a fine
         # tradeoff to prevent stale entries in the exclusion list.
-        for game in self.exclusions:
-            if not game in new_games:
-                if  yes_or_no(f"Library contains exclusion for {game}, but couldn't find it in Steam library. Do you want to remove it?"):
-                    self.purge_exclusion(game)
-                    purge_count += 1
-                    print(f"Purged game {game} from exclusions.")
-                else:
-                    print(f"Did not purge game {game} from exclusions.")
-
-        self._sort_games()
+        plan.purges = [game for game in self.exclusions if not game in new_games_index]
+        return plan
+
+    def apply_sync_plan(self, plan: SyncPlan, missing_policy: MissingPolicy = MissingPolicy.ASK):
+        for game, name in plan.renames:
+            print(f"Updating {game} name to match newly read value: {name}")
+        self.games.rename_all(plan.renames)
+
+        for game in plan.skipped:
+            print(f"Not adding {game} to library, since it was previously removed.")
+        for game in plan.adds:
+            print(f"Added {game} to library.")
+        self.games.add_all(plan.adds)
+
+        removals = Library._confirm_missing(plan.removals, missing_policy, 'Library contains the above games, but couldn\'t find them in Steam library. Do you want to remove them?')
+        self.games.remove_all(removals)
+        for game in removals:
+            print(f"Removed game {game} from library.")
+        if len(removals) < len(plan.removals):
+            print(f"Did not remove {len(plan.removals) - len(removals)} games missing from Steam library.")
+
+        purges = Library._confirm_missing(plan.purges, missing_policy, 'Library contains exclusions for the above games, but couldn\'t find them in Steam library. Do you want to remove them?')
+        self.exclusions.remove_all(purges)
+        for game in purges:
+            print(f"Purged game {game} from exclusions.")
+        if len(purges) < len(plan.purges):
+            print(f"Did not purge {len(plan.purges) - len(purges)} exclusions missing from Steam library.")
+
         newline()
-        print(f"Added {add_count} games, updated {update_count} games, removed {remove_count} games, and purged {purge_count} exclusions based on Steam library.")
+        print(f"Added {len(plan.adds)} games, updated {len(plan.renames)} games, removed {len(removals)} games, and purged {len(purges)} exclusions based on Steam library.")
+
+    @staticmethod
+    def _confirm_missing(games: List[Game], missing_policy: MissingPolicy, prompt: str) -> List[Game]:
+        if not games or missing_policy == MissingPolicy.KEEP:
+            return []
+        if missing_policy == MissingPolicy.REMOVE:
+            return games
+        # Ask once for the whole list, rather than once per game
+        Library.print_game_list(games)
+        return games if yes_or_no(prompt) else []
 
     def to_file(self, file_path: Path):
         with file_path.open(mode='w', encoding='utf8') as file:
@@ -192,8 +320,26 @@ class Library:
         library = cls(games=games, exclusions=exclusions)
         return library
 
-    def to_sunshine_config_json_dict(self, pre_launcher_path: Path, launcher_path: Path, teardown_path: Path, settings_sync_path: Path, static_art_dir: Path, art_cache_dir: Path) -> dict:
+    def to_sunshine_config_json_dict(self, pre_launcher_path: Path, launcher_path: Path, teardown_path: Path, settings_sync_path: Path, prep_path: Path, static_art_dir: Path, art_cache: ConvertedArtworkCache, artwork_index: ArtworkIndex, art_workers: Optional[int] = None, existing_config: Optional[dict] = None, agent_client_path: Optional[Path] = None) -> dict:
+        """Generate the Sunshine config for the library.
+
+        If an existing config is given, it's merged with the generated apps (see merge_sunshine_config). Apps that
+        were generated from the same inputs as an app in the existing config are reused as-is, so their artwork
+        doesn't need to be looked at again.
+
+        Each app gets a single prep command (prep_path), which restores settings and starts Steam concurrently, rather
+        than separate settings sync and pre-launcher commands, which Sunshine would run one after another.
+
+        If agent_client_path is given, the scripts are run through the agent client, so they run in the agent when it's
+        up (and in-process otherwise).
+        """
         pythonw_path = Path(sys.executable).parent.resolve() / 'pythonw.exe'
+        def script_cmd(script_path: Path, args: str = '') -> str:
+            if agent_client_path:
+                return f"{pythonw_path} {agent_client_path} {script_path.stem} {args}".rstrip()
+            return f"{pythonw_path} {script_path} {args}".rstrip()
+
+        existing_config = existing_config or {}
         config: dict = {
             'env': {
                 'PATH': "$(PATH);$(ProgramFiles(x86))\\Steam"
@@ -205,50 +351,80 @@ class Library:
         apps = [
             {
                 'name': 'Desktop',
-                'image-path': 'desktop.png'
+                'image-path': 'desktop.png',
+                MANAGED_APP_KEY: 'desktop'
             },
             {
                 'name': 'Steam Big Picture',
-                'cmd': f"{pythonw_path} {launcher_path}",
+                'cmd': script_cmd(launcher_path),
                 'prep-cmd': [
                     {
-                        'do': f"{pythonw_path} {pre_launcher_path}",
-                        'undo': f"{pythonw_path} {teardown_path} detached",
+                        'do': script_cmd(prep_path, 'do'),
+                        'undo': script_cmd(prep_path, 'undo'),
                         'elevated': 'false'
                     }
                 ],
                 'image-path': str(static_art_dir / 'steam-big-picture.png'),
-                **common_options
+                **common_options,
+                MANAGED_APP_KEY: 'big-picture'
             },
         ]
         config['apps'] = apps
 
+        # Everything that goes into a game's app entry. If none of it has changed, the existing entry can be reused
+        artwork_index.refresh()
+        art_paths = {game.id: game.get_cover_art_source_path(artwork_index) for game in self.games}
+        common_inputs = [str(pythonw_path), str(pre_launcher_path), str(launcher_path), str(teardown_path), str(settings_sync_path), str(prep_path), str(agent_client_path), common_options, art_cache.size, art_cache.compress_level]
+        def get_fingerprint(game: Game) -> str:
+            art_path = art_paths[game.id]
+            art_stat = art_path.stat() if art_path else None
+            inputs = [common_inputs, game.to_json_dict(), str(art_path), art_stat and art_stat.st_size, art_stat and art_stat.st_mtime_ns]
+            return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+        existing_apps = {app[MANAGED_APP_KEY]: app for app in existing_config.get('apps', []) if MANAGED_APP_KEY in app}
+        fingerprints = {game.id: get_fingerprint(game) for game in self.games}
+        reused_apps = {}
+        for game in self.games:
+            existing_app = existing_apps.get(game.id)
+            if existing_app and existing_app.get(FINGERPRINT_KEY) == fingerprints[game.id] and (not existing_app.get('image-path') or Path(existing_app['image-path']).is_file()):
+                reused_apps[game.id] = existing_app
+        if reused_apps:
+            print(f"Reusing {len(reused_apps)} unchanged games from existing Sunshine config")
+
+        # Convert artwork in parallel. Even pngs are converted, so they're resized and optimized
+        src_art_paths = [path for path in art_paths.values() if path]
+        converted_art_paths = art_cache.convert_all((art_paths[game.id] for game in self.games if not game.id in reused_apps and art_paths[game.id]), art_workers)
+        # Keep converted artwork for excluded games around, in case they're returned to the library
+        excluded_art_paths = [game.get_cover_art_source_path(artwork_index) for game in self.exclusions]
+        art_cache.collect_garbage(src_art_paths + [path for path in excluded_art_paths if path], src_art_paths)
+        art_cache.save()
+
         for game in self.games:
+            if game.id in reused_apps:
+                apps.append(reused_apps[game.id])
+                continue
+
+            # The game id is always passed, so the stream's session is tagged with the game it's for
+            prep_args = game.settings_sync_args() + ' ' if game.settings_path else f"-g={game.id} "
             prep_cmds = [
                 {
-                    'do': f"{pythonw_path} {pre_launcher_path}",
-                    'undo': f"{pythonw_path} {teardown_path} detached",
+                    'do': script_cmd(prep_path, f"{prep_args}do"),
+                    'undo': script_cmd(prep_path, f"{prep_args}undo"),
                     'elevated': 'false'
                 }
             ]
-            if game.settings_path:
-                prep_cmds.insert(0, {
-                    'do': f"{pythonw_path} {settings_sync_path} {game.settings_sync_args()} load",
-                    'undo': f"{pythonw_path} {settings_sync_path} {game.settings_sync_args()} save",
-                    'elevated': 'false'
-                })
 
             apps.append({
                 'name': game.name,
-                'cmd': f"{pythonw_path} {launcher_path} {game.launcher_args()}",
+                'cmd': script_cmd(launcher_path, game.launcher_args()),
                 'prep-cmd': prep_cmds,
-                'image-path': str(game.get_cover_art_path(STEAM_CONFIG_PATH, art_cache_dir) or ''),
-                **common_options
+                'image-path': str(converted_art_paths.get(art_paths[game.id]) or ''),
+                **common_options,
+                MANAGED_APP_KEY: game.id,
+                FINGERPRINT_KEY: fingerprints[game.id]
             })
-        return config
-
-    def _sort_games(self):
-        self.games = sorted(self.games)
 
-    def _sort_exclusions(self):
-        self.exclusions = sorted(self.exclusions)
+        legacy_markers = [str(launcher_path), str(pre_launcher_path), str(teardown_path), str(settings_sync_path), str(prep_path)]
+        if agent_client_path:
+            legacy_markers.append(str(agent_client_path))
+        return merge_sunshine_config(existing_config, config, legacy_markers)
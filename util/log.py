@@ -1,23 +1,208 @@
-import traceback
+import atexit
+import json
+import os
+import sys
+import threading
+import time
 from datetime import datetime
 from pathlib import Path
+from typing import Iterator, List, Optional
+
+class InterProcessLock:
+    """Exclusive lock shared between processes, held on a lock file. Used as a context manager."""
+
+    def __init__(self, lock_path: Path):
+        self.lock_path = lock_path
+        self.file = None
+
+    def __enter__(self):
+        self.file = self.lock_path.open(mode='a+b')
+        self.file.seek(0)
+        if sys.platform == 'win32':
+            import msvcrt
+            while True:
+                try:
+                    msvcrt.locking(self.file.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.005)
+        else:
+            import fcntl
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.seek(0)
+        if sys.platform == 'win32':
+            import msvcrt
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
 
 class Logger:
-    def __init__(self, log_file_path: Path):
+    """Writes structured log records, one JSON object per line.
+
+    Records are buffered, and written in batches by a background thread (and whenever the process exits). Several
+    processes can log to the same file (e.g. the detached teardown and the teardown that started it), since each batch
+    is appended while holding a lock shared between processes. The file is only open while a batch is written.
+
+    Once the file gets bigger than max_bytes, or its first record is older than max_age seconds, it's rotated: renamed,
+    and compressed with gzip. Only the newest backup_count rotated files are kept.
+    """
+
+    # How long records are held before they're written, so they're written in batches
+    FLUSH_DELAY = 0.2
+    MAX_BYTES = 5 * 1024 * 1024
+    MAX_AGE = 7 * 24 * 60 * 60
+    BACKUP_COUNT = 5
+
+    def __init__(self, log_file_path: Path, max_bytes: int = MAX_BYTES, max_age: float = MAX_AGE, backup_count: int = BACKUP_COUNT):
         dir_path = log_file_path.parent
         dir_path.mkdir(parents=True, exist_ok=True)
-        self.file = log_file_path.open(mode='a')
+        self.path = log_file_path
+        self.lock_path = log_file_path.with_name(log_file_path.name + '.lock')
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backup_count = backup_count
+        self.pending: List[bytes] = []
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.writer = None
+        # Fields added to every record, e.g. the id of the stream session the script is running for. Kept per thread,
+        # since the agent runs the scripts for several streams at once, each on its own thread
+        self.local = threading.local()
+        atexit.register(self.flush)
+
+    def set_context(self, **fields):
+        """Set the fields added to every record the calling thread logs."""
+        self.local.context = fields
+
+    def log(self, *args, level: str = 'info', **fields):
+        """Log a message (made of the arguments like print would), with any extra fields added to the record."""
+        record = {
+            'time': datetime.now().isoformat(),
+            'level': level,
+            'pid': os.getpid(),
+            'message': ' '.join(str(arg) for arg in args)
+        }
+        record.update(getattr(self.local, 'context', {}))
+        record.update(fields)
+        line = (json.dumps(record, ensure_ascii=False, default=str) + '\n').encode('utf-8')
+        with self.condition:
+            self.pending.append(line)
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._run_writer, daemon=True)
+                self.writer.start()
+            self.condition.notify()
+
+    def flush(self):
+        """Write all buffered records now."""
+        with self.flush_lock:
+            with self.condition:
+                lines, self.pending = self.pending, []
+            if lines:
+                self._write(b''.join(lines))
 
-    def log(self, *args):
-        print(f"{datetime.now()}:", *args, file=self.file)
+    def _run_writer(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending)
+            time.sleep(Logger.FLUSH_DELAY)
+            try:
+                self.flush()
+            except OSError as e:
+                # Nowhere to log this to. Keep going, so later records still have a chance of being written
+                print(f"Failed to write log {self.path}: {e}", file=sys.stderr)
+
+    def _write(self, data: bytes):
+        with InterProcessLock(self.lock_path):
+            rotated_path = self._rotate_if_needed(len(data))
+            with self.path.open(mode='ab') as file:
+                file.write(data)
+        # Compress outside of the lock, since no other process knows about the rotated file
+        if rotated_path:
+            self._compress(rotated_path)
+            self._delete_old_backups()
+
+    def _get_start_time(self) -> Optional[float]:
+        """When the first record in the log file was written."""
+        try:
+            with self.path.open(mode='rb') as file:
+                return datetime.fromisoformat(json.loads(file.readline())['time']).timestamp()
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _rotate_if_needed(self, incoming_bytes: int) -> Optional[Path]:
+        try:
+            size = self.path.stat().st_size
+        except FileNotFoundError:
+            return None
+        if size == 0:
+            return None
+        start_time = self._get_start_time()
+        if size + incoming_bytes <= self.max_bytes and (start_time is None or start_time > time.time() - self.max_age):
+            return None
+        rotated_path = self.path.with_name(f"{self.path.stem}.{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{os.getpid()}{self.path.suffix}")
+        os.replace(self.path, rotated_path)
+        return rotated_path
+
+    def _compress(self, rotated_path: Path):
+        import gzip
+        import shutil
+        compressed_path = rotated_path.with_name(rotated_path.name + '.gz')
+        temp_path = compressed_path.with_name(compressed_path.name + '.tmp')
+        with rotated_path.open(mode='rb') as src, gzip.open(temp_path, mode='wb') as dest:
+            shutil.copyfileobj(src, dest)
+        os.replace(temp_path, compressed_path)
+        rotated_path.unlink()
+
+    def get_backup_paths(self) -> List[Path]:
+        """The rotated log files, oldest first."""
+        return sorted(self.path.parent.glob(f"{self.path.stem}.*{self.path.suffix}.gz"))
+
+    def _delete_old_backups(self):
+        backups = self.get_backup_paths()
+        for path in backups[:max(0, len(backups) - self.backup_count)]:
+            path.unlink(missing_ok=True)
 
     def with_error_catching(self, func, name: str):
         try:
-            self.log('=' * 100)
             self.log(f"Started running {name}")
             func()
         except BaseException as e:
-            self.log(f"Script failed with exception: {traceback.format_exc()}")
+            import traceback
+            self.log(f"Script failed with exception: {e!r}", level='error', traceback=traceback.format_exc())
             raise e
         finally:
-            self.log(f"Finished running {name}")
\ No newline at end of file
+            self.log(f"Finished running {name}")
+            try:
+                self.flush()
+            except OSError as e:
+                # Failing to write the log mustn't hide the script's own exception, or fail a script that succeeded
+                print(f"Failed to write log {self.path}: {e}", file=sys.stderr)
+
+def read_log_records(log_file_path: Path, include_rotated: bool = True) -> Iterator[dict]:
+    """Read the records in a log file, oldest first. Rotated log files are included, unless include_rotated is False.
+    Lines that aren't valid records (e.g. a line cut short by a crash) are skipped."""
+    paths = []
+    if include_rotated:
+        paths += sorted(log_file_path.parent.glob(f"{log_file_path.stem}.*{log_file_path.suffix}.gz"))
+    paths.append(log_file_path)
+    for path in paths:
+        if path.suffix == '.gz':
+            import gzip
+            opener = gzip.open
+        else:
+            opener = open
+        try:
+            with opener(path, mode='rb') as file:
+                for line in file:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            continue
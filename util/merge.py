@@ -0,0 +1,315 @@
+import codecs
+import json
+import re
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+# Settings files are flattened into a dict of keys to values. Each key is a JSON encoded list of the names leading to
+# the value (e.g. the section and key in an INI file), so it can be used as a key in the stored JSON deltas.
+#
+# A delta has the keys whose values should be set ('set'), and the keys that should be removed ('deleted').
+
+def make_key(*path: str) -> str:
+    return json.dumps(list(path), ensure_ascii=False)
+
+def decode_settings_text(data: bytes) -> Tuple[str, str]:
+    """Decode a settings file, returning its text and the encoding to write it back with (which keeps its BOM, if any)."""
+    if data.startswith(codecs.BOM_UTF16_LE) or data.startswith(codecs.BOM_UTF16_BE):
+        return data.decode('utf-16'), 'utf-16'
+    if data.startswith(codecs.BOM_UTF8):
+        return data.decode('utf-8-sig'), 'utf-8-sig'
+    try:
+        return data.decode('utf-8'), 'utf-8'
+    except UnicodeDecodeError:
+        # Older games write INI files in the system code page. Latin-1 at least round trips every byte
+        return data.decode('latin-1'), 'latin-1'
+
+class IniFormat:
+    """INI files, edited line by line so comments, ordering and formatting are kept. Each section also has a key of its
+    own (with just the section's name), so a delta records the sections it adds, and undoing it removes them again."""
+
+    SECTION_PATTERN = re.compile(r'^\s*\[([^\]]*)\]')
+    KEY_PATTERN = re.compile(r'^(\s*)([^=;#\[\s][^=]*?)(\s*=\s*)(.*?)\s*$')
+
+    def _parse(self, lines: List[str]) -> Tuple[Dict[str, int], Dict[str, int]]:
+        """Find the line of each key (the last one, if it's repeated), the header of each section (the first one), and
+        the last non-blank line of each section."""
+        key_lines = {}
+        section_ends = {'': -1}
+        section = ''
+        for i, line in enumerate(lines):
+            body = line.rstrip('\r\n')
+            match = IniFormat.SECTION_PATTERN.match(body)
+            if match:
+                section = match.group(1).strip()
+                key_lines.setdefault(make_key(section), i)
+                section_ends[section] = i
+                continue
+            match = IniFormat.KEY_PATTERN.match(body)
+            if match:
+                key_lines[make_key(section, match.group(2))] = i
+            if body.strip():
+                section_ends[section] = i
+        return key_lines, section_ends
+
+    def read(self, text: str) -> Dict[str, Any]:
+        lines = text.splitlines(keepends=True)
+        key_lines, _ = self._parse(lines)
+        values = {}
+        for key, i in key_lines.items():
+            match = IniFormat.KEY_PATTERN.match(lines[i].rstrip('\r\n'))
+            values[key] = match.group(4) if match else ''
+        return values
+
+    def apply(self, text: str, delta: dict) -> str:
+        lines = text.splitlines(keepends=True)
+        newline = '\r\n' if '\r\n' in text else '\n'
+        if lines and not lines[-1].endswith(('\r', '\n')):
+            lines[-1] += newline
+        key_lines, section_ends = self._parse(lines)
+        separator = '='
+        for i in key_lines.values():
+            match = IniFormat.KEY_PATTERN.match(lines[i].rstrip('\r\n'))
+            if match:
+                separator = match.group(3)
+                break
+
+        replaced: Dict[int, Optional[str]] = {}
+        inserted: Dict[int, List[str]] = {}
+        new_sections: Dict[str, List[str]] = {}
+        deleted_headers = []
+        for key in delta.get('deleted', []):
+            if len(json.loads(key)) == 1:
+                deleted_headers.append(key_lines.get(key))
+            elif key in key_lines:
+                replaced[key_lines[key]] = None
+        for key, value in delta.get('set', {}).items():
+            path = json.loads(key)
+            if len(path) == 1:
+                # Adding a section. Its keys are added along with it
+                if not path[0] in section_ends:
+                    new_sections.setdefault(path[0], [])
+                continue
+            section, name = path
+            if key in key_lines:
+                i = key_lines[key]
+                body = lines[i].rstrip('\r\n')
+                match = IniFormat.KEY_PATTERN.match(body)
+                replaced[i] = f"{match.group(1)}{match.group(2)}{match.group(3)}{value}{lines[i][len(body):]}"
+            elif section in section_ends:
+                inserted.setdefault(section_ends[section], []).append(f"{name}{separator}{value}{newline}")
+            else:
+                new_sections.setdefault(section, []).append(f"{name}{separator}{value}{newline}")
+
+        # Only remove a section's header once nothing is left in it, otherwise its remaining keys would end up in the
+        # section before it
+        header = None
+        kept = {}
+        for i, line in enumerate(lines):
+            if IniFormat.SECTION_PATTERN.match(line):
+                header = i
+                kept[i] = bool(inserted.get(i))
+            elif header is not None and replaced.get(i, line) is not None and (line.strip() or inserted.get(i)):
+                kept[header] = True
+        for i in deleted_headers:
+            if i is not None and not kept[i]:
+                replaced[i] = None
+
+        result = inserted.get(-1, [])
+        for i, line in enumerate(lines):
+            line = replaced.get(i, line)
+            if line is not None:
+                result.append(line)
+            result += inserted.get(i, [])
+        # New sections aren't separated from the rest of the file by a blank line, so removing them puts the file back
+        # exactly as it was
+        for section, section_lines in new_sections.items():
+            result.append(f"[{section}]{newline}")
+            result += section_lines
+        return ''.join(result)
+
+class JsonFormat:
+    """JSON files. Nested objects are flattened, anything else (including arrays) is a single value.
+
+    Applying a delta re-serializes the whole file. Its indentation is kept, but any other formatting (e.g. spacing
+    around keys, or arrays kept on one line) isn't, even for keys the delta doesn't touch.
+    """
+
+    def _flatten(self, value: Any, path: List[str], values: Dict[str, Any]):
+        if isinstance(value, dict) and value:
+            for name, child in value.items():
+                self._flatten(child, path + [name], values)
+        else:
+            values[make_key(*path)] = value
+
+    def read(self, text: str) -> Dict[str, Any]:
+        values = {}
+        self._flatten(json.loads(text) if text.strip() else {}, [], values)
+        return values
+
+    def apply(self, text: str, delta: dict) -> str:
+        root = json.loads(text) if text.strip() else {}
+        for key in delta.get('deleted', []):
+            path = json.loads(key)
+            parents = [root]
+            for name in path[:-1]:
+                parents.append(parents[-1].get(name) if isinstance(parents[-1], dict) else None)
+            if not path or not isinstance(parents[-1], dict) or not path[-1] in parents[-1]:
+                continue
+            del parents[-1][path[-1]]
+            # Remove objects that are left empty (e.g. ones a delta added that are being reverted). Objects that were
+            # empty in the base are flattened as values of their own, so the delta sets them again below
+            for depth in range(len(path) - 1, 0, -1):
+                if parents[depth]:
+                    break
+                del parents[depth - 1][path[depth - 1]]
+        for key, value in delta.get('set', {}).items():
+            path = json.loads(key)
+            if not path:
+                root = value
+                continue
+            if not isinstance(root, dict):
+                root = {}
+            parent = root
+            for name in path[:-1]:
+                if not isinstance(parent.get(name), dict):
+                    parent[name] = {}
+                parent = parent[name]
+            parent[path[-1]] = value
+
+        # Keep the file's indentation
+        match = re.search(r'\n([ \t]+)\S', text)
+        indent = match.group(1) if match else None
+        result = json.dumps(root, ensure_ascii=False, indent=indent)
+        return result + '\n' if text.endswith('\n') else result
+
+class XmlFormat:
+    """XML files. Each element's text and attributes are values. Elements are identified by their tag and their index
+    among siblings with the same tag."""
+
+    ELEMENT_PATTERN = re.compile(r'^(.*)\[(\d+)\]$')
+    DECLARATION_PATTERN = re.compile(r'^\s*<\?xml[^>]*\?>\s*')
+
+    def _parse(self, text: str):
+        import io
+        import xml.etree.ElementTree as ET
+        # Keep the file's namespace prefixes when it's written back
+        for _, (prefix, uri) in ET.iterparse(io.StringIO(text), events=['start-ns']):
+            ET.register_namespace(prefix, uri)
+        return ET.fromstring(text, parser=ET.XMLParser(target=ET.TreeBuilder(insert_comments=True)))
+
+    def _children(self, element) -> List[Tuple[str, Any]]:
+        counts = {}
+        children = []
+        for child in element:
+            # Skip comments and processing instructions
+            if isinstance(child.tag, str):
+                index = counts.get(child.tag, 0)
+                counts[child.tag] = index + 1
+                children.append((f"{child.tag}[{index}]", child))
+        return children
+
+    def _flatten(self, element, path: List[str], values: Dict[str, Any]):
+        if element.text and element.text.strip():
+            values[make_key(*path, '#text')] = element.text
+        for name, value in element.attrib.items():
+            values[make_key(*path, f"@{name}")] = value
+        for name, child in self._children(element):
+            self._flatten(child, path + [name], values)
+
+    def read(self, text: str) -> Dict[str, Any]:
+        root = self._parse(text)
+        values = {}
+        self._flatten(root, [root.tag], values)
+        return values
+
+    def _find(self, root, path: List[str], create: bool):
+        import xml.etree.ElementTree as ET
+        if not path or path[0] != root.tag:
+            return None
+        element = root
+        for name in path[1:]:
+            tag, index = XmlFormat.ELEMENT_PATTERN.match(name).groups()
+            matches = [child for child in element if child.tag == tag]
+            if len(matches) <= int(index):
+                if not create:
+                    return None
+                while len(matches) <= int(index):
+                    matches.append(ET.SubElement(element, tag))
+            element = matches[int(index)]
+        return element
+
+    def apply(self, text: str, delta: dict) -> str:
+        import xml.etree.ElementTree as ET
+        root = self._parse(text)
+        emptied = []
+        for key in delta.get('deleted', []):
+            path = json.loads(key)
+            element = self._find(root, path[:-1], create=False)
+            if element is None:
+                continue
+            if path[-1] == '#text':
+                element.text = None
+            else:
+                element.attrib.pop(path[-1][1:], None)
+            emptied.append(path[:-1])
+        # Remove elements that are left with nothing in them (e.g. ones a delta added that are being reverted). Found
+        # before any are removed, since removing one changes the indices of its later siblings
+        removed = [(self._find(root, path[:-1], create=False), self._find(root, path, create=False)) for path in emptied if len(path) > 1]
+        for parent, element in removed:
+            if parent is not None and element is not None and not element.text and not element.attrib and len(element) == 0 and element in list(parent):
+                parent.remove(element)
+        for key, value in delta.get('set', {}).items():
+            path = json.loads(key)
+            element = self._find(root, path[:-1], create=True)
+            if element is None:
+                continue
+            if path[-1] == '#text':
+                element.text = value
+            else:
+                element.set(path[-1][1:], value)
+
+        result = ET.tostring(root, encoding='unicode')
+        # Keep the declaration as it was, since it names the encoding the file is written back in
+        match = XmlFormat.DECLARATION_PATTERN.match(text)
+        if match:
+            result = match.group(0) + result
+        return result + '\n' if text.endswith('\n') else result
+
+SETTINGS_FORMATS = {
+    '.ini': IniFormat(),
+    '.json': JsonFormat(),
+    '.xml': XmlFormat(),
+}
+
+def get_settings_format(path: Path):
+    """The format used to merge the settings file, or None if it can't be merged."""
+    return SETTINGS_FORMATS.get(path.suffix.lower())
+
+def compute_settings_delta(settings_format, base_data: bytes, data: bytes) -> dict:
+    """The delta that turns the base settings into the given settings."""
+    base = settings_format.read(decode_settings_text(base_data)[0])
+    values = settings_format.read(decode_settings_text(data)[0])
+    return {
+        'set': {key: value for key, value in values.items() if not key in base or base[key] != value},
+        'deleted': [key for key in base if not key in values]
+    }
+
+def invert_settings_delta(settings_format, base_data: bytes, delta: dict) -> dict:
+    """The delta that undoes the given delta, after it was applied to the base settings."""
+    base = settings_format.read(decode_settings_text(base_data)[0])
+    changed = list(delta.get('set', {})) + list(delta.get('deleted', []))
+    return {
+        'set': {key: base[key] for key in changed if key in base},
+        'deleted': [key for key in changed if not key in base]
+    }
+
+def apply_settings_delta(settings_format, data: bytes, delta: dict) -> bytes:
+    # Leave the file exactly as it is if there's nothing to change, since applying may reformat it
+    if is_delta_empty(delta):
+        return data
+    text, encoding = decode_settings_text(data)
+    return settings_format.apply(text, delta).encode(encoding)
+
+def is_delta_empty(delta: dict) -> bool:
+    return not delta.get('set') and not delta.get('deleted')
@@ -0,0 +1,96 @@
+import concurrent.futures
+import time
+from typing import Callable, Iterable, List, Optional
+
+class PrepStep:
+    """One step of getting ready for a stream. Steps run as soon as the steps they depend on (by name) finish."""
+
+    def __init__(self, name: str, run: Callable[[], None], rollback: Optional[Callable[[], None]] = None, depends_on: Iterable[str] = ()):
+        self.name = name
+        self.run = run
+        self.rollback = rollback
+        self.depends_on = list(depends_on)
+        self.start_time: Optional[float] = None
+        self.end_time: Optional[float] = None
+        self.error: Optional[BaseException] = None
+
+    @property
+    def elapsed(self) -> float:
+        return self.end_time - self.start_time
+
+    def execute(self):
+        self.start_time = time.perf_counter()
+        try:
+            self.run()
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.end_time = time.perf_counter()
+
+class PrepError(RuntimeError):
+    def __init__(self, step: PrepStep):
+        super().__init__(f"Prep step '{step.name}' failed: {step.error}")
+        self.step = step
+
+def run_prep_steps(steps: List[PrepStep], log: Callable[[str], None] = print):
+    """Run steps concurrently, each one as soon as its dependencies are done.
+
+    If a step fails, no more steps are started. Once the running ones finish, every step that completed is rolled
+    back, in the reverse of the order they completed in, and PrepError is raised.
+    """
+    names = {step.name for step in steps}
+    for step in steps:
+        for dependency in step.depends_on:
+            if not dependency in names:
+                raise ValueError(f"Prep step '{step.name}' depends on unknown step '{dependency}'")
+
+    start_time = time.perf_counter()
+    pending = list(steps)
+    running = {}
+    completed: List[PrepStep] = []
+    failed = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(steps))) as executor:
+        while pending or running:
+            if failed is None:
+                done = {step.name for step in completed}
+                for step in [step for step in pending if all(dependency in done for dependency in step.depends_on)]:
+                    pending.remove(step)
+                    running[executor.submit(step.execute)] = step
+            if not running:
+                # Nothing left that can run
+                break
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                if step.error is None:
+                    completed.append(step)
+                elif failed is None:
+                    failed = step
+
+    if failed is None and pending:
+        # Only possible with a dependency cycle
+        raise ValueError(f"Prep steps {', '.join(step.name for step in pending)} could never run. Check their dependencies.")
+
+    if failed is not None:
+        log(f"Prep step '{failed.name}' failed after {failed.elapsed * 1000:.0f} ms. Rolling back {len(completed)} completed steps")
+        for step in reversed(completed):
+            if step.rollback:
+                try:
+                    step.rollback()
+                    log(f"Rolled back prep step '{step.name}'")
+                except Exception as e:
+                    log(f"Failed to roll back prep step '{step.name}': {e}")
+        raise PrepError(failed) from failed.error
+
+    report_prep_steps(steps, start_time, log)
+
+def report_prep_steps(steps: List[PrepStep], start_time: float, log: Callable[[str], None] = print):
+    """Log when each step finished, compared to when it would have finished if the steps ran one after another (in
+    the order given), as Sunshine runs prep commands."""
+    sequential_end = 0.0
+    for step in steps:
+        sequential_end += step.elapsed
+        end = step.end_time - start_time
+        log(f"Prep step '{step.name}' took {step.elapsed * 1000:.0f} ms and finished at {end * 1000:.0f} ms, instead of {sequential_end * 1000:.0f} ms when run one after another (saved {(sequential_end - end) * 1000:.0f} ms)")
+    total = max(step.end_time for step in steps) - start_time if steps else 0
+    log(f"Prep finished in {total * 1000:.0f} ms, saving {(sequential_end - total) * 1000:.0f} ms over the {sequential_end * 1000:.0f} ms the steps take one after another")
@@ -0,0 +1,380 @@
+import sys
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+
+class ProcessInfo(NamedTuple):
+    pid: int
+    parent_pid: int
+    name: str
+    # Seconds since the epoch, or None if it wasn't read with the rest of the snapshot
+    create_time: Optional[float] = None
+
+class ProcessSnapshot:
+    """Point-in-time view of the running processes, indexed by name (case-insensitive) and by parent pid.
+
+    Creation times are only needed to tell real children from stale ones, so if the snapshot didn't include them,
+    they're read with read_create_time when first needed.
+    """
+
+    def __init__(self, processes: Iterable[ProcessInfo], read_create_time: Optional[Callable[[int], Optional[float]]] = None):
+        self.read_create_time = read_create_time
+        self.create_times: Dict[int, Optional[float]] = {}
+        self.processes: Dict[int, ProcessInfo] = {}
+        self.pids_by_name: Dict[str, List[int]] = {}
+        self.children_by_pid: Dict[int, List[int]] = {}
+        for process in processes:
+            self.processes[process.pid] = process
+            self.pids_by_name.setdefault(process.name.casefold(), []).append(process.pid)
+            self.children_by_pid.setdefault(process.parent_pid, []).append(process.pid)
+
+    def __len__(self) -> int:
+        return len(self.processes)
+
+    def get(self, pid: int) -> Optional[ProcessInfo]:
+        return self.processes.get(pid)
+
+    def get_pids(self, name: str) -> List[int]:
+        return self.pids_by_name.get(name.casefold(), [])
+
+    def is_running(self, name: str) -> bool:
+        return len(self.get_pids(name)) > 0
+
+    def get_create_time(self, pid: int) -> Optional[float]:
+        process = self.processes.get(pid)
+        if process is None:
+            return None
+        if process.create_time is not None or self.read_create_time is None:
+            return process.create_time
+        if not pid in self.create_times:
+            self.create_times[pid] = self.read_create_time(pid)
+        return self.create_times[pid]
+
+    def get_children(self, pid: int) -> List[ProcessInfo]:
+        # A process can't be its own child. This guards against the idle process (pid 0) being its own parent
+        children = [self.processes[child] for child in self.children_by_pid.get(pid, []) if child != pid]
+        if not children:
+            return children
+        # Windows doesn't clear the parent pid when a parent exits, so if its pid was reused, the new process appears
+        # to have the old one's children. Those were created before it, so they're skipped
+        create_time = self.get_create_time(pid)
+        if create_time is None:
+            return children
+        kept = []
+        for child in children:
+            child_create_time = self.get_create_time(child.pid)
+            if child_create_time is None or child_create_time >= create_time:
+                kept.append(child)
+        return kept
+
+    def get_tree(self, pids: Iterable[int]) -> List[int]:
+        """Return the given pids, plus the pids of all of their descendants."""
+        tree = []
+        seen = set()
+        pending = [pid for pid in pids if pid in self.processes]
+        while pending:
+            pid = pending.pop()
+            if pid in seen:
+                continue
+            seen.add(pid)
+            tree.append(pid)
+            pending.extend(child.pid for child in self.get_children(pid))
+        return tree
+
+    def get_kill_order(self, pids: Iterable[int]) -> List[ProcessInfo]:
+        """Return the given processes and all of their descendants, ordered so every process comes after all of its
+        descendants. Killing in this order means no process is orphaned (and possibly respawned by its parent)."""
+        # get_tree lists every process before its descendants, so reversing it puts leaves first
+        return [self.processes[pid] for pid in reversed(self.get_tree(pids))]
+
+class ProcessBackend:
+    """Source of process snapshots."""
+
+    def snapshot(self) -> ProcessSnapshot:
+        raise NotImplementedError()
+
+class ProcessWaiter:
+    """Blocks until processes exit."""
+
+    def wait_for_exit(self, pids: List[int], timeout: float) -> bool:
+        """Wait until all of the given processes have exited, or the timeout (in seconds) passes. Returns whether
+        all of the processes exited."""
+        raise NotImplementedError()
+
+class ProcessTerminator:
+    """Kills processes."""
+
+    def terminate(self, process: ProcessInfo) -> bool:
+        """Kill a process seen in an earlier snapshot. Returns false (without killing anything) if the process already
+        exited, or its pid was reused by a different program since the snapshot was taken."""
+        raise NotImplementedError()
+
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+
+def read_win32_process_create_time(pid: int) -> Optional[float]:
+    """When the process was created, or None if it can't be opened (e.g. it already exited, or it's protected)."""
+    import pywintypes, win32api, win32process
+    try:
+        handle = win32api.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+    except pywintypes.error:
+        return None
+    try:
+        return win32process.GetProcessTimes(handle)['CreationTime'].timestamp()
+    except pywintypes.error:
+        return None
+    finally:
+        handle.Close()
+
+class Win32ProcessTerminator(ProcessTerminator):
+    STILL_ACTIVE = 259
+
+    def terminate(self, process: ProcessInfo) -> bool:
+        import pywintypes, win32api, win32con, win32process
+
+        try:
+            handle = win32api.OpenProcess(win32con.PROCESS_QUERY_INFORMATION | win32con.PROCESS_VM_READ | win32con.PROCESS_TERMINATE, False, process.pid)
+        except pywintypes.error:
+            # Already exited
+            return False
+        try:
+            if win32process.GetExitCodeProcess(handle) != Win32ProcessTerminator.STILL_ACTIVE:
+                return False
+            # Make sure the pid still belongs to the same program
+            if win32process.GetModuleFileNameEx(handle, 0).rsplit('\\', 1)[-1].casefold() != process.name.casefold():
+                return False
+            win32api.TerminateProcess(handle, 0)
+            return True
+        finally:
+            handle.Close()
+
+class Win32ProcessWaiter(ProcessWaiter):
+    """Waits on process handles with WaitForMultipleObjects, so the wait itself uses no CPU."""
+
+    MAXIMUM_WAIT_OBJECTS = 64
+    FALLBACK_POLL_INTERVAL = 0.25
+
+    def wait_for_exit(self, pids: List[int], timeout: float) -> bool:
+        import pywintypes, win32api, win32con, win32event
+
+        handles = []
+        for pid in pids:
+            try:
+                handles.append(win32api.OpenProcess(win32con.SYNCHRONIZE, False, pid))
+            except pywintypes.error:
+                # Either the process already exited, or we aren't allowed to wait on it (e.g. an elevated anticheat process)
+                pass
+        try:
+            if not handles:
+                # Nothing we can wait on, so the caller has to fall back to polling. Don't let it spin
+                time.sleep(min(timeout, Win32ProcessWaiter.FALLBACK_POLL_INTERVAL))
+                return False
+
+            deadline = time.monotonic() + timeout
+            # A single wait can only take so many handles, so wait on them in batches
+            for i in range(0, len(handles), Win32ProcessWaiter.MAXIMUM_WAIT_OBJECTS):
+                remaining_ms = int(max(0, deadline - time.monotonic()) * 1000)
+                batch = handles[i:i + Win32ProcessWaiter.MAXIMUM_WAIT_OBJECTS]
+                if win32event.WaitForMultipleObjects(batch, True, remaining_ms) == win32event.WAIT_TIMEOUT:
+                    return False
+            return True
+        finally:
+            for handle in handles:
+                handle.Close()
+
+class Toolhelp32ProcessBackend(ProcessBackend):
+    """Takes snapshots with the Win32 CreateToolhelp32Snapshot API. This is a single kernel call, and much cheaper
+    than enumerating Win32_Process through WMI."""
+
+    TH32CS_SNAPPROCESS = 0x00000002
+
+    def __init__(self):
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESSENTRY32W(ctypes.Structure):
+            _fields_ = [
+                ('dwSize', wintypes.DWORD),
+                ('cntUsage', wintypes.DWORD),
+                ('th32ProcessID', wintypes.DWORD),
+                ('th32DefaultHeapID', ctypes.c_size_t),
+                ('th32ModuleID', wintypes.DWORD),
+                ('cntThreads', wintypes.DWORD),
+                ('th32ParentProcessID', wintypes.DWORD),
+                ('pcPriClassBase', ctypes.c_long),
+                ('dwFlags', wintypes.DWORD),
+                ('szExeFile', ctypes.c_wchar * 260),
+            ]
+
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        kernel32.CreateToolhelp32Snapshot.argtypes = [wintypes.DWORD, wintypes.DWORD]
+        kernel32.CreateToolhelp32Snapshot.restype = wintypes.HANDLE
+        kernel32.Process32FirstW.argtypes = [wintypes.HANDLE, ctypes.POINTER(PROCESSENTRY32W)]
+        kernel32.Process32FirstW.restype = wintypes.BOOL
+        kernel32.Process32NextW.argtypes = [wintypes.HANDLE, ctypes.POINTER(PROCESSENTRY32W)]
+        kernel32.Process32NextW.restype = wintypes.BOOL
+        kernel32.CloseHandle.argtypes = [wintypes.HANDLE]
+        kernel32.CloseHandle.restype = wintypes.BOOL
+
+        self.ctypes = ctypes
+        self.kernel32 = kernel32
+        self.entry_type = PROCESSENTRY32W
+        self.invalid_handle = wintypes.HANDLE(-1).value
+
+    def snapshot(self) -> ProcessSnapshot:
+        handle = self.kernel32.CreateToolhelp32Snapshot(Toolhelp32ProcessBackend.TH32CS_SNAPPROCESS, 0)
+        if handle == self.invalid_handle:
+            raise self.ctypes.WinError(self.ctypes.get_last_error())
+        try:
+            processes = []
+            entry = self.entry_type()
+            entry.dwSize = self.ctypes.sizeof(self.entry_type)
+            more = self.kernel32.Process32FirstW(handle, self.ctypes.byref(entry))
+            while more:
+                processes.append(ProcessInfo(entry.th32ProcessID, entry.th32ParentProcessID, entry.szExeFile))
+                more = self.kernel32.Process32NextW(handle, self.ctypes.byref(entry))
+            return ProcessSnapshot(processes, read_win32_process_create_time)
+        finally:
+            self.kernel32.CloseHandle(handle)
+
+class WmiProcessBackend(ProcessBackend):
+    """Takes snapshots through WMI. The connection is opened once and reused, and each snapshot is a single query
+    for just the properties we need."""
+
+    def __init__(self):
+        import win32com.client
+        self.wmi = win32com.client.GetObject('winmgmts:')
+
+    def snapshot(self) -> ProcessSnapshot:
+        results = self.wmi.ExecQuery('Select ProcessId, ParentProcessId, Name from Win32_Process')
+        return ProcessSnapshot((ProcessInfo(result.ProcessId, result.ParentProcessId, result.Name) for result in results), read_win32_process_create_time)
+
+class FakeProcessBackend(ProcessBackend, ProcessWaiter, ProcessTerminator):
+    """In-memory process list, for exercising process handling logic without Windows. Processes can be started and
+    exited from other threads, which wakes up any wait_for_exit calls. Processes that were terminated are recorded,
+    in order, in terminated."""
+
+    def __init__(self, processes: Optional[Iterable[ProcessInfo]] = None):
+        self.processes: Dict[int, ProcessInfo] = {process.pid: process for process in processes or []}
+        self.snapshot_count = 0
+        self.terminated: List[ProcessInfo] = []
+        self.condition = threading.Condition()
+
+    def start(self, pid: int, name: str, parent_pid: int = 0, create_time: Optional[float] = None) -> ProcessInfo:
+        with self.condition:
+            process = ProcessInfo(pid, parent_pid, name, time.time() if create_time is None else create_time)
+            self.processes[pid] = process
+            return process
+
+    def exit(self, pid: int):
+        with self.condition:
+            self.processes.pop(pid, None)
+            self.condition.notify_all()
+
+    def snapshot(self) -> ProcessSnapshot:
+        with self.condition:
+            self.snapshot_count += 1
+            return ProcessSnapshot(list(self.processes.values()))
+
+    def terminate(self, process: ProcessInfo) -> bool:
+        with self.condition:
+            current = self.processes.get(process.pid)
+            if current is None or current.name.casefold() != process.name.casefold():
+                return False
+            del self.processes[process.pid]
+            self.terminated.append(current)
+            self.condition.notify_all()
+            return True
+
+    def wait_for_exit(self, pids: List[int], timeout: float) -> bool:
+        with self.condition:
+            return self.condition.wait_for(lambda: not any(pid in self.processes for pid in pids), timeout)
+
+def get_default_process_backend() -> ProcessBackend:
+    if sys.platform != 'win32':
+        raise RuntimeError('Reading the process table is only supported on Windows. Use FakeProcessBackend elsewhere.')
+    try:
+        return Toolhelp32ProcessBackend()
+    except (OSError, AttributeError):
+        return WmiProcessBackend()
+
+class ProcessTable:
+    """Shared access to the process table, backed by a ProcessBackend.
+
+    Snapshots are cached for max_age seconds, so several checks in quick succession only cost a single snapshot.
+    """
+
+    def __init__(self, backend: Optional[ProcessBackend] = None, max_age: float = 0):
+        self._backend = backend
+        self.max_age = max_age
+        self._snapshot: Optional[ProcessSnapshot] = None
+        self._snapshot_time = 0.0
+
+    @property
+    def backend(self) -> ProcessBackend:
+        # Created lazily, so scripts that never look at processes don't pay for it
+        if self._backend is None:
+            self._backend = get_default_process_backend()
+        return self._backend
+
+    def snapshot(self, max_age: Optional[float] = None) -> ProcessSnapshot:
+        max_age = self.max_age if max_age is None else max_age
+        now = time.monotonic()
+        if self._snapshot is None or now - self._snapshot_time > max_age:
+            self._snapshot = self.backend.snapshot()
+            self._snapshot_time = now
+        return self._snapshot
+
+    def invalidate(self):
+        self._snapshot = None
+
+    def get_pids(self, name: str) -> List[int]:
+        return self.snapshot().get_pids(name)
+
+    def is_running(self, name: str) -> bool:
+        return self.snapshot().is_running(name)
+
+def get_default_process_waiter() -> ProcessWaiter:
+    if sys.platform != 'win32':
+        raise RuntimeError('Waiting on processes is only supported on Windows. Use FakeProcessBackend elsewhere.')
+    return Win32ProcessWaiter()
+
+def get_default_process_terminator() -> ProcessTerminator:
+    if sys.platform != 'win32':
+        raise RuntimeError('Terminating processes is only supported on Windows. Use FakeProcessBackend elsewhere.')
+    return Win32ProcessTerminator()
+
+def terminate_process_trees(snapshot: ProcessSnapshot, pids: Iterable[int], terminator: ProcessTerminator, log: Callable[[str], None] = print) -> List[ProcessInfo]:
+    """Kill the given processes and all of their descendants, leaves first, based on a single snapshot. Returns the
+    processes that were actually killed."""
+    kill_order = snapshot.get_kill_order(pids)
+    if not kill_order:
+        return []
+    log(f"Killing {len(kill_order)} processes, leaves first: {', '.join(f'{process.name} (pid={process.pid})' for process in kill_order)}")
+    killed = []
+    skipped = []
+    for process in kill_order:
+        try:
+            if terminator.terminate(process):
+                killed.append(process)
+            else:
+                skipped.append(process)
+        except Exception as e:
+            # e.g. access denied. Keep going, so one stubborn process doesn't keep the rest alive
+            log(f"Failed to kill {process.name} (pid={process.pid}): {e}")
+    if skipped:
+        log(f"Skipped {len(skipped)} processes that already exited (or whose pid was reused): {', '.join(f'{process.name} (pid={process.pid})' for process in skipped)}")
+    return killed
+
+def wait_while_running(is_running: Callable[[], bool], get_pids: Callable[[], List[int]], waiter: ProcessWaiter, recheck_interval: float = 10):
+    """Block while is_running() returns true, by waiting on the handles of the processes returned by get_pids().
+
+    Once all of those processes exit (or recheck_interval passes, to pick up any processes started since), is_running()
+    is checked again. So this returns almost as soon as the last process exits, without polling in the meantime.
+    """
+    while is_running():
+        pids = get_pids()
+        if pids:
+            waiter.wait_for_exit(pids, recheck_interval)
+        else:
+            # We know the game is running, but couldn't find its processes. Fall back to polling
+            time.sleep(Win32ProcessWaiter.FALLBACK_POLL_INTERVAL)
@@ -0,0 +1,165 @@
+import threading
+import time
+from typing import Any, Callable, Optional
+from util.wait import *
+
+class RegistryValueWatcher(WaitEvents):
+    """Watches a single registry value, so callers can block until it reaches some state. It can also be passed to
+    wait_until as its events, to re-check a condition on the value whenever the key changes."""
+
+    def read(self) -> Any:
+        raise NotImplementedError()
+
+    def wait_for(self, predicate: Callable[[Any], bool], timeout: Optional[float] = None) -> bool:
+        """Block until predicate(value) is true, or the timeout (in seconds) passes. Returns whether the predicate
+        became true. The value is only re-read when the key changes (or, when polling, on each poll)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._start_waiting()
+        while True:
+            # Arm before reading, so a change between reading and waiting isn't missed
+            self._arm()
+            if predicate(self.read()):
+                return True
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            self._wait(remaining)
+
+    def arm(self) -> Any:
+        self._arm()
+
+    def wait(self, token: Any, timeout: Optional[float]):
+        self._wait(timeout)
+
+    def close(self):
+        pass
+
+    def _start_waiting(self):
+        pass
+
+    def _arm(self):
+        pass
+
+    def _wait(self, timeout: Optional[float]):
+        raise NotImplementedError()
+
+class Win32RegistryValueWatcher(RegistryValueWatcher):
+    """Uses RegNotifyChangeKeyValue, so changes are picked up as soon as they're written, without polling.
+
+    Each notification is registered once, and only registered again after it fires, so waiting a long time (e.g. for
+    a game to quit) doesn't pile up registrations on the key.
+    """
+
+    # Changes can't be missed, so there's no need to wake up and re-check the value
+    recheck_interval = None
+
+    def __init__(self, root_key, subkey: str, value_name: str):
+        import win32api, win32con, win32event
+        self.win32api = win32api
+        self.win32con = win32con
+        self.win32event = win32event
+        self.value_name = value_name
+        self.key = win32api.RegOpenKeyEx(root_key, subkey, 0, win32con.KEY_READ | win32con.KEY_NOTIFY)
+        self.event = win32event.CreateEvent(None, False, False, None)
+        self.armed = False
+
+    def read(self) -> Any:
+        try:
+            value, _ = self.win32api.RegQueryValueEx(self.key, self.value_name)
+            return value
+        except self.win32api.error:
+            return None
+
+    def close(self):
+        self.key.Close()
+        self.event.Close()
+
+    def _arm(self):
+        if not self.armed:
+            self.win32api.RegNotifyChangeKeyValue(self.key, False, self.win32con.REG_NOTIFY_CHANGE_LAST_SET, self.event, True)
+            self.armed = True
+
+    def _wait(self, timeout: Optional[float]):
+        result = self.win32event.WaitForSingleObject(self.event, self.win32event.INFINITE if timeout is None else int(timeout * 1000))
+        if result == self.win32event.WAIT_OBJECT_0:
+            self.armed = False
+
+class PollingRegistryValueWatcher(RegistryValueWatcher):
+    """Fallback for when change notifications aren't available. Polls quickly at first, since values usually change
+    soon after we start waiting, then backs off."""
+
+    MIN_INTERVAL = 0.05
+    MAX_INTERVAL = 1.0
+    BACKOFF = 1.5
+
+    def __init__(self, read_value: Callable[[], Any]):
+        self.read_value = read_value
+        self.interval = PollingRegistryValueWatcher.MIN_INTERVAL
+
+    def read(self) -> Any:
+        return self.read_value()
+
+    def _start_waiting(self):
+        self.interval = PollingRegistryValueWatcher.MIN_INTERVAL
+
+    def _wait(self, timeout: Optional[float]):
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        self.interval = min(self.interval * PollingRegistryValueWatcher.BACKOFF, PollingRegistryValueWatcher.MAX_INTERVAL)
+
+class FakeRegistry:
+    """In-memory registry key, for exercising registry watching logic without Windows. Values can be changed from
+    other threads, which wakes up any watchers."""
+
+    def __init__(self, values: Optional[dict] = None):
+        self.values = {} if values is None else dict(values)
+        self.version = 0
+        self.condition = threading.Condition()
+
+    def get_value(self, value_name: str) -> Any:
+        with self.condition:
+            return self.values.get(value_name)
+
+    def set_value(self, value_name: str, value: Any):
+        with self.condition:
+            self.values[value_name] = value
+            self.version += 1
+            self.condition.notify_all()
+
+    def watch(self, value_name: str) -> RegistryValueWatcher:
+        return FakeRegistryValueWatcher(self, value_name)
+
+class FakeRegistryValueWatcher(RegistryValueWatcher):
+    recheck_interval = None
+
+    def __init__(self, registry: FakeRegistry, value_name: str):
+        self.registry = registry
+        self.value_name = value_name
+        self.armed_version = 0
+        self.read_count = 0
+
+    def read(self) -> Any:
+        self.read_count += 1
+        return self.registry.get_value(self.value_name)
+
+    def _arm(self):
+        with self.registry.condition:
+            self.armed_version = self.registry.version
+
+    def _wait(self, timeout: Optional[float]):
+        with self.registry.condition:
+            self.registry.condition.wait_for(lambda: self.registry.version != self.armed_version, timeout)
+
+def watch_registry_value(root_key, subkey: str, value_name: str) -> RegistryValueWatcher:
+    """Watch a registry value with change notifications, falling back to polling if they aren't available."""
+    try:
+        return Win32RegistryValueWatcher(root_key, subkey, value_name)
+    except Exception:
+        import winreg
+        def read_value() -> Any:
+            try:
+                with winreg.OpenKeyEx(root_key, subkey, 0, winreg.KEY_READ) as key:
+                    value, _ = winreg.QueryValueEx(key, value_name)
+                    return value
+            except FileNotFoundError:
+                return None
+        return PollingRegistryValueWatcher(read_value)
@@ -0,0 +1,11 @@
+import importlib.util
+from pathlib import Path
+from types import ModuleType
+
+def load_script(script_path: Path) -> ModuleType:
+    """Import one of the adapter's scripts as a module, without running its main block. The scripts' file names
+    aren't valid module names, so they can't be imported normally."""
+    spec = importlib.util.spec_from_file_location(script_path.stem.replace('-', '_'), script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
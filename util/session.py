@@ -0,0 +1,120 @@
+import json
+import math
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Self, Tuple
+
+class Session:
+    """One stream, from prep to teardown.
+
+    The commands Sunshine runs are fixed when the config is written, so they can't carry an id for each stream.
+    Instead, the first script of a stream starts a session and writes it to a small file, and the scripts that run
+    after it join that session.
+    """
+
+    __VERSION = 1
+    # A session older than this is assumed to be left over from a stream that never got to start a new one
+    MAX_AGE = 24 * 60 * 60
+
+    def __init__(self, id: str, game_id: Optional[str], start_time: float):
+        self.id = id
+        self.game_id = game_id
+        self.start_time = start_time
+
+    def __str__(self) -> str:
+        return f"{self.id} (game id={self.game_id})"
+
+    def to_json_dict(self) -> dict:
+        return {
+            'version': Session.__VERSION,
+            'id': self.id,
+            'game_id': self.game_id,
+            'start_time': self.start_time
+        }
+
+    @classmethod
+    def from_json_dict(cls, j: dict) -> Optional[Self]:
+        if j.get('version') != Session.__VERSION:
+            return None
+        return cls(j['id'], j['game_id'], j['start_time'])
+
+    def to_file(self, file_path: Path):
+        # Imported here, since joining a session usually only reads it
+        from util.sunshine import write_file_atomically
+        write_file_atomically(file_path, json.dumps(self.to_json_dict()).encode('utf-8'))
+
+    @classmethod
+    def from_file(cls, file_path: Path) -> Optional[Self]:
+        try:
+            with file_path.open(mode='r', encoding='utf8') as file:
+                return cls.from_json_dict(json.load(file))
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+def start_session(session_path: Path, game_id: Optional[str] = None) -> Session:
+    """Start a new session, replacing the current one."""
+    session = Session(os.urandom(6).hex(), game_id, time.time())
+    session.to_file(session_path)
+    return session
+
+def join_session(session_path: Path, game_id: Optional[str] = None, session_id: Optional[str] = None) -> Session:
+    """Join the current session. If session_id is given, that session is joined, even if it's no longer the current
+    one. Otherwise, a new session is started if there's no current one, it's stale, or it's for a different game."""
+    session = Session.from_file(session_path)
+    if session_id:
+        if session is None or session.id != session_id:
+            return Session(session_id, game_id, time.time())
+        return session
+    if session is None or session.start_time < time.time() - Session.MAX_AGE or (game_id and session.game_id and session.game_id != game_id):
+        return start_session(session_path, game_id)
+    if game_id and not session.game_id:
+        session.game_id = game_id
+        session.to_file(session_path)
+    return session
+
+def log_span(log: Callable[..., None], session: Session, name: str, start_time: float, end_time: float, **fields):
+    """Log how long a phase of the session took. Times are from time.perf_counter."""
+    duration_ms = (end_time - start_time) * 1000
+    log(f"Span '{name}' took {duration_ms:.0f} ms", session=session.id, game_id=session.game_id, span=name, duration_ms=round(duration_ms, 1), **fields)
+
+@contextmanager
+def span(log: Callable[..., None], session: Session, name: str):
+    """Time the body as a phase of the session. If it raises, the span is still logged, marked as failed."""
+    start_time = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        log_span(log, session, name, start_time, time.perf_counter(), failed=True)
+        raise
+    log_span(log, session, name, start_time, time.perf_counter())
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of the values (which must not be empty)."""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+def get_span_records(records: Iterable[dict]) -> List[dict]:
+    """The span records (see log_span) among log records, oldest first."""
+    spans = [record for record in records if 'span' in record and 'session' in record]
+    spans.sort(key=lambda record: record['time'])
+    return spans
+
+def summarize_spans(spans: Iterable[dict]) -> Dict[Tuple[str, str], dict]:
+    """Aggregate spans by game and phase, into their count, p50, p95 and max durations in ms. Failed spans are left out."""
+    durations: Dict[Tuple[str, str], List[float]] = {}
+    for record in spans:
+        if record.get('failed'):
+            continue
+        durations.setdefault((str(record.get('game_id')), record['span']), []).append(record['duration_ms'])
+    return {
+        key: {
+            'count': len(values),
+            'p50': percentile(values, 0.5),
+            'p95': percentile(values, 0.95),
+            'max': max(values)
+        }
+        for key, values in durations.items()
+    }
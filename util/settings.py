@@ -0,0 +1,379 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import zlib
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+from util.sunshine import *
+
+class SettingsSyncStats:
+    """Counts of what a settings sync actually did, for logging."""
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.copied = 0
+        self.skipped = 0
+        self.deleted = 0
+        self.bytes_written = 0
+
+    def __str__(self) -> str:
+        return (f"{self.copied} files copied ({self.bytes_written} bytes), {self.skipped} skipped as already up to date, "
+                f"{self.deleted} deleted, in {(time.perf_counter() - self.start_time) * 1000:.1f} ms")
+
+def copy_file_atomically(src_path: Path, dest_path: Path, stats: Optional[SettingsSyncStats] = None) -> bool:
+    """Copy a file (including its timestamps, like shutil.copy2) through a temp file and rename, so a crash can never
+    leave a truncated file behind. Returns False, without writing anything, if the destination already has the same
+    contents."""
+    data = src_path.read_bytes()
+    changed = write_file_atomically(dest_path, data)
+    if changed:
+        shutil.copystat(src_path, dest_path)
+    if stats:
+        if changed:
+            stats.copied += 1
+            stats.bytes_written += len(data)
+        else:
+            stats.skipped += 1
+    return changed
+
+def files_look_identical(src_path: Path, dest_path: Path) -> bool:
+    """Whether two files have the same size and modification time. Copies made by copy_file_atomically (and files
+    restored from the settings store) keep their source's modification time, so this tells whether a file needs
+    copying without reading either of them."""
+    try:
+        src_stat = src_path.stat()
+        dest_stat = dest_path.stat()
+    except FileNotFoundError:
+        return False
+    return src_stat.st_size == dest_stat.st_size and src_stat.st_mtime_ns == dest_stat.st_mtime_ns
+
+class SettingsFiles:
+    """The files that make up a game's settings. Either a single file, or the files in a directory that match any of
+    a set of glob patterns (all files, if there are no patterns).
+
+    Files are identified by their path relative to the directory (or, for a single file, by its name), so the same
+    files can be listed in copies of the settings kept elsewhere, like the backup.
+
+    With merge, only the individual settings that changed during a stream are saved and loaded, rather than whole
+    files (see util.merge).
+    """
+
+    ALL_FILES = ('**/*',)
+
+    def __init__(self, path: Path, patterns: Optional[List[str]] = None, merge: bool = False):
+        self.path = path
+        self.patterns = list(patterns) if patterns else []
+        self.merge = merge
+        self.is_directory = bool(self.patterns) or path.is_dir()
+
+    def __str__(self) -> str:
+        string = str(self.path)
+        if self.patterns:
+            string += f" ({', '.join(self.patterns)})"
+        if self.merge:
+            string += ' merged'
+        return string
+
+    def list(self, root: Optional[Path] = None) -> Dict[str, Path]:
+        """Map each settings file under root (the settings path itself by default) to its path."""
+        root = self.path if root is None else root
+        if not self.is_directory:
+            return {self.path.name: root} if root.is_file() else {}
+        files = {}
+        for pattern in self.patterns or SettingsFiles.ALL_FILES:
+            for path in root.glob(pattern):
+                # Skip write_file_atomically's temp files
+                if path.name.startswith('.') and path.name.endswith('.tmp'):
+                    continue
+                if path.is_file():
+                    files[path.relative_to(root).as_posix()] = path
+        return files
+
+    def resolve(self, name: str, root: Optional[Path] = None) -> Path:
+        """The path of the named settings file under root (the settings path itself by default)."""
+        root = self.path if root is None else root
+        return root / name if self.is_directory else root
+
+def sync_settings_files(settings_files: SettingsFiles, src_root: Path, dest_root: Path, stats: Optional[SettingsSyncStats] = None, delete_extra: bool = True) -> bool:
+    """Make the settings files under dest_root match the ones under src_root. Files whose size and modification time
+    already match are skipped without being read. With delete_extra, settings files that only exist under dest_root
+    are deleted. Returns whether anything changed."""
+    src_files = settings_files.list(src_root)
+    changed = False
+    for name, src_path in src_files.items():
+        dest_path = settings_files.resolve(name, dest_root)
+        if files_look_identical(src_path, dest_path):
+            if stats:
+                stats.skipped += 1
+        elif copy_file_atomically(src_path, dest_path, stats):
+            changed = True
+    if delete_extra:
+        for name, dest_path in settings_files.list(dest_root).items():
+            if not name in src_files:
+                dest_path.unlink()
+                changed = True
+                if stats:
+                    stats.deleted += 1
+    return changed
+
+class SettingsJournal:
+    """Records how far a stream's settings sync got, so a stream that was interrupted (e.g. a crash or power loss
+    between load and save) can be finished off before the next load. Otherwise the next load would back up the
+    stream's settings over the original ones.
+
+    There's one small journal file per settings file, so syncs for different games never touch the same journal.
+    """
+
+    # The game's settings were backed up, but the client's settings may only have been partially loaded
+    BACKED_UP = 'backed up'
+    # Settings for the stream were loaded. The backup holds the original settings
+    LOADED = 'loaded'
+    # The stream's settings were saved for the client, but the backup may not have been restored yet
+    SAVED = 'saved'
+
+    def __init__(self, journal_dir: Path, settings_path: Path):
+        self.file_path = journal_dir / f"{hashlib.sha1(str(settings_path.resolve()).casefold().encode('utf-8')).hexdigest()}.json"
+        self.settings_path = settings_path
+
+    def read(self) -> Optional[dict]:
+        try:
+            with self.file_path.open(mode='r', encoding='utf8') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # Journal writes are atomic, so this shouldn't happen. But if it does, there's nothing to recover
+            return None
+
+    def write(self, state: str, game_id: str, client_id: str):
+        entry = {
+            'state': state,
+            'settings_path': str(self.settings_path),
+            'game_id': game_id,
+            'client_id': client_id,
+            'time': time.time()
+        }
+        write_file_atomically(self.file_path, json.dumps(entry, ensure_ascii=False, indent=4).encode('utf-8'))
+
+    def clear(self):
+        self.file_path.unlink(missing_ok=True)
+
+class SettingsStore:
+    """Content-addressed store for saved settings.
+
+    Each distinct file content is stored once, compressed, as a blob named by its hash. Which content belongs to which
+    game and client is kept in small manifests (one per game, client and settings path), along with the last
+    keep_versions versions, newest last. Each version lists the size, modification time and hash of every settings
+    file, so saving only needs to read and hash the files that changed since the last version, and loading only
+    writes the files that differ. Neither slows down as more clients and versions are stored.
+
+    Blobs that are no longer referenced (e.g. versions that fell out of the history) are only deleted by
+    collect_garbage.
+    """
+
+    __VERSION = 2
+    # Blobs younger than this are never garbage collected, since a save may have written the blob, but not yet the
+    # manifest that references it
+    GC_GRACE_PERIOD = 60 * 60
+
+    def __init__(self, root_path: Path, keep_versions: int = 10):
+        self.root_path = root_path
+        self.blob_dir = root_path / 'blobs'
+        self.manifest_dir = root_path / 'manifests'
+        self.keep_versions = keep_versions
+
+    def get_blob_path(self, content_hash: str) -> Path:
+        return self.blob_dir / content_hash[:2] / content_hash
+
+    def get_manifest_path(self, game_id: str, client_id: str, name: str) -> Path:
+        return self.manifest_dir / game_id / client_id / f"{name}.json"
+
+    def read_history(self, game_id: str, client_id: str, name: str) -> List[dict]:
+        """Return the stored versions, oldest first. Each has when it was saved, and the hash, size and modification
+        time of each file."""
+        try:
+            with self.get_manifest_path(game_id, client_id, name).open(mode='r', encoding='utf8') as file:
+                manifest = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return []
+        if manifest.get('version') == 1:
+            # Version 1 only stored single files
+            return [{'files': {name: {key: version[key] for key in ('hash', 'size', 'mtime_ns')}}, 'saved': version['saved']}
+                    for version in manifest['history']]
+        if manifest.get('version') != SettingsStore.__VERSION:
+            return []
+        return manifest['history']
+
+    def _write_history(self, game_id: str, client_id: str, name: str, history: List[dict]):
+        manifest = {'version': SettingsStore.__VERSION, 'name': name, 'history': history}
+        write_file_atomically(self.get_manifest_path(game_id, client_id, name), json.dumps(manifest, indent=4).encode('utf-8'))
+
+    def save(self, game_id: str, client_id: str, settings_files: SettingsFiles, stats: Optional[SettingsSyncStats] = None) -> bool:
+        """Store the settings files as the newest version for the game and client. Returns False, without storing
+        anything, if they're identical to the newest version."""
+        history = self.read_history(game_id, client_id, settings_files.path.name)
+        previous = history[-1]['files'] if history else {}
+        entries = {}
+        for name, path in settings_files.list().items():
+            stat = path.stat()
+            entry = previous.get(name)
+            if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+                # Unchanged since the last save, so don't bother reading it
+                entries[name] = entry
+                if stats:
+                    stats.skipped += 1
+                continue
+
+            data = path.read_bytes()
+            content_hash = self._write_blob(data, stats)
+            entries[name] = {'hash': content_hash, 'size': len(data), 'mtime_ns': stat.st_mtime_ns}
+            if stats:
+                if entry and entry['hash'] == content_hash:
+                    stats.skipped += 1
+                else:
+                    stats.copied += 1
+
+        if history and entries == previous:
+            return False
+        history.append({'files': entries, 'saved': time.time()})
+        self._write_history(game_id, client_id, settings_files.path.name, history[-self.keep_versions:])
+        return True
+
+    def save_data(self, game_id: str, client_id: str, name: str, data: bytes, stats: Optional[SettingsSyncStats] = None) -> bool:
+        """Store data that isn't read from a settings file (e.g. merged settings) as the newest version for the game
+        and client. Returns False, without storing anything, if it's identical to the newest version."""
+        history = self.read_history(game_id, client_id, name)
+        content_hash = hashlib.sha256(data).hexdigest()
+        if history and [entry['hash'] for entry in history[-1]['files'].values()] == [content_hash]:
+            if stats:
+                stats.skipped += 1
+            return False
+        self._write_blob(data, stats)
+        history.append({'files': {name: {'hash': content_hash, 'size': len(data), 'mtime_ns': 0}}, 'saved': time.time()})
+        self._write_history(game_id, client_id, name, history[-self.keep_versions:])
+        if stats:
+            stats.copied += 1
+        return True
+
+    def load_data(self, game_id: str, client_id: str, name: str) -> Optional[bytes]:
+        """The newest version stored with save_data, or None if nothing is stored."""
+        history = self.read_history(game_id, client_id, name)
+        if not history:
+            return None
+        return self.read_blob(history[-1]['files'][name])
+
+    def _write_blob(self, data: bytes, stats: Optional[SettingsSyncStats]) -> str:
+        content_hash = hashlib.sha256(data).hexdigest()
+        blob_path = self.get_blob_path(content_hash)
+        if not blob_path.is_file():
+            compressed = zlib.compress(data)
+            write_file_atomically(blob_path, compressed)
+            if stats:
+                stats.bytes_written += len(compressed)
+        return content_hash
+
+    def read_blob(self, entry: dict) -> bytes:
+        data = zlib.decompress(self.get_blob_path(entry['hash']).read_bytes())
+        if hashlib.sha256(data).hexdigest() != entry['hash']:
+            raise ValueError(f"Stored settings blob {entry['hash']} is corrupted")
+        return data
+
+    def load(self, game_id: str, client_id: str, settings_files: SettingsFiles, stats: Optional[SettingsSyncStats] = None) -> Optional[bool]:
+        """Write the newest stored version for the game and client to the settings files. Settings files that aren't
+        part of that version are left alone. Returns None if nothing is stored, otherwise whether any settings file
+        changed."""
+        history = self.read_history(game_id, client_id, settings_files.path.name)
+        if not history:
+            return None
+        changed = False
+        for name, entry in history[-1]['files'].items():
+            settings_path = settings_files.resolve(name)
+            try:
+                stat = settings_path.stat()
+                if stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime_ns']:
+                    if stats:
+                        stats.skipped += 1
+                    continue
+            except FileNotFoundError:
+                pass
+            if self._restore(entry, settings_path, stats):
+                changed = True
+        return changed
+
+    def rollback(self, game_id: str, client_id: str, name: str, steps: int = 1) -> dict:
+        """Make an older version the newest one again. The versions in between are kept in the history. Returns the
+        version that's now the newest."""
+        history = self.read_history(game_id, client_id, name)
+        if steps < 1 or steps >= len(history):
+            raise ValueError(f"Can't roll back {steps} versions, there are only {len(history)} stored versions")
+        version = dict(history[-1 - steps], saved=time.time())
+        history.append(version)
+        self._write_history(game_id, client_id, name, history[-self.keep_versions:])
+        return version
+
+    def _restore(self, entry: dict, settings_path: Path, stats: Optional[SettingsSyncStats]) -> bool:
+        data = self.read_blob(entry)
+        changed = write_file_atomically(settings_path, data)
+        # Even if the contents were already right, set the modification time, so the file is skipped next time
+        os.utime(settings_path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+        if stats:
+            if changed:
+                stats.copied += 1
+                stats.bytes_written += len(data)
+            else:
+                stats.skipped += 1
+        return changed
+
+    def collect_garbage(self, max_bytes: Optional[int] = None, log: Callable[[str], None] = print):
+        """Delete blobs that no manifest references. Then, if the blobs take up more than max_bytes, drop the oldest
+        versions (never the newest one for a game and client) until they fit."""
+        manifests = {}
+        for manifest_path in self.manifest_dir.glob('*/*/*.json'):
+            game_id, client_id = manifest_path.parent.parent.name, manifest_path.parent.name
+            name = manifest_path.name[:-len('.json')]
+            manifests[(game_id, client_id, name)] = self.read_history(game_id, client_id, name)
+
+        blob_sizes = {blob_path.name: blob_path.stat() for blob_path in self.blob_dir.glob('*/*') if blob_path.is_file()}
+        total_bytes = sum(stat.st_size for stat in blob_sizes.values())
+
+        def get_hashes(version: dict) -> set:
+            return {entry['hash'] for entry in version['files'].values()}
+
+        if max_bytes is not None and total_bytes > max_bytes:
+            # Drop old versions, oldest first, until what's left fits. A blob is only freed once no version uses it
+            references = {}
+            for history in manifests.values():
+                for version in history:
+                    for content_hash in get_hashes(version):
+                        references[content_hash] = references.get(content_hash, 0) + 1
+            referenced_bytes = sum(blob_sizes[content_hash].st_size for content_hash in references if content_hash in blob_sizes)
+            old_versions = sorted(((version['saved'], key, version) for key, history in manifests.items() for version in history[:-1]), key=lambda item: item[0])
+            dropped = set()
+            for _, key, version in old_versions:
+                if referenced_bytes <= max_bytes:
+                    break
+                dropped.add((key, id(version)))
+                for content_hash in get_hashes(version):
+                    references[content_hash] -= 1
+                    if references[content_hash] == 0 and content_hash in blob_sizes:
+                        referenced_bytes -= blob_sizes[content_hash].st_size
+            for key, history in manifests.items():
+                kept = [version for version in history if not (key, id(version)) in dropped]
+                if len(kept) != len(history):
+                    self._write_history(*key, kept)
+                    manifests[key] = kept
+            if dropped:
+                log(f"Dropped {len(dropped)} old settings versions to fit within {max_bytes} bytes")
+
+        referenced = {content_hash for history in manifests.values() for version in history for content_hash in get_hashes(version)}
+        cutoff = time.time() - SettingsStore.GC_GRACE_PERIOD
+        deleted_count = 0
+        deleted_bytes = 0
+        for content_hash, stat in blob_sizes.items():
+            if not content_hash in referenced and stat.st_mtime < cutoff:
+                self.get_blob_path(content_hash).unlink(missing_ok=True)
+                deleted_count += 1
+                deleted_bytes += stat.st_size
+        log(f"Deleted {deleted_count} unreferenced settings blobs ({deleted_bytes} bytes). {total_bytes - deleted_bytes} bytes of settings are stored")
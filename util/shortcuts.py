@@ -0,0 +1,137 @@
+import hashlib
+import json
+import mmap
+import re
+from pathlib import Path
+from typing import Iterator, List, Optional, Self, Tuple
+from util.game import *
+from util.vdf import *
+
+def get_app_id_from_alt_id(alt_id: int):
+    # The steam shortcut id (id used to launch the game) is a 64-bit unsigned integer.
+    # The 32 upper bits are simply the game's alt id. The lower 32 bits are constant.
+    return (alt_id << 32) | 0x02000000
+
+# The shortcuts.vdf fields read_shortcut uses. The rest are skipped when reading the file
+SHORTCUT_FIELDS = ('appid', 'appname', 'exe', 'StartDir', 'LaunchOptions', 'tags', 'LastPlayTime')
+
+def read_shortcut(entry: dict) -> dict:
+    """Normalize a raw shortcuts.vdf entry into a dict with consistently named fields."""
+    appid = get_field(entry, 'appid')
+    tags = get_field(entry, 'tags') or {}
+    return {
+        # appid is stored as a signed int32, but Steam treats it as unsigned
+        'appid': None if appid is None else appid & 0xFFFFFFFF,
+        'appname': get_field(entry, 'appname', ''),
+        'exe': get_field(entry, 'exe', ''),
+        'StartDir': get_field(entry, 'StartDir', ''),
+        'LaunchOptions': get_field(entry, 'LaunchOptions', ''),
+        'tags': list(tags.values()) if isinstance(tags, dict) else [],
+        'LastPlayTime': get_field(entry, 'LastPlayTime', 0),
+    }
+
+def iter_shortcuts(shortcut_path: Path) -> Iterator[dict]:
+    for _, entry in iter_file_map_entries(shortcut_path, 'shortcuts', SHORTCUT_FIELDS):
+        yield read_shortcut(entry)
+
+def shortcut_to_game(shortcut: dict) -> Game | None:
+    if shortcut['appid'] is None:
+        print(f"Non-steam game {shortcut['appname']} doesn't have an app id. Skipping.")
+        return None
+    id = get_app_id_from_alt_id(shortcut['appid'])
+    target_process = Path(re.sub(r'^"|"$', '', shortcut['exe'])).name
+    return Game(id=str(id), name=shortcut['appname'], alt_id=str(id), process_name=target_process)
+
+def iter_non_steam_games(shortcut_path: Path) -> Iterator[Game]:
+    for shortcut in iter_shortcuts(shortcut_path):
+        game = shortcut_to_game(shortcut)
+        if game:
+            yield game
+
+class ShortcutCache:
+    """Persistent cache of parsed shortcuts.vdf entries.
+
+    The whole file is fingerprinted by size, mtime and content hash. If the size and mtime match, the cached shortcuts
+    are returned without reading the file. If only those changed, the content hash is checked before anything is
+    parsed. Otherwise the whole file is parsed again, which is faster than working out which shortcuts changed.
+    """
+
+    __VERSION = 2
+
+    def __init__(self, size: Optional[int] = None, mtime_ns: Optional[int] = None, content_hash: Optional[str] = None,
+                 shortcuts: Optional[List[dict]] = None):
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.content_hash = content_hash
+        self.shortcuts = [] if shortcuts is None else shortcuts
+
+        # Statistics for the last call to read_shortcuts
+        self.parsed_count = 0
+        self.reused_count = 0
+
+    def read_shortcuts(self, shortcut_path: Path) -> Tuple[List[dict], bool]:
+        """Return the shortcuts in the given file, and whether the cache was changed (and so should be saved)."""
+        self.parsed_count = 0
+        self.reused_count = 0
+        stat = shortcut_path.stat()
+        if stat.st_size == self.size and stat.st_mtime_ns == self.mtime_ns:
+            self.reused_count = len(self.shortcuts)
+            return self.shortcuts, False
+
+        if stat.st_size == 0:
+            self._update(stat, '', [])
+            return [], True
+
+        with shortcut_path.open(mode='rb') as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                content_hash = hashlib.sha256(buffer).hexdigest()
+                if content_hash == self.content_hash:
+                    # Only the mtime changed
+                    self._update(stat, content_hash, self.shortcuts)
+                    self.reused_count = len(self.shortcuts)
+                    return self.shortcuts, True
+
+                reader = BinaryVdfReader(buffer)
+                reader.enter_map('shortcuts')
+                shortcuts = [read_shortcut(entry) for _, entry in reader.iter_map(SHORTCUT_FIELDS) if isinstance(entry, dict)]
+
+        self.parsed_count = len(shortcuts)
+        self._update(stat, content_hash, shortcuts)
+        return shortcuts, True
+
+    def _update(self, stat, content_hash: str, shortcuts: List[dict]):
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        self.content_hash = content_hash
+        self.shortcuts = shortcuts
+
+    def to_file(self, file_path: Path):
+        # json.dump writes through the pure Python encoder, which is several times slower than dumps for a file this big
+        file_path.write_text(json.dumps(self.to_json_dict(), ensure_ascii=False), encoding='utf8')
+
+    @classmethod
+    def from_file(cls, file_path: Path) -> Self:
+        if not file_path.is_file():
+            return cls()
+        try:
+            with file_path.open(mode='r', encoding='utf8') as file:
+                return cls.from_json_dict(json.load(file))
+        except (ValueError, KeyError, TypeError):
+            # The cache can always be rebuilt from shortcuts.vdf, so just start over if it's corrupted
+            print(f"Shortcut cache at {file_path} is invalid. Rebuilding it.")
+            return cls()
+
+    def to_json_dict(self) -> dict:
+        return {
+            'version': ShortcutCache.__VERSION,
+            'size': self.size,
+            'mtime_ns': self.mtime_ns,
+            'content_hash': self.content_hash,
+            'shortcuts': self.shortcuts
+        }
+
+    @classmethod
+    def from_json_dict(cls, j: dict) -> Self:
+        if j.get('version') != ShortcutCache.__VERSION:
+            return cls()
+        return cls(size=j['size'], mtime_ns=j['mtime_ns'], content_hash=j['content_hash'], shortcuts=j['shortcuts'])
@@ -1,9 +1,13 @@
+import json
+import mmap
 import re
-import win32con, win32gui
+import time
 import winreg
 from pathlib import Path
-from typing import Any, List
+from typing import Any, Dict, Iterable, List, Optional, Self, Tuple
 from util.game import *
+from util.shortcuts import *
+from util.window import *
 
 def read_reg_value(key, value_key: str) -> Any:
     value, _ = winreg.QueryValueEx(key, value_key)
@@ -17,31 +21,152 @@ def get_steam_exe_path() -> Path:
     with winreg.OpenKeyEx(winreg.HKEY_CURRENT_USER, r'SOFTWARE\Valve\Steam', 0, winreg.KEY_READ) as key:
         return Path(read_reg_value(key, 'SteamExe'))
 
-def get_localization_entry(key: str) -> str | None:
-    language = get_steam_language()
-    localization_file_path = get_steam_install_path() / "steamui" / "localization" / f"steamui_{language}-json.js"
+# Localization entries looked up whenever the localization file has to be read, so later lookups of any of them are
+# answered from the cache
+LOCALIZATION_KEYS = ('SP_WindowTitle_BigPicture',)
+# Kept in the scripts' directory, with their other runtime caches
+LOCALIZATION_CACHE_PATH = Path(__file__).resolve().parent.parent / '.localization-cache'
+
+# Body of a string value in the localization file, up to the closing quote (skipping escaped quotes)
+_LOCALIZATION_VALUE_PATTERN = re.compile(rb'[^"\\]*(?:\\.[^"\\]*)*')
+
+def read_localization_entries(localization_file_path: Path, keys: Iterable[str]) -> Dict[str, Optional[str]]:
+    """Read several entries from a Steam localization file. The file is several megabytes, so it's searched as bytes
+    through a memory map, and only the values found are decoded."""
+    entries = {key: None for key in keys}
+    if localization_file_path.stat().st_size == 0:
+        # Empty files can't be memory mapped
+        return entries
+    with localization_file_path.open(mode='rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            # A separate search per key is done at memchr speed, which beats a single regex pass over the file for
+            # the handful of keys we need
+            for key in entries:
+                prefix = b'"' + key.encode('utf-8') + b'":"'
+                start = buffer.find(prefix)
+                if start == -1:
+                    continue
+                value = _LOCALIZATION_VALUE_PATTERN.match(buffer, start + len(prefix)).group(0)
+                entries[key] = value.decode('utf-8').replace("\\'", "'")
+    return entries
+
+class LocalizationCache:
+    """Persistent cache of entries from Steam's localization file.
+
+    The cache is keyed by language, and the localization file's size and mtime. If any of those change (e.g. Steam
+    updates), the cache is emptied. Entries that aren't found in the file are cached too, as None.
+    """
+
+    __VERSION = 1
+
+    def __init__(self, language: Optional[str] = None, size: Optional[int] = None, mtime_ns: Optional[int] = None, entries: Optional[Dict[str, Optional[str]]] = None):
+        self.language = language
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.entries = {} if entries is None else entries
+
+    def get_entries(self, localization_file_path: Path, language: str, keys: Iterable[str]) -> Tuple[Dict[str, Optional[str]], bool]:
+        """Return the given entries, and whether the cache was changed (and so should be saved)."""
+        keys = list(keys)
+        changed = False
+        stat = localization_file_path.stat()
+        if (language, stat.st_size, stat.st_mtime_ns) != (self.language, self.size, self.mtime_ns):
+            self.language = language
+            self.size = stat.st_size
+            self.mtime_ns = stat.st_mtime_ns
+            self.entries = {}
+            changed = True
+
+        missing = [key for key in keys if not key in self.entries]
+        if missing:
+            # Since we have to read the file anyway, pick up all the entries we know about
+            missing += [key for key in LOCALIZATION_KEYS if not key in self.entries and not key in missing]
+            self.entries.update(read_localization_entries(localization_file_path, missing))
+            changed = True
+        return {key: self.entries[key] for key in keys}, changed
+
+    def to_file(self, file_path: Path):
+        with file_path.open(mode='w', encoding='utf8') as file:
+            json.dump(self.to_json_dict(), file, ensure_ascii=False)
+
+    @classmethod
+    def from_file(cls, file_path: Path) -> Self:
+        if not file_path.is_file():
+            return cls()
+        try:
+            with file_path.open(mode='r', encoding='utf8') as file:
+                return cls.from_json_dict(json.load(file))
+        except (ValueError, KeyError, TypeError):
+            # The cache can always be rebuilt from the localization file, so just start over if it's corrupted
+            return cls()
+
+    def to_json_dict(self) -> dict:
+        return {
+            'version': LocalizationCache.__VERSION,
+            'language': self.language,
+            'size': self.size,
+            'mtime_ns': self.mtime_ns,
+            'entries': self.entries
+        }
+
+    @classmethod
+    def from_json_dict(cls, j: dict) -> Self:
+        if j.get('version') != LocalizationCache.__VERSION:
+            return cls()
+        return cls(language=j['language'], size=j['size'], mtime_ns=j['mtime_ns'], entries=j['entries'])
+
+def get_localization_entries(keys: Iterable[str], cache_path: Optional[Path] = LOCALIZATION_CACHE_PATH) -> Dict[str, Optional[str]]:
+    # Language and install path come from the same key, so only open it once
+    with winreg.OpenKeyEx(winreg.HKEY_CURRENT_USER, r'SOFTWARE\Valve\Steam', 0, winreg.KEY_READ) as key:
+        language = read_reg_value(key, 'Language')
+        install_path = Path(read_reg_value(key, 'SteamPath'))
+    localization_file_path = install_path / "steamui" / "localization" / f"steamui_{language}-json.js"
     if not localization_file_path.is_file():
         raise FileNotFoundError(f"Could not find steam localization file at {localization_file_path}")
+    if not cache_path:
+        return read_localization_entries(localization_file_path, keys)
+
+    cache = LocalizationCache.from_file(cache_path)
+    entries, changed = cache.get_entries(localization_file_path, language, keys)
+    if changed:
+        try:
+            cache.to_file(cache_path)
+        except OSError:
+            # Not being able to save the cache shouldn't stop a game from launching
+            pass
+    return entries
 
-    value_pattern = re.compile(r'"' + re.escape(key) + r'":"([^"\\]*(\\.[^"\\]*)*)"')
-    with localization_file_path.open(encoding="utf-8") as localization_file:
-        value_match = value_pattern.search(localization_file.read())
-        if value_match:
-            return value_match.group(1).replace("\\'", "'")
+def get_localization_entry(key: str) -> str | None:
+    return get_localization_entries([key])[key]
+
+def get_steam_pid() -> int:
+    with winreg.OpenKeyEx(winreg.HKEY_CURRENT_USER, r'SOFTWARE\Valve\Steam\ActiveProcess', 0, winreg.KEY_READ) as key:
+        return read_reg_value(key, 'pid')
 
-    return None
+# Steam's own child processes. Any other child of Steam is a game (or a game's launcher)
+STEAM_HELPER_PROCESS_NAMES = ('steamwebhelper.exe', 'GameOverlayUI.exe')
 
 def get_steam_language() -> str:
     with winreg.OpenKeyEx(winreg.HKEY_CURRENT_USER, r'SOFTWARE\Valve\Steam', 0, winreg.KEY_READ) as key:
         return read_reg_value(key, 'Language')
 
+__STEAM_CONFIG_PATH = None
+
 def get_steam_config_path() -> Path:
+    """Path of the active user's Steam config directory. It's read from the registry the first time it's needed, then
+    cached. This isn't done at import, since most scripts never need it."""
+    global __STEAM_CONFIG_PATH
+    if __STEAM_CONFIG_PATH is None:
+        __STEAM_CONFIG_PATH = read_steam_config_path()
+    return __STEAM_CONFIG_PATH
+
+def read_steam_config_path() -> Path:
     with winreg.OpenKeyEx(winreg.HKEY_CURRENT_USER, r'SOFTWARE\Valve\Steam\ActiveProcess', 0, winreg.KEY_READ) as key:
         return get_steam_install_path() / 'userdata' / str(read_reg_value(key, 'ActiveUser')) / 'config'
 
 __BIG_PICTURE_WINDOW_TITLE = None
 
-def get_big_picture_window() -> int:
+def get_big_picture_window_title() -> str:
     global __BIG_PICTURE_WINDOW_TITLE
 
     # Try to read the value, then cache it. If we don't find an entry, throw an error
@@ -49,26 +174,35 @@ def get_big_picture_window() -> int:
         __BIG_PICTURE_WINDOW_TITLE = get_localization_entry('SP_WindowTitle_BigPicture')
     if not __BIG_PICTURE_WINDOW_TITLE:
         raise ValueError('Failed to find Big Picture mode window title in localization file')
+    return __BIG_PICTURE_WINDOW_TITLE
 
-    return win32gui.FindWindow('SDL_app', __BIG_PICTURE_WINDOW_TITLE)
+def get_big_picture_window(windows: Optional[WindowSystem] = None) -> int:
+    return (windows or get_window_system()).find_window('SDL_app', get_big_picture_window_title())
 
-def get_steam_window() -> int:
-    return win32gui.FindWindow('SDL_app', 'Steam')
+def get_steam_window(windows: Optional[WindowSystem] = None) -> int:
+    return (windows or get_window_system()).find_window('SDL_app', 'Steam')
 
-def close_big_picture():
-    handle = get_big_picture_window()
-    if handle:
-        win32gui.SendMessage(handle, win32con.WM_CLOSE)
+def is_big_picture_window_visible(windows: Optional[WindowSystem] = None) -> bool:
+    windows = windows or get_window_system()
+    handle = get_big_picture_window(windows)
+    return handle != 0 and windows.is_visible(handle)
 
-def close_steam_window():
-    handle = get_steam_window()
+def is_steam_window_visible(windows: Optional[WindowSystem] = None) -> bool:
+    windows = windows or get_window_system()
+    handle = get_steam_window(windows)
+    return handle != 0 and windows.is_visible(handle)
+
+def close_big_picture(windows: Optional[WindowSystem] = None):
+    windows = windows or get_window_system()
+    handle = get_big_picture_window(windows)
     if handle:
-        win32gui.SendMessage(handle, win32con.WM_CLOSE)
+        windows.close_window(handle)
 
-def get_app_id_from_alt_id(alt_id: int):
-    # The steam shortcut id (id used to launch the game) is a 64-bit unsigned integer.
-    # The 32 upper bits are simply the game's alt id. The lower 32 bits are constant.
-    return (alt_id << 32) | 0x02000000
+def close_steam_window(windows: Optional[WindowSystem] = None):
+    windows = windows or get_window_system()
+    handle = get_steam_window(windows)
+    if handle:
+        windows.close_window(handle)
 
 def get_installed_steam_games() -> List[Game]:
     installed = []
@@ -88,51 +222,19 @@ def get_installed_steam_games() -> List[Game]:
                     print(f"Game id={game_id} either doesn't have name, or installed flag. Skipping.")
     return installed
 
-# Expose the steam config path as a constant value so it can be used without re-computing it
-STEAM_CONFIG_PATH = get_steam_config_path()
-
-# The following function is adapted from code originally from https://github.com/boppreh/steamgrid.
-# Please refer to the below license from the original code.
-
-# The MIT License (MIT)
-
-# Copyright (c) 2016 BoppreH
-
-# Permission is hereby granted, free of charge, to any person obtaining a copy
-# of this software and associated documentation files (the "Software"), to deal
-# in the Software without restriction, including without limitation the rights
-# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
-# copies of the Software, and to permit persons to whom the Software is
-# furnished to do so, subject to the following conditions:
-
-# The above copyright notice and this permission notice shall be included in all
-# copies or substantial portions of the Software.
-
-# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
-# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
-# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
-# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
-# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
-# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
-# SOFTWARE.
-
-def get_non_steam_games() -> List[Game]:
-    shortcut_path = STEAM_CONFIG_PATH / 'shortcuts.vdf'
+def get_non_steam_games(cache_path: Optional[Path] = None) -> List[Game]:
+    shortcut_path = get_steam_config_path() / 'shortcuts.vdf'
     if not shortcut_path.is_file():
         print(f"No non-steam games shortcut file found at {shortcut_path}. Assuming no non-steam games are installed.")
         return []
-    shortcut_bytes = shortcut_path.read_bytes()
-
-	# The actual binary format is known, but using regexes is way easier than
-	# parsing the entire file. If I run into any problems I'll replace this.
-    game_pattern = re.compile(b"\x00\x02appid\x00(.{4})\x01appname\x00([^\x08]+?)\x00\x01exe\x00([^\x08]+?)\x00\x01.+?\x00tags\x00(?:\x01([^\x08]+?)|)\x08\x08", flags=re.DOTALL | re.IGNORECASE)
-    games = []
-    for game_match in game_pattern.findall(shortcut_bytes):
-        alt_id = int.from_bytes(game_match[0], byteorder='little', signed=False)
-        id = get_app_id_from_alt_id(alt_id)
-        name = game_match[1].decode('utf-8')
-        target = game_match[2].decode('utf-8')
-        target_process = Path(re.sub(r'^"|"$', '', target)).name
-        games.append(Game(id=str(id), name=name, alt_id=str(id), process_name=target_process))
-
+    if not cache_path:
+        return list(iter_non_steam_games(shortcut_path))
+
+    start_time = time.perf_counter()
+    cache = ShortcutCache.from_file(cache_path)
+    shortcuts, changed = cache.read_shortcuts(shortcut_path)
+    if changed:
+        cache.to_file(cache_path)
+    games = [game for game in (shortcut_to_game(shortcut) for shortcut in shortcuts) if game]
+    print(f"Read {len(games)} non-steam games in {(time.perf_counter() - start_time) * 1000:.0f} ms ({cache.parsed_count} parsed, {cache.reused_count} from cache).")
     return games
@@ -0,0 +1,77 @@
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import List
+
+# Keys added to the apps.json entries generated by this tool, so they can be told apart from entries the user added
+# to Sunshine themselves. Values are strings, since Sunshine stores everything in apps.json as strings
+MANAGED_APP_KEY = 'steam-adapter-id'
+FINGERPRINT_KEY = 'steam-adapter-fingerprint'
+
+def read_sunshine_config(file_path: Path) -> dict:
+    if not file_path.is_file():
+        return {}
+    with file_path.open(mode='r', encoding='utf-8') as file:
+        return json.load(file)
+
+def is_managed_app(app: dict, legacy_markers: List[str]) -> bool:
+    """Whether an app entry was generated by this tool. Entries written before apps were tagged are recognized by
+    referencing one of our scripts (legacy_markers) in their commands."""
+    if MANAGED_APP_KEY in app:
+        return True
+    commands = [app.get('cmd', '')] + [prep_cmd.get(key, '') for prep_cmd in app.get('prep-cmd', []) for key in ('do', 'undo')]
+    return any(marker in command for command in commands for marker in legacy_markers)
+
+def merge_sunshine_config(existing: dict, generated: dict, legacy_markers: List[str]) -> dict:
+    """Merge generated apps into an existing Sunshine config.
+
+    Any apps in the existing config that weren't generated by this tool are kept, in their original order, followed by
+    the generated apps. Existing apps that are identical to a generated app (e.g. Sunshine's default Desktop entry)
+    are replaced by the generated app, rather than duplicated.
+    """
+    generated_apps = generated.get('apps', [])
+    untagged_generated_apps = [{key: value for key, value in app.items() if key != MANAGED_APP_KEY and key != FINGERPRINT_KEY} for app in generated_apps]
+    foreign_apps = [app for app in existing.get('apps', []) if not is_managed_app(app, legacy_markers) and not app in untagged_generated_apps]
+
+    merged = {**existing, **generated}
+    merged['env'] = {**existing.get('env', {}), **generated.get('env', {})}
+    merged['apps'] = foreign_apps + generated_apps
+    return merged
+
+def write_file_atomically(file_path: Path, data: bytes) -> bool:
+    """Write a file by writing a temp file next to it, then renaming it over the original. Readers will never see a
+    partially written file. Returns False (without writing anything) if the file already has the given contents.
+
+    If the directory isn't writable, but the file is (e.g. Sunshine's config, when only its own permissions were
+    loosened), the file is overwritten in place instead.
+    """
+    if file_path.is_file() and file_path.stat().st_size == len(data) and file_path.read_bytes() == data:
+        return False
+
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=file_path.parent, prefix=f".{file_path.name}.", suffix='.tmp')
+    except PermissionError:
+        if not file_path.is_file():
+            raise
+        with file_path.open(mode='wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        return True
+    try:
+        with os.fdopen(fd, mode='wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, file_path)
+    except BaseException:
+        Path(temp_path).unlink(missing_ok=True)
+        raise
+    return True
+
+def write_sunshine_config_file(file_path: Path, config: dict) -> bool:
+    """Write a Sunshine config atomically. Returns False if the file was already up to date."""
+    data = json.dumps(config, ensure_ascii=False, indent=4).encode('utf-8')
+    return write_file_atomically(file_path, data)
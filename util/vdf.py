@@ -0,0 +1,330 @@
+import mmap
+import re
+import struct
+from pathlib import Path
+from typing import Any, Collection, Dict, FrozenSet, Iterator, Optional, Tuple
+
+# Type tags used by Steam's binary VDF format (shortcuts.vdf, appinfo.vdf, etc.)
+TYPE_MAP = 0x00
+TYPE_STRING = 0x01
+TYPE_INT32 = 0x02
+TYPE_FLOAT32 = 0x03
+TYPE_POINTER = 0x04
+TYPE_WIDE_STRING = 0x05
+TYPE_COLOR = 0x06
+TYPE_UINT64 = 0x07
+TYPE_MAP_END = 0x08
+TYPE_INT64 = 0x0A
+TYPE_MAP_END_ALT = 0x0B
+
+_INT32 = struct.Struct('<i')
+_FLOAT32 = struct.Struct('<f')
+_UINT64 = struct.Struct('<Q')
+_INT64 = struct.Struct('<q')
+
+class VdfError(ValueError):
+    pass
+
+# Records whose keys aren't needed are skipped by a regex, so skipping them doesn't cost a trip through Python each.
+# The quantifiers are possessive, since a record can only be read one way
+_FLAT_RECORD = rb'\x01[^\x00]*+\x00[^\x00]*+\x00|[\x02\x03\x04\x06][^\x00]*+\x00.{4}|[\x07\x0a][^\x00]*+\x00.{8}'
+_FIELD_PATTERNS: Dict[FrozenSet[str], Tuple[re.Pattern, Dict[bytes, str]]] = {}
+
+def _get_field_pattern(fields: FrozenSet[str]) -> Tuple[re.Pattern, Dict[bytes, str]]:
+    """Pattern that skips the records whose keys aren't one of fields (including nested maps that only hold flat
+    records), then matches the next record if it's a string or int32 (groups 1-4), or the end of the map (group 5).
+    Also returns a dict of the keys seen so far to the field they match, which the caller fills in."""
+    pattern = _FIELD_PATTERNS.get(fields)
+    if pattern is None:
+        wanted = b'|'.join(re.escape(field.encode('utf-8')) for field in fields)
+        other_key = rb'(?!(?:' + wanted + rb')\x00)[^\x00]*+\x00'
+        skip = (rb'(?:\x01' + other_key + rb'[^\x00]*+\x00|[\x02\x03\x04\x06]' + other_key + rb'.{4}|[\x07\x0a]' + other_key + rb'.{8}'
+                rb'|\x00' + other_key + rb'(?:' + _FLAT_RECORD + rb')*+[\x08\x0b])*+')
+        record = rb'(?:\x01([^\x00]*+)\x00([^\x00]*+)\x00|\x02([^\x00]*+)\x00(.{4})|([\x08\x0b]))?'
+        pattern = _FIELD_PATTERNS[fields] = (re.compile(skip + record, flags=re.DOTALL | re.IGNORECASE), {})
+    return pattern
+
+def _get_field_name(fields: FrozenSet[str], key: str) -> Optional[str]:
+    folded = key.casefold()
+    for field in fields:
+        if field.casefold() == folded:
+            return field
+    return None
+
+class BinaryVdfReader:
+    """Incremental reader for binary VDF data.
+
+    Records are decoded one at a time straight out of the underlying buffer (bytes or mmap), so callers can stop
+    early or consume large maps entry by entry without building the whole tree in memory.
+    """
+
+    def __init__(self, buffer, offset: int = 0):
+        self.buffer = buffer
+        self.offset = offset
+
+    def iter_map(self, fields: Optional[Collection[str]] = None) -> Iterator[Tuple[str, Any]]:
+        """Yield (key, value) pairs until the end of the current map. Nested maps are read into dicts, with only the
+        given fields if any (see read_map)."""
+        if fields is not None:
+            fields = frozenset(fields)
+        # Large files are mostly one big map of maps (e.g. a shortcut per entry), so read each entry's header inline
+        buffer = self.buffer
+        while True:
+            if self.offset >= len(buffer):
+                raise VdfError(f"Unexpected end of data at offset {self.offset}")
+            value_type = buffer[self.offset]
+            if value_type == TYPE_MAP_END or value_type == TYPE_MAP_END_ALT:
+                self.offset += 1
+                return
+            end = buffer.find(b'\x00', self.offset + 1)
+            if end < 0:
+                raise VdfError(f"Unterminated string at offset {self.offset + 1}")
+            key = buffer[self.offset + 1:end].decode('utf-8', 'replace')
+            self.offset = end + 1
+            if value_type == TYPE_MAP:
+                yield key, self._read_fields(fields) if fields is not None else self.read_map()
+            else:
+                yield key, self._read_value(value_type, key)
+
+    def read_map(self, fields: Optional[Collection[str]] = None) -> dict:
+        """Read the rest of the current map into a dict. If fields are given, only the records with those keys (matched
+        case-insensitively, for ASCII keys) are read, and the rest are skipped. The dict is then keyed by the names in
+        fields, rather than however the file happens to spell them."""
+        if fields is not None:
+            return self._read_fields(fields if isinstance(fields, frozenset) else frozenset(fields))
+        # This is the hot path when reading large files, so it inlines the common record types to avoid
+        # per-record method calls
+        buffer = self.buffer
+        find = buffer.find
+        unpack_int32 = _INT32.unpack_from
+        offset = self.offset
+        result = {}
+        try:
+            while True:
+                value_type = buffer[offset]
+                if value_type == TYPE_MAP_END or value_type == TYPE_MAP_END_ALT:
+                    self.offset = offset + 1
+                    return result
+                end = find(b'\x00', offset + 1)
+                if end < 0:
+                    raise VdfError(f"Unterminated string at offset {offset + 1}")
+                if value_type == TYPE_STRING:
+                    value_end = find(b'\x00', end + 1)
+                    if value_end < 0:
+                        raise VdfError(f"Unterminated string at offset {end + 1}")
+                    result[buffer[offset + 1:end].decode('utf-8', 'replace')] = buffer[end + 1:value_end].decode('utf-8', 'replace')
+                    offset = value_end + 1
+                elif value_type == TYPE_INT32:
+                    result[buffer[offset + 1:end].decode('utf-8', 'replace')] = unpack_int32(buffer, end + 1)[0]
+                    offset = end + 5
+                else:
+                    key = buffer[offset + 1:end].decode('utf-8', 'replace')
+                    self.offset = end + 1
+                    result[key] = self._read_value(value_type, key)
+                    offset = self.offset
+        except (IndexError, struct.error):
+            raise VdfError(f"Unexpected end of data at offset {offset}")
+
+    def _read_fields(self, fields: FrozenSet[str]) -> dict:
+        buffer = self.buffer
+        pattern, names = _get_field_pattern(fields)
+        match_record = pattern.match
+        unpack_int32 = _INT32.unpack
+        offset = self.offset
+        result = {}
+        while True:
+            match = match_record(buffer, offset)
+            offset = match.end()
+            string_key, string_value, int_key, int_value, map_end = match.groups()
+            if string_key is not None:
+                name = names.get(string_key) or names.setdefault(string_key, _get_field_name(fields, string_key.decode('utf-8', 'replace')))
+                result[name] = string_value.decode('utf-8', 'replace')
+            elif int_key is not None:
+                name = names.get(int_key) or names.setdefault(int_key, _get_field_name(fields, int_key.decode('utf-8', 'replace')))
+                result[name] = unpack_int32(int_value)[0]
+            elif map_end is not None:
+                self.offset = offset
+                return result
+            else:
+                # Anything else the pattern doesn't handle (e.g. a nested map that's needed, or one that has maps of
+                # its own) is read one record at a time. This also reports the end of the data
+                self.offset = offset
+                value_type = self._read_byte()
+                key = self._read_string()
+                name = _get_field_name(fields, key)
+                if name is not None:
+                    result[name] = self._read_value(value_type, key)
+                else:
+                    self._skip_value(value_type, key)
+                offset = self.offset
+
+    def iter_map_spans(self) -> Iterator[Tuple[str, int, int]]:
+        """Yield (key, start, end) for each nested map in the current map, without decoding it.
+
+        start and end delimit the nested map's body, so it can be decoded later with BinaryVdfReader(buffer, start).read_map().
+        """
+        while True:
+            value_type = self._read_byte()
+            if value_type == TYPE_MAP_END or value_type == TYPE_MAP_END_ALT:
+                return
+            key = self._read_string()
+            start = self.offset
+            self._skip_value(value_type, key)
+            if value_type == TYPE_MAP:
+                yield key, start, self.offset
+
+    def enter_map(self, key: str):
+        """Advance into the nested map with the given key (case-insensitive), skipping any records before it."""
+        while True:
+            value_type = self._read_byte()
+            if value_type == TYPE_MAP_END or value_type == TYPE_MAP_END_ALT:
+                raise VdfError(f"Could not find map with key '{key}'")
+            record_key = self._read_string()
+            if value_type == TYPE_MAP and record_key.casefold() == key.casefold():
+                return
+            self._skip_value(value_type, record_key)
+
+    def _read_value(self, value_type: int, key: str) -> Any:
+        if value_type == TYPE_MAP:
+            return self.read_map()
+        elif value_type == TYPE_STRING:
+            return self._read_string()
+        elif value_type == TYPE_INT32 or value_type == TYPE_POINTER or value_type == TYPE_COLOR:
+            return self._unpack(_INT32)
+        elif value_type == TYPE_FLOAT32:
+            return self._unpack(_FLOAT32)
+        elif value_type == TYPE_UINT64:
+            return self._unpack(_UINT64)
+        elif value_type == TYPE_INT64:
+            return self._unpack(_INT64)
+        elif value_type == TYPE_WIDE_STRING:
+            return self._read_wide_string()
+        raise VdfError(f"Unknown value type {value_type:#04x} for key '{key}' at offset {self.offset}")
+
+    def _skip_value(self, value_type: int, key: str):
+        if value_type == TYPE_MAP:
+            self._skip_map()
+        elif value_type == TYPE_STRING:
+            self.offset = self._find(b'\x00') + 1
+        elif value_type in (TYPE_INT32, TYPE_POINTER, TYPE_COLOR, TYPE_FLOAT32):
+            self._advance(4)
+        elif value_type == TYPE_UINT64 or value_type == TYPE_INT64:
+            self._advance(8)
+        elif value_type == TYPE_WIDE_STRING:
+            self._read_wide_string()
+        else:
+            raise VdfError(f"Unknown value type {value_type:#04x} for key '{key}' at offset {self.offset}")
+
+    def _skip_map(self):
+        # Same idea as read_map: inline the common record types, since skipping is used to split large files
+        buffer = self.buffer
+        find = buffer.find
+        offset = self.offset
+        try:
+            while True:
+                value_type = buffer[offset]
+                if value_type == TYPE_MAP_END or value_type == TYPE_MAP_END_ALT:
+                    self.offset = offset + 1
+                    return
+                end = find(b'\x00', offset + 1)
+                if end < 0:
+                    raise VdfError(f"Unterminated string at offset {offset + 1}")
+                if value_type == TYPE_STRING:
+                    offset = find(b'\x00', end + 1) + 1
+                    if offset == 0:
+                        raise VdfError(f"Unterminated string at offset {end + 1}")
+                elif value_type == TYPE_INT32:
+                    offset = end + 5
+                else:
+                    self.offset = end + 1
+                    self._skip_value(value_type, buffer[offset + 1:end].decode('utf-8', 'replace'))
+                    offset = self.offset
+        except IndexError:
+            raise VdfError(f"Unexpected end of data at offset {offset}")
+
+    def _read_byte(self) -> int:
+        if self.offset >= len(self.buffer):
+            raise VdfError(f"Unexpected end of data at offset {self.offset}")
+        value = self.buffer[self.offset]
+        self.offset += 1
+        return value
+
+    def _read_string(self) -> str:
+        end = self._find(b'\x00')
+        value = self.buffer[self.offset:end]
+        self.offset = end + 1
+        return bytes(value).decode('utf-8', errors='replace')
+
+    def _read_wide_string(self) -> str:
+        end = self.offset
+        while True:
+            end = self._find(b'\x00\x00', end)
+            # Wide characters are 2-byte aligned relative to the start of the string
+            if (end - self.offset) % 2 == 0:
+                break
+            end += 1
+        value = self.buffer[self.offset:end]
+        self.offset = end + 2
+        return bytes(value).decode('utf-16-le', errors='replace')
+
+    def _find(self, terminator: bytes, start: int | None = None) -> int:
+        end = self.buffer.find(terminator, self.offset if start is None else start)
+        if end < 0:
+            raise VdfError(f"Unterminated string at offset {self.offset}")
+        return end
+
+    def _unpack(self, fmt: struct.Struct) -> Any:
+        self._advance(fmt.size)
+        return fmt.unpack_from(self.buffer, self.offset - fmt.size)[0]
+
+    def _advance(self, count: int):
+        if self.offset + count > len(self.buffer):
+            raise VdfError(f"Unexpected end of data at offset {self.offset}")
+        self.offset += count
+
+def iter_file_map_entries(file_path: Path, key: str, fields: Optional[Collection[str]] = None) -> Iterator[Tuple[str, dict]]:
+    """Lazily yield the entries of the top-level map with the given key in a binary VDF file. If fields are given,
+    each entry only has the fields with those keys (see BinaryVdfReader.read_map).
+
+    The file is memory-mapped, so only the pages for entries that are actually consumed are read.
+    """
+    with file_path.open(mode='rb') as file:
+        if file_path.stat().st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            reader = BinaryVdfReader(buffer)
+            reader.enter_map(key)
+            for entry_key, value in reader.iter_map(fields):
+                if isinstance(value, dict):
+                    yield entry_key, value
+
+def get_field(entry: dict, key: str, default: Any = None) -> Any:
+    """Look up a field case-insensitively. Steam has changed the casing of shortcut keys over time (appname vs AppName)."""
+    if key in entry:
+        return entry[key]
+    folded = key.casefold()
+    for entry_key, value in entry.items():
+        if entry_key.casefold() == folded:
+            return value
+    return default
+
+def dumps(root: dict) -> bytes:
+    """Serialize a dict to binary VDF. Supports nested dicts, strings and ints (written as int32)."""
+    parts = []
+    _dump_map(root, parts)
+    parts.append(bytes([TYPE_MAP_END]))
+    return b''.join(parts)
+
+def _dump_map(value: dict, parts: list):
+    for key, item in value.items():
+        encoded_key = str(key).encode('utf-8') + b'\x00'
+        if isinstance(item, dict):
+            parts.append(bytes([TYPE_MAP]) + encoded_key)
+            _dump_map(item, parts)
+            parts.append(bytes([TYPE_MAP_END]))
+        elif isinstance(item, str):
+            parts.append(bytes([TYPE_STRING]) + encoded_key + item.encode('utf-8') + b'\x00')
+        elif isinstance(item, int):
+            parts.append(bytes([TYPE_INT32]) + encoded_key + (item & 0xFFFFFFFF).to_bytes(4, byteorder='little'))
+        else:
+            raise VdfError(f"Cannot serialize value of type {type(item).__name__} for key '{key}'")
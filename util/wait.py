@@ -0,0 +1,109 @@
+import threading
+import time
+from typing import Any, Callable, List, Optional
+
+class WaitResult:
+    """Outcome and timing of a single wait_until call."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.success = False
+        self.cancelled = False
+        self.elapsed = 0.0
+        self.probes = 0
+
+    def __str__(self) -> str:
+        outcome = 'cancelled' if self.cancelled else ('done' if self.success else 'timed out')
+        return f"Wait for {self.name} {outcome} after {self.elapsed:.3f} seconds and {self.probes} probes"
+
+class WaitTimeoutError(RuntimeError):
+    def __init__(self, result: WaitResult, timeout: float):
+        super().__init__(f"Timed out waiting for {result.name}. Waited {timeout} seconds ({result.probes} probes)")
+        self.result = result
+
+class WaitEvents:
+    """Source of wake-ups for wait_until, so the condition is re-checked as soon as something it depends on changes,
+    rather than on the next poll. The condition is still re-checked every recheck_interval seconds, in case an event is
+    missed. If events can't be missed, recheck_interval is None, and the wait only wakes up for events (or the timeout)."""
+
+    recheck_interval: Optional[float] = 1.0
+
+    def arm(self) -> Any:
+        """Called before each check of the condition. Returns a token to pass to wait."""
+        raise NotImplementedError()
+
+    def wait(self, token: Any, timeout: Optional[float]):
+        """Block until an event arrives after the matching arm call, or the timeout (in seconds, or None for no timeout)
+        passes."""
+        raise NotImplementedError()
+
+def wait_until(condition: Callable[[], bool], name: str, timeout: Optional[float] = None, stable_for: float = 0,
+               initial_interval: float = 0.05, max_interval: float = 0.5, backoff: float = 1.5,
+               cancel: Optional[threading.Event] = None, raise_on_timeout: bool = True,
+               log: Optional[Callable[[str], None]] = None, events: Optional[WaitEvents] = None) -> WaitResult:
+    """Poll condition until it's true, with adaptive backoff.
+
+    Polling starts every initial_interval seconds, since most waits finish quickly, then slows down by a factor of
+    backoff up to max_interval. If stable_for is given, the condition must stay true for that many seconds (across
+    every probe in between) before the wait succeeds. This is for states that flicker, like windows that close and
+    reopen.
+
+    If events are given, the condition is re-checked whenever one arrives, instead of polling (see WaitEvents). The
+    cancel event is then only checked between events and rechecks.
+
+    The wait gives up once timeout seconds pass (raising WaitTimeoutError, unless raise_on_timeout is false), or when
+    the cancel event is set. The result is passed to log if given.
+    """
+    result = WaitResult(name)
+    start_time = time.perf_counter()
+    deadline = None if timeout is None else start_time + timeout
+    interval = initial_interval if events is None else events.recheck_interval
+    token = None
+    stable_since = None
+    try:
+        while True:
+            result.probes += 1
+            if events is not None:
+                # Arm before checking, so an event between checking and waiting isn't missed
+                token = events.arm()
+            now = time.perf_counter()
+            if condition():
+                if stable_since is None:
+                    stable_since = now
+                if now - stable_since >= stable_for:
+                    result.success = True
+                    return result
+            else:
+                stable_since = None
+
+            now = time.perf_counter()
+            if deadline is not None and now >= deadline:
+                if raise_on_timeout:
+                    raise WaitTimeoutError(result, timeout)
+                return result
+
+            # None means waiting for the next event, however long it takes
+            sleep_time = interval
+            if stable_since is not None:
+                # Don't overshoot the end of the stability window
+                stable_time = max(0, stable_since + stable_for - now)
+                sleep_time = stable_time if sleep_time is None else min(sleep_time, stable_time)
+            if deadline is not None:
+                sleep_time = deadline - now if sleep_time is None else min(sleep_time, deadline - now)
+            if events is not None:
+                events.wait(token, sleep_time)
+                if cancel is not None and cancel.is_set():
+                    result.cancelled = True
+                    return result
+                continue
+            if cancel is not None:
+                if cancel.wait(sleep_time):
+                    result.cancelled = True
+                    return result
+            else:
+                time.sleep(sleep_time)
+            interval = min(interval * backoff, max_interval)
+    finally:
+        result.elapsed = time.perf_counter() - start_time
+        if log:
+            log(str(result))
@@ -0,0 +1,223 @@
+import sys
+import threading
+from typing import Any, Dict, List, Optional
+from util.wait import *
+
+class WindowWatcher(WaitEvents):
+    """Wakes up wait_until whenever a top-level window is created, shown, hidden, destroyed or renamed.
+
+    The events themselves come from a separate source (see Win32WindowEventSource and FakeWindowSystem), which calls
+    notify. Without a source, this degrades to polling every recheck_interval seconds.
+    """
+
+    # How often conditions are re-checked if no events arrive. Short when there's no event source, since then it's
+    # the only way changes are noticed
+    EVENT_RECHECK_INTERVAL = 1.0
+    POLLING_RECHECK_INTERVAL = 0.25
+
+    def __init__(self):
+        self.version = 0
+        self.condition = threading.Condition()
+        self.source = None
+        self.recheck_interval = WindowWatcher.POLLING_RECHECK_INTERVAL
+
+    def attach(self, source):
+        self.source = source
+        self.recheck_interval = WindowWatcher.EVENT_RECHECK_INTERVAL
+
+    def notify(self):
+        with self.condition:
+            self.version += 1
+            self.condition.notify_all()
+
+    def arm(self) -> Any:
+        with self.condition:
+            return self.version
+
+    def wait(self, token: Any, timeout: float):
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != token, timeout)
+
+    def close(self):
+        if self.source:
+            self.source.close()
+            self.source = None
+        self.recheck_interval = WindowWatcher.POLLING_RECHECK_INTERVAL
+
+class Win32WindowEventSource:
+    """Listens for window events with SetWinEventHook, on a background thread running a message loop (which is how
+    out-of-context hooks are delivered)."""
+
+    EVENT_OBJECT_CREATE = 0x8000
+    EVENT_OBJECT_HIDE = 0x8003
+    EVENT_OBJECT_NAMECHANGE = 0x800C
+    WINEVENT_OUTOFCONTEXT = 0x0000
+    WINEVENT_SKIPOWNPROCESS = 0x0002
+    OBJID_WINDOW = 0
+    WM_QUIT = 0x0012
+
+    def __init__(self, watcher: WindowWatcher):
+        import ctypes
+        from ctypes import wintypes
+
+        self.ctypes = ctypes
+        self.wintypes = wintypes
+        self.watcher = watcher
+        self.user32 = ctypes.WinDLL('user32', use_last_error=True)
+        self.kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        self.proc_type = ctypes.WINFUNCTYPE(None, wintypes.HANDLE, wintypes.DWORD, wintypes.HWND, wintypes.LONG, wintypes.LONG, wintypes.DWORD, wintypes.DWORD)
+        self.user32.SetWinEventHook.argtypes = [wintypes.DWORD, wintypes.DWORD, wintypes.HMODULE, self.proc_type, wintypes.DWORD, wintypes.DWORD, wintypes.DWORD]
+        self.user32.SetWinEventHook.restype = wintypes.HANDLE
+        self.user32.UnhookWinEvent.argtypes = [wintypes.HANDLE]
+        self.user32.GetMessageW.argtypes = [ctypes.POINTER(wintypes.MSG), wintypes.HWND, wintypes.UINT, wintypes.UINT]
+        self.user32.PostThreadMessageW.argtypes = [wintypes.DWORD, wintypes.UINT, wintypes.WPARAM, wintypes.LPARAM]
+        # Kept on self, otherwise ctypes would let the callback be garbage collected while the hook still uses it
+        self.callback = self.proc_type(self._on_event)
+        self.thread_id = None
+        self.error = None
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.error:
+            raise self.error
+
+    def close(self):
+        if self.thread_id is not None:
+            self.user32.PostThreadMessageW(self.thread_id, Win32WindowEventSource.WM_QUIT, 0, 0)
+            self.thread.join()
+            self.thread_id = None
+
+    def _on_event(self, hook, event, hwnd, id_object, id_child, event_thread, event_time):
+        # Only care about windows themselves, not the controls inside them
+        if id_object == Win32WindowEventSource.OBJID_WINDOW and id_child == 0:
+            self.watcher.notify()
+
+    def _run(self):
+        flags = Win32WindowEventSource.WINEVENT_OUTOFCONTEXT | Win32WindowEventSource.WINEVENT_SKIPOWNPROCESS
+        hooks = [
+            self.user32.SetWinEventHook(Win32WindowEventSource.EVENT_OBJECT_CREATE, Win32WindowEventSource.EVENT_OBJECT_HIDE, None, self.callback, 0, 0, flags),
+            self.user32.SetWinEventHook(Win32WindowEventSource.EVENT_OBJECT_NAMECHANGE, Win32WindowEventSource.EVENT_OBJECT_NAMECHANGE, None, self.callback, 0, 0, flags),
+        ]
+        try:
+            if not all(hooks):
+                self.error = self.ctypes.WinError(self.ctypes.get_last_error())
+                return
+            self.thread_id = self.kernel32.GetCurrentThreadId()
+            self.ready.set()
+            msg = self.wintypes.MSG()
+            while self.user32.GetMessageW(self.ctypes.byref(msg), None, 0, 0) > 0:
+                pass
+        finally:
+            for hook in hooks:
+                if hook:
+                    self.user32.UnhookWinEvent(hook)
+            self.ready.set()
+
+class WindowSystem:
+    """Finds, checks and closes top-level windows. Its watcher wakes up wait_until whenever the windows change."""
+
+    watcher: WindowWatcher
+
+    def find_window(self, class_name: str, title: str) -> int:
+        """Return the handle of the window with the given class and title, or 0 if there isn't one."""
+        raise NotImplementedError()
+
+    def is_visible(self, handle: int) -> bool:
+        raise NotImplementedError()
+
+    def close_window(self, handle: int):
+        """Ask a window to close, like clicking its close button. It may not actually close."""
+        raise NotImplementedError()
+
+class Win32WindowSystem(WindowSystem):
+    """The desktop's windows, through pywin32. Shares the process-wide window watcher."""
+
+    def __init__(self):
+        import win32con, win32gui
+        self.win32con = win32con
+        self.win32gui = win32gui
+        self.watcher = get_window_watcher()
+
+    def find_window(self, class_name: str, title: str) -> int:
+        return self.win32gui.FindWindow(class_name, title)
+
+    def is_visible(self, handle: int) -> bool:
+        return bool(self.win32gui.IsWindowVisible(handle))
+
+    def close_window(self, handle: int):
+        self.win32gui.SendMessage(handle, self.win32con.WM_CLOSE)
+
+class FakeWindowSystem(WindowSystem):
+    """In-memory set of top-level windows, for exercising window handling logic without Windows. Changing a window
+    (from any thread) notifies the watcher, like the real event hook would. Windows asked to close are destroyed, and
+    their handles recorded, in order, in closed."""
+
+    def __init__(self):
+        self.watcher = WindowWatcher()
+        self.watcher.attach(self)
+        self.windows: Dict[int, dict] = {}
+        self.closed: List[int] = []
+        self.next_handle = 1
+        self.lock = threading.Lock()
+
+    def create(self, class_name: str, title: str, visible: bool = True) -> int:
+        with self.lock:
+            handle = self.next_handle
+            self.next_handle += 1
+            self.windows[handle] = {'class': class_name, 'title': title, 'visible': visible}
+        self.watcher.notify()
+        return handle
+
+    def set_visible(self, handle: int, visible: bool):
+        with self.lock:
+            self.windows[handle]['visible'] = visible
+        self.watcher.notify()
+
+    def destroy(self, handle: int):
+        with self.lock:
+            self.windows.pop(handle, None)
+        self.watcher.notify()
+
+    def find_window(self, class_name: str, title: str) -> int:
+        with self.lock:
+            for handle, window in self.windows.items():
+                if window['class'] == class_name and window['title'] == title:
+                    return handle
+        return 0
+
+    def is_visible(self, handle: int) -> bool:
+        with self.lock:
+            return handle in self.windows and self.windows[handle]['visible']
+
+    def close_window(self, handle: int):
+        with self.lock:
+            self.closed.append(handle)
+        self.destroy(handle)
+
+    def close(self):
+        pass
+
+__WINDOW_WATCHER = None
+
+def get_window_watcher() -> WindowWatcher:
+    """Process-wide window watcher. It's driven by window events when they're available, and falls back to polling
+    otherwise."""
+    global __WINDOW_WATCHER
+    if __WINDOW_WATCHER is None:
+        watcher = WindowWatcher()
+        if sys.platform == 'win32':
+            try:
+                watcher.attach(Win32WindowEventSource(watcher))
+            except (OSError, AttributeError):
+                pass
+        __WINDOW_WATCHER = watcher
+    return __WINDOW_WATCHER
+
+__WINDOW_SYSTEM = None
+
+def get_window_system() -> WindowSystem:
+    global __WINDOW_SYSTEM
+    if __WINDOW_SYSTEM is None:
+        __WINDOW_SYSTEM = Win32WindowSystem()
+    return __WINDOW_SYSTEM